@@ -0,0 +1,217 @@
+"""Per-model admission control (UPSTREAM_MAX_CONCURRENCY > 0).
+
+Without it every request is forwarded immediately: a saturated model's boxes queue or
+reject inside vLLM, and once all of them fail the caller gets a 503. With it, each
+upstream takes at most UPSTREAM_MAX_CONCURRENCY inflight requests (set it to the boxes'
+`max_num_seqs`), counted from the cluster-wide leases in load_tracker. Requests beyond that
+wait in a bounded per-model queue (ADMISSION_QUEUE_SIZE) until a lease frees up, or fail
+with 503 after ADMISSION_TIMEOUT_SECONDS.
+
+Only the route's healthy servers count towards capacity, as long as it has any: a dead or
+unloaded box holds no leases and would otherwise always look free, so the queue would
+never engage during a partial outage. An admitted request is then routed to a server
+below the cap first (`order`), whatever cookie stickiness or prefix affinity preferred.
+
+Loads lag admissions: a request admitted now takes its lease a moment later, on its first
+attempt. Until it does (or gives up), its slot stays reserved on the model's queue and is
+subtracted from the free slots, so a burst can't all be admitted against the same loads.
+The proxy calls `settle` once the lease has been taken.
+
+The queue is fair across callers: waiters are grouped by API key (or x402 payer) and
+admitted round-robin, so one client's burst doesn't starve everyone else's requests.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from http import HTTPStatus
+
+from fastapi import HTTPException
+
+from src.config import config
+from src.load_tracker import get_loads
+from src.logger import setup_logger
+from src.routing import CompiledRoute, routing_table
+
+logger = setup_logger(__name__)
+
+# How often a model with waiters re-reads its servers' loads. Leases are released on other
+# replicas too, so polling is the only way to see all of them.
+POLL_INTERVAL = 0.05
+EWMA_ALPHA = 0.2
+
+
+def _capacity_servers(route: CompiledRoute) -> tuple[str, ...]:
+    """Servers whose free slots admit requests: the healthy tier, or every tier if it's empty."""
+    return route.healthy or route.servers
+
+
+def _free_slots(servers: tuple[str, ...], loads: dict[str, int], reserved: int) -> int:
+    cap = config.UPSTREAM_MAX_CONCURRENCY
+    return sum(max(cap - loads.get(s, 0), 0) for s in servers) - reserved
+
+
+class _Waiter:
+    __slots__ = ("future", "enqueued_at")
+
+    def __init__(self) -> None:
+        self.future: asyncio.Future[dict[str, int]] = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+
+
+class ModelQueue:
+    def __init__(self, model: str) -> None:
+        self.model = model
+        self.callers: OrderedDict[str, deque[_Waiter]] = OrderedDict()
+        self.depth = 0
+        self.reserved = 0  # admitted requests whose lease hasn't been taken yet
+        self.dispatcher: asyncio.Task | None = None
+        # Stats
+        self.admitted = 0
+        self.queued_total = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self.wait_ewma = 0.0  # seconds, over requests that had to queue
+        self.wait_max = 0.0
+
+    def push(self, caller: str, waiter: _Waiter) -> None:
+        self.callers.setdefault(caller, deque()).append(waiter)
+        self.depth += 1
+        self.queued_total += 1
+
+    def pop(self) -> _Waiter | None:
+        """Next waiter, round-robin over callers."""
+        while self.callers:
+            caller, waiters = next(iter(self.callers.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                self.callers.move_to_end(caller)
+            else:
+                del self.callers[caller]
+            self.depth -= 1
+            if not waiter.future.done():  # skip waiters that gave up
+                return waiter
+        return None
+
+    def discard(self, caller: str, waiter: _Waiter) -> None:
+        waiters = self.callers.get(caller)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            self.depth -= 1
+            if not waiters:
+                del self.callers[caller]
+
+    def record_wait(self, seconds: float) -> None:
+        self.wait_ewma = seconds if not self.wait_ewma else self.wait_ewma + EWMA_ALPHA * (seconds - self.wait_ewma)
+        self.wait_max = max(self.wait_max, seconds)
+
+
+class AdmissionController:
+    def __init__(self) -> None:
+        self.queues: dict[str, ModelQueue] = {}
+
+    def _queue(self, model: str) -> ModelQueue:
+        queue = self.queues.get(model)
+        if queue is None:
+            queue = self.queues[model] = ModelQueue(model)
+        return queue
+
+    async def admit(self, route: CompiledRoute, loads: dict[str, int], caller: str) -> dict[str, int]:
+        """Wait until one of the route's servers has a free slot; returns the loads to route
+        with. Raises HTTPException(503) when the queue is full or the deadline passes."""
+        if config.UPSTREAM_MAX_CONCURRENCY <= 0:
+            return loads
+        queue = self._queue(route.model)
+        servers = _capacity_servers(route)
+        if queue.depth == 0 and _free_slots(servers, loads, queue.reserved) > 0:
+            queue.admitted += 1
+            queue.reserved += 1
+            return loads
+
+        if queue.depth >= config.ADMISSION_QUEUE_SIZE:
+            queue.rejected += 1
+            raise HTTPException(
+                status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+                detail=f"Too many queued requests for model {route.model}",
+                headers={"Retry-After": "1"},
+            )
+
+        waiter = _Waiter()
+        queue.push(caller, waiter)
+        if queue.dispatcher is None or queue.dispatcher.done():
+            queue.dispatcher = asyncio.create_task(self._dispatch(queue, route))
+        try:
+            fresh = await asyncio.wait_for(asyncio.shield(waiter.future), config.ADMISSION_TIMEOUT_SECONDS)
+        except BaseException as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.settle(route.model)  # admitted just as we gave up: free the reserved slot
+            if not isinstance(e, asyncio.TimeoutError):
+                raise
+            queue.timed_out += 1
+            logger.warning(f"Admission timed out for model {route.model} ({queue.depth} queued)")
+            raise HTTPException(
+                status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+                detail=f"All servers busy for model {route.model}",
+                headers={"Retry-After": "1"},
+            )
+        finally:
+            if not waiter.future.done():
+                waiter.future.cancel()
+                queue.discard(caller, waiter)
+        queue.record_wait(time.monotonic() - waiter.enqueued_at)
+        queue.admitted += 1
+        return fresh
+
+    def settle(self, model: str) -> None:
+        """Release an admitted request's reservation: its lease has been taken, or it never will be."""
+        queue = self.queues.get(model)
+        if queue is not None and queue.reserved > 0:
+            queue.reserved -= 1
+
+    def order(self, route: CompiledRoute, servers: list[str], loads: dict[str, int]) -> list[str]:
+        """Stable partition: capacity servers already at the cap go behind everything else."""
+        cap = config.UPSTREAM_MAX_CONCURRENCY
+        if cap <= 0:
+            return servers
+        counted = _capacity_servers(route)
+        full = [s for s in servers if s in counted and loads.get(s, 0) >= cap]
+        if not full:
+            return servers
+        return [s for s in servers if s not in full] + full
+
+    async def _dispatch(self, queue: ModelQueue, route: CompiledRoute) -> None:
+        """Hand free slots to waiters as leases are released, until the queue drains."""
+        try:
+            while queue.depth:
+                # Health changes while requests wait: count the current healthy tier each time
+                route = routing_table.get(route.model) or route
+                servers = _capacity_servers(route)
+                loads = await get_loads(servers)
+                for _ in range(_free_slots(servers, loads, queue.reserved)):
+                    waiter = queue.pop()
+                    if waiter is None:
+                        break
+                    queue.reserved += 1
+                    waiter.future.set_result(loads)
+                if queue.depth:
+                    await asyncio.sleep(POLL_INTERVAL)
+        except Exception as e:
+            logger.error(f"Admission dispatcher for {queue.model} failed: {e}", exc_info=True)
+
+    def stats(self) -> dict[str, dict]:
+        return {
+            model: {
+                "queued": q.depth,
+                "reserved": q.reserved,
+                "admitted": q.admitted,
+                "queued_total": q.queued_total,
+                "timed_out": q.timed_out,
+                "rejected": q.rejected,
+                "wait_ms_avg": round(q.wait_ewma * 1000, 1),
+                "wait_ms_max": round(q.wait_max * 1000, 1),
+            }
+            for model, q in self.queues.items()
+        }
+
+
+admission = AdmissionController()
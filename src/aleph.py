@@ -5,6 +5,7 @@ import httpx
 
 from src.logger import setup_logger
 from src.redis_client import get_redis, k
+from src.routing import routing_table
 
 logger = setup_logger(__name__)
 
@@ -62,7 +63,10 @@ class AlephService:
 
             self.reasoning_models = new_reasoning
             self.vision_models = new_vision
-            logger.debug(f"Loaded {len(self.reasoning_models)} reasoning models, {len(self.vision_models)} vision models")
+            routing_table.update_aleph(self.redirections, self.reasoning_models, self.vision_models)
+            logger.debug(
+                f"Loaded {len(self.reasoning_models)} reasoning models, {len(self.vision_models)} vision models"
+            )
 
             self._last_fetch_time = current_time
 
@@ -91,6 +95,7 @@ class AlephService:
                 self.redirections = dict(snap.get("redirections") or {})
                 self.reasoning_models = set(snap.get("reasoning_models") or [])
                 self.vision_models = set(snap.get("vision_models") or [])
+                routing_table.update_aleph(self.redirections, self.reasoning_models, self.vision_models)
         except Exception as e:
             logger.error(f"Failed to sync Aleph snapshot from Redis: {e}", exc_info=True)
 
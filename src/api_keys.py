@@ -10,14 +10,15 @@ from src.ssl_trust import SSL_CONTEXT
 
 logger = setup_logger(__name__)
 
-# Snapshot shape: {"keys": [...], "invalid_keys": {key: {"reason", "message"}}}
+# Snapshot shape: {"keys": [...], "invalid_keys": {key: {"reason", "message"}},
+#                  "limits": {key: {"rps", "tps", "concurrency"}}}
 REDIS_KEY = k("api_keys")
 # Transitional key from the list→dict shape migration; deleted on each refresh so no
 # stale copy lingers. Constant + delete can go once no deployment has ever written it.
 REDIS_KEY_V2 = k("api_keys_v2")
 
 
-async def get_active_keys() -> tuple[set, dict] | None:
+async def get_active_keys() -> tuple[set, dict, dict] | None:
     try:
         async with httpx.AsyncClient(timeout=120.0, verify=SSL_CONTEXT) as client:
             response = await client.get(
@@ -26,9 +27,14 @@ async def get_active_keys() -> tuple[set, dict] | None:
             )
             if response.status_code == 200:
                 data = response.json()
-                # invalid_keys entries ({reason, message}) are trusted server-side data,
-                # stored/served as-is; consumers read them with .get() fallbacks.
-                return set(data.get("keys") or []), dict(data.get("invalid_keys") or {})
+                # invalid_keys entries ({reason, message}) and limits ({rps, tps, concurrency})
+                # are trusted server-side data, stored/served as-is; consumers read them
+                # with .get() fallbacks.
+                return (
+                    set(data.get("keys") or []),
+                    dict(data.get("invalid_keys") or {}),
+                    dict(data.get("limits") or {}),
+                )
             logger.error(f"Error fetching accounts: {response.status_code}")
             return None
     except Exception as e:
@@ -45,11 +51,19 @@ def parse_snapshot(raw: str) -> tuple[set[str], dict[str, dict]]:
     return set(data), {}
 
 
+def parse_limits(raw: str) -> dict[str, dict]:
+    """Per-key rate limits from a snapshot; absent in legacy snapshots and older backends."""
+    data = json.loads(raw)
+    return dict(data.get("limits") or {}) if isinstance(data, dict) else {}
+
+
 class KeysManager:
     _instance = None
     keys: set[str] = set()
     # key -> {"reason": str, "message": str} for real-but-unusable keys (limits/credits/disabled)
     invalid_keys: dict[str, dict] = {}
+    # key -> {"rps": float, "tps": float, "concurrency": int}, each optional (see src/rate_limit.py)
+    limits: dict[str, dict] = {}
 
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
@@ -62,19 +76,23 @@ class KeysManager:
     def key_invalid_info(self, key: str) -> dict | None:
         return self.invalid_keys.get(key)
 
+    def key_limits(self, key: str) -> dict | None:
+        return self.limits.get(key)
+
     async def refresh_keys(self):
         """Leader-only: fetch authoritative keys and publish to Redis."""
         fetched = await get_active_keys()
         if fetched is not None:
-            new_keys, new_invalid = fetched
+            new_keys, new_invalid, new_limits = fetched
             self.keys = new_keys
             self.invalid_keys = new_invalid
+            self.limits = new_limits
             try:
                 redis = get_redis()
                 async with redis.pipeline(transaction=True) as pipe:
                     pipe.set(
                         REDIS_KEY,
-                        json.dumps({"keys": sorted(new_keys), "invalid_keys": new_invalid}),
+                        json.dumps({"keys": sorted(new_keys), "invalid_keys": new_invalid, "limits": new_limits}),
                     )
                     pipe.delete(REDIS_KEY_V2)
                     await pipe.execute()
@@ -94,6 +112,7 @@ class KeysManager:
             if raw is None:
                 return
             self.keys, self.invalid_keys = parse_snapshot(raw)
+            self.limits = parse_limits(raw)
         except Exception as e:
             logger.error(f"Failed to sync keys from Redis: {e}", exc_info=True)
 
@@ -0,0 +1,159 @@
+"""Raw ASGI fast path for inference requests, mounted in front of the FastAPI app.
+
+Every POST that doesn't belong to an explicit FastAPI route is an inference call for the
+catch-all proxy. Sending those through FastAPI costs routing, dependency injection, the
+middleware stack and a StreamingResponse per request, which dominates our per-request
+overhead. This app reads the body itself, builds the same RequestContext the FastAPI route
+would, and runs the shared `handle_proxy` core, so cookies, image stripping, thinking
+variants and x402 behave identically. Anything it can't serve as-is (no usable `model`,
+non-POST, explicit routes, lifespan) is handed to the wrapped FastAPI app unchanged.
+
+Large bodies (STREAM_REQUEST_MIN_BYTES) are scanned for their `model` field without being
+joined or parsed, then forwarded chunk by chunk; see src/request_stream.py.
+"""
+
+from fastapi import FastAPI, HTTPException
+from fastapi.routing import APIRoute
+from starlette.datastructures import MutableHeaders
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Match
+from starlette.types import Message, Receive, Scope, Send
+
+from src.config import config
+from src.proxy import handle_proxy, proxy_request, until_disconnect
+from src.request_context import RequestContext
+from src.request_stream import ClientDisconnected, StreamedBody
+
+
+async def _read_body(receive: Receive) -> bytes | None:
+    """Whole request body, or None if the client disconnected while sending it."""
+    chunks: list[bytes] = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+
+
+def _stream_body(scope: Scope) -> bool:
+    """Whether to stream this request's body: large or of unknown (chunked) length."""
+    threshold = config.STREAM_REQUEST_MIN_BYTES
+    if threshold <= 0:
+        return False
+    for name, value in scope["headers"]:
+        if name == b"content-length":
+            return value.isdigit() and int(value) >= threshold
+    return True
+
+
+async def _read_context(scope: Scope, receive: Receive) -> RequestContext | None:
+    """Context for the request, its body streamed or read whole; None if the client disconnected."""
+    full_path = scope["path"][1:]
+    if not _stream_body(scope):
+        body = await _read_body(receive)
+        return None if body is None else RequestContext(scope, full_path, body)
+    stream = StreamedBody(receive)
+    try:
+        model = await stream.scan("model")
+        if isinstance(model, str) and len(stream.chunks) > 1:
+            return RequestContext(scope, full_path, b"", stream=stream, scanned_model=model)
+        # Arrived in one piece (or no usable model): nothing to gain from streaming
+        return RequestContext(scope, full_path, await stream.read_all())
+    except ClientDisconnected:
+        return None
+
+
+def _replay(body: bytes, receive: Receive) -> Receive:
+    """A `receive` that yields the already-read body once, then defers to the real one."""
+    replayed = False
+
+    async def replay() -> Message:
+        nonlocal replayed
+        if not replayed:
+            replayed = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return replay
+
+
+def _cors_send(send: Send, origin: str, has_cookie: bool) -> Send:
+    """Same response headers as the app's CORSMiddleware(allow_origins=["*"]) for simple requests.
+
+    Preflight OPTIONS never reach the fast path, so only the simple-response branch is needed.
+    """
+
+    async def wrapped(message: Message) -> None:
+        if message["type"] == "http.response.start":
+            headers = MutableHeaders(scope=message)
+            if has_cookie:
+                headers["Access-Control-Allow-Origin"] = origin
+                headers.add_vary_header("Origin")
+            else:
+                headers["Access-Control-Allow-Origin"] = "*"
+        await send(message)
+
+    return wrapped
+
+
+class ProxyASGIApp:
+    def __init__(self, app: FastAPI) -> None:
+        self.app = app
+        # Resolved on first request: routers are included after this wrapper is built.
+        self._static_paths: frozenset[str] | None = None
+        self._dynamic_routes: list = []
+
+    def _load_routes(self) -> frozenset[str]:
+        static: set[str] = set()
+        for route in self.app.routes:
+            if isinstance(route, APIRoute) and route.endpoint is proxy_request:
+                continue
+            path = getattr(route, "path", None)
+            if path is None:
+                continue
+            if "{" in path:
+                self._dynamic_routes.append(route)
+            else:
+                static.add(path)
+        self._static_paths = frozenset(static)
+        return self._static_paths
+
+    def _is_app_route(self, scope: Scope) -> bool:
+        static = self._static_paths if self._static_paths is not None else self._load_routes()
+        if scope["path"] in static:
+            return True
+        return any(route.matches(scope)[0] != Match.NONE for route in self._dynamic_routes)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] != "POST" or self._is_app_route(scope):
+            await self.app(scope, receive, send)
+            return
+
+        ctx = await _read_context(scope, receive)
+        if ctx is None:
+            return
+        if ctx.model_name is None:
+            # Let FastAPI answer with its usual 422 body
+            await self.app(scope, _replay(ctx.raw_body, receive), send)
+            return
+
+        origin = ctx.headers.get("origin")
+        if origin is not None:
+            send = _cors_send(send, origin, "cookie" in ctx.headers)
+
+        response: Response | None
+        try:
+            if ctx.streaming:
+                # `receive` still feeds the upload; a disconnect surfaces as ClientDisconnected
+                response = await handle_proxy(ctx)
+            else:
+                response = await until_disconnect(handle_proxy(ctx), receive)
+        except ClientDisconnected:
+            return
+        except HTTPException as e:
+            response = JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+        if response is not None:
+            await response(scope, receive, send)
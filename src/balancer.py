@@ -0,0 +1,177 @@
+"""Upstream ordering strategies (BALANCER_STRATEGY).
+
+`least_loaded` sorts each health tier by inflight lease count. Every replica sees the same
+counts, so under a burst they all pick the same "least loaded" server at once.
+
+`p2c` (power of two choices) samples two healthy servers at random and puts the cheaper
+one first, so replicas spread out instead of herding. Cost is the inflight count weighted
+by the server's expected service time, learned from responses this replica relayed: an
+EWMA of time to first byte plus an EWMA of streamed tokens/s, so faster GPU boxes take a
+proportionally larger share. The rest of the healthy tier follows by cost as failover
+targets; capable and unknown tiers keep the least-loaded order.
+
+Independently of the strategy, prefix affinity (PREFIX_AFFINITY_MESSAGES > 0) sends
+requests sharing a conversation prefix to the same healthy server, so vLLM's prefix cache
+is reused without a stickiness cookie (see `affinity_server`).
+"""
+
+import bisect
+import hashlib
+import math
+import random
+from collections.abc import Callable
+from functools import lru_cache
+from typing import Any
+
+from src import fast_json
+from src.config import config
+from src.routing import CompiledRoute
+
+EWMA_ALPHA = 0.2
+# Completion length used to turn tokens/s into seconds, so TTFB and throughput add up.
+NOMINAL_TOKENS = 256
+
+
+def _ewma(prev: float | None, sample: float) -> float:
+    return sample if prev is None else prev + EWMA_ALPHA * (sample - prev)
+
+
+class UpstreamStats:
+    __slots__ = ("ttfb", "tokens_per_s")
+
+    def __init__(self) -> None:
+        self.ttfb: float | None = None  # seconds
+        self.tokens_per_s: float | None = None
+
+    def cost(self) -> float | None:
+        """Expected seconds to serve a nominal request, or None before the first sample."""
+        if self.ttfb is None and self.tokens_per_s is None:
+            return None
+        cost = self.ttfb or 0.0
+        if self.tokens_per_s:
+            cost += NOMINAL_TOKENS / self.tokens_per_s
+        return cost
+
+
+class LatencyTracker:
+    """Per-replica latency EWMAs per upstream, fed by the streaming relay.
+
+    Only streamed (SSE) responses are sampled: a buffered response's first byte arrives
+    after the whole generation, which says nothing about queueing on the box.
+    """
+
+    def __init__(self) -> None:
+        self._stats: dict[str, UpstreamStats] = {}
+
+    def _get(self, server: str) -> UpstreamStats:
+        stats = self._stats.get(server)
+        if stats is None:
+            stats = self._stats[server] = UpstreamStats()
+        return stats
+
+    def observe_ttfb(self, server: str, seconds: float) -> None:
+        stats = self._get(server)
+        stats.ttfb = _ewma(stats.ttfb, seconds)
+
+    def observe_throughput(self, server: str, tokens: int, seconds: float) -> None:
+        if tokens <= 0 or seconds <= 0:
+            return
+        stats = self._get(server)
+        stats.tokens_per_s = _ewma(stats.tokens_per_s, tokens / seconds)
+
+    def cost(self, server: str) -> float | None:
+        stats = self._stats.get(server)
+        return stats.cost() if stats is not None else None
+
+
+upstream_latency = LatencyTracker()
+
+
+def _least_loaded(route: CompiledRoute, loads: dict[str, int]) -> list[str]:
+    return route.servers_by_load(loads)
+
+
+def _power_of_two(route: CompiledRoute, loads: dict[str, int]) -> list[str]:
+    healthy = list(route.healthy)
+    costs = {s: upstream_latency.cost(s) for s in healthy}
+    known = sorted(c for c in costs.values() if c is not None)
+    # Servers without samples yet are priced at the median, so they get traffic to learn from.
+    default = known[len(known) // 2] if known else 1.0
+
+    def score(s: str) -> float:
+        cost = costs[s]
+        return (loads.get(s, 0) + 1) * (cost if cost is not None else default)
+
+    healthy.sort(key=score)
+    if len(healthy) > 2:
+        a, b = random.sample(healthy, 2)
+        first = a if score(a) <= score(b) else b
+        healthy.remove(first)
+        healthy.insert(0, first)
+    # Tiers are disjoint, so everything after the healthy tier is capable + unknown by load.
+    return [*healthy, *route.servers_by_load(loads)[len(route.healthy) :]]
+
+
+STRATEGIES: dict[str, Callable[[CompiledRoute, dict[str, int]], list[str]]] = {
+    "least_loaded": _least_loaded,
+    "p2c": _power_of_two,
+}
+
+
+def order_servers(route: CompiledRoute, loads: dict[str, int]) -> list[str]:
+    """Failover order for one request under the configured strategy (new list, safe to mutate)."""
+    return STRATEGIES.get(config.BALANCER_STRATEGY, _least_loaded)(route, loads)
+
+
+# Virtual nodes per server on the hash ring: enough to keep the key split even across a
+# handful of boxes, and to spread a removed box's keys over all the others.
+RING_REPLICAS = 64
+
+
+def _hash(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
+
+
+def prefix_key(model: str, body: dict[str, Any]) -> int | None:
+    """Hash of the request's stable prefix: the Anthropic `system` block plus the first
+    PREFIX_AFFINITY_MESSAGES messages (OpenAI system prompts are the first message).
+    None when affinity is off or the body has no messages (completions, embeddings)."""
+    n = config.PREFIX_AFFINITY_MESSAGES
+    messages = body.get("messages")
+    if n <= 0 or not isinstance(messages, list) or not messages:
+        return None
+    return _hash(fast_json.dumps([model, body.get("system"), messages[:n]]))
+
+
+@lru_cache(maxsize=256)
+def _ring(servers: tuple[str, ...]) -> tuple[list[int], list[str]]:
+    points = sorted((_hash(f"{server}#{i}".encode()), server) for server in servers for i in range(RING_REPLICAS))
+    return [p for p, _ in points], [s for _, s in points]
+
+
+def affinity_server(route: CompiledRoute, key: int, loads: dict[str, int]) -> str | None:
+    """Healthy server owning `key` under consistent hashing with bounded loads.
+
+    Walks the ring clockwise from the key and takes the first server whose inflight count
+    is under PREFIX_AFFINITY_LOAD_FACTOR x the tier's average (+1 for this request), so a
+    hot prefix spills over to its ring neighbour instead of piling onto one box. Returns
+    None (plain load-based order) when there is no healthy server under that bound.
+    """
+    servers = route.healthy
+    if not servers:
+        return None
+    points, owners = _ring(servers)
+    total = sum(loads.get(s, 0) for s in servers)
+    capacity = math.ceil(config.PREFIX_AFFINITY_LOAD_FACTOR * (total + 1) / len(servers))
+    start = bisect.bisect(points, key)
+    seen: set[str] = set()
+    for step in range(len(points)):
+        server = owners[(start + step) % len(points)]
+        if server in seen:
+            continue
+        if loads.get(server, 0) < capacity:
+            return server
+        seen.add(server)
+        if len(seen) == len(servers):
+            break
+    return None
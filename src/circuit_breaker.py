@@ -0,0 +1,133 @@
+"""Passive health: per-upstream circuit breakers fed by proxied request outcomes.
+
+Active health checks only run every HEALTH_CHECK_INTERVAL, so between sweeps a dead box
+keeps being tried first and every request pays its connect timeout or 5xx before failing
+over. Each breaker counts consecutive failures (connect errors, timeouts, 5xx) and, past
+CIRCUIT_FAILURE_THRESHOLD, opens for CIRCUIT_OPEN_SECONDS: open servers are moved to the
+end of the failover order (never dropped, so a fully open model still gets tried). Once
+the open period ends the breaker is half-open: one request on this replica probes the
+server, and its outcome closes or re-opens the breaker.
+
+Opening is shared across replicas through a Redis key per server holding the open-until
+time (wall clock), which every replica polls (`run_sync`); a successful probe deletes it.
+"""
+
+import asyncio
+import time
+
+from src.config import config
+from src.logger import setup_logger
+from src.redis_client import get_redis, k
+
+logger = setup_logger(__name__)
+
+
+def _key(server: str) -> str:
+    return k("breaker", server)
+
+
+class Breaker:
+    __slots__ = ("failures", "open_until", "probing")
+
+    def __init__(self) -> None:
+        self.failures = 0  # consecutive
+        self.open_until = 0.0  # time.time(); 0 = closed
+        self.probing = 0.0  # time.time() a half-open trial request started on this replica
+
+
+class CircuitBreakers:
+    def __init__(self) -> None:
+        self._breakers: dict[str, Breaker] = {}
+
+    def _get(self, server: str) -> Breaker:
+        breaker = self._breakers.get(server)
+        if breaker is None:
+            breaker = self._breakers[server] = Breaker()
+        return breaker
+
+    def is_open(self, server: str) -> bool:
+        """True while requests should avoid `server` (open, or half-open with its probe in flight)."""
+        breaker = self._breakers.get(server)
+        if breaker is None or not breaker.open_until:
+            return False
+        now = time.time()
+        # A probe that never reported back (cancelled, unexpected error) stops blocking after a while
+        if breaker.probing and now - breaker.probing < config.CIRCUIT_OPEN_SECONDS:
+            return True
+        return now < breaker.open_until
+
+    def order(self, servers: list[str]) -> list[str]:
+        """Stable partition: servers with an open breaker go last."""
+        if not self._breakers:
+            return servers
+        open_ = [s for s in servers if self.is_open(s)]
+        if not open_:
+            return servers
+        return [s for s in servers if s not in open_] + open_
+
+    def on_attempt(self, server: str) -> None:
+        """A request is about to go to `server`; if its breaker is half-open, it's the probe."""
+        breaker = self._breakers.get(server)
+        if breaker is not None and breaker.open_until and not self.is_open(server):
+            breaker.probing = time.time()
+
+    async def record_success(self, server: str) -> None:
+        breaker = self._breakers.get(server)
+        if breaker is None:
+            return
+        was_open = bool(breaker.open_until)
+        breaker.failures = 0
+        breaker.open_until = 0.0
+        breaker.probing = 0.0
+        if was_open:
+            logger.info(f"Circuit closed for {server}")
+            try:
+                await get_redis().delete(_key(server))
+            except Exception as e:
+                logger.error(f"Failed to clear circuit state for {server}: {e}", exc_info=True)
+
+    async def record_failure(self, server: str) -> None:
+        if config.CIRCUIT_FAILURE_THRESHOLD <= 0:
+            return
+        breaker = self._get(server)
+        breaker.failures += 1
+        # Any failure while open or half-open (the probe, or a last-resort try) re-opens it
+        if not breaker.open_until and breaker.failures < config.CIRCUIT_FAILURE_THRESHOLD:
+            return
+        breaker.probing = 0.0
+        breaker.open_until = time.time() + config.CIRCUIT_OPEN_SECONDS
+        logger.warning(f"Circuit open for {server} after {breaker.failures} consecutive failures")
+        try:
+            await get_redis().set(_key(server), str(breaker.open_until), ex=config.CIRCUIT_OPEN_SECONDS)
+        except Exception as e:
+            logger.error(f"Failed to publish circuit state for {server}: {e}", exc_info=True)
+
+    async def sync_from_redis(self, servers: list[str]) -> None:
+        """Adopt breakers opened by other replicas."""
+        if not servers:
+            return
+        try:
+            values = await get_redis().mget([_key(s) for s in servers])
+        except Exception as e:
+            logger.error(f"Failed to sync circuit state from Redis: {e}", exc_info=True)
+            return
+        for server, value in zip(servers, values):
+            if value is None:
+                continue
+            open_until = float(value)
+            breaker = self._get(server)
+            if open_until > breaker.open_until:
+                breaker.open_until = open_until
+                breaker.probing = 0.0
+
+
+circuit_breakers = CircuitBreakers()
+
+
+async def run_sync() -> None:
+    """Background task: pull breaker state from Redis every CIRCUIT_SYNC_INTERVAL_MS."""
+    interval = config.CIRCUIT_SYNC_INTERVAL_MS / 1000
+    while True:
+        await asyncio.sleep(interval)
+        servers = list(dict.fromkeys(u for urls in config.MODELS.values() for u in urls))
+        await circuit_breakers.sync_from_redis(servers)
@@ -0,0 +1,106 @@
+"""Single-flight coalescing of identical deterministic requests (COALESCE_REQUESTS).
+
+Retry storms and fan-out clients send the same embedding input or the same greedy
+completion several times at once, and each copy costs a full GPU request. While one such
+request is in flight, identical ones (same caller, model, path and canonical body) wait
+for it instead of going upstream, and every waiter gets a copy of its buffered response.
+
+Only non-streaming requests whose answer doesn't depend on sampling are coalesced:
+embeddings, and completions with `temperature: 0` or a fixed `seed`. The caller's API key
+is part of the key, so responses are never shared across tenants, and so is the
+Accept-Encoding sent upstream: the buffered body keeps the leader's Content-Encoding, so
+only a request that accepts the same encodings may be handed it.
+"""
+
+import asyncio
+import hashlib
+from collections.abc import Awaitable, Callable
+
+from fastapi import Response
+
+from src import fast_json
+from src.config import config
+from src.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Framing headers are recomputed for the buffered body; the stickiness cookie only goes
+# to the request that actually picked the server.
+_FRAMING_HEADERS = frozenset({"content-length", "transfer-encoding"})
+_LEADER_ONLY_HEADERS = frozenset({"set-cookie"})
+
+
+def coalesce_key(
+    token: str, model: str, path: str, body: dict | None, accept_encoding: str = "identity"
+) -> str | None:
+    """Single-flight key for a request, or None when it must not be coalesced.
+    `accept_encoding` is the Accept-Encoding header the request goes upstream with."""
+    if not config.COALESCE_REQUESTS or body is None or body.get("stream") is True:
+        return None
+    if not path.endswith("embeddings"):
+        temperature = body.get("temperature")
+        seeded = isinstance(body.get("seed"), int) and not isinstance(body.get("seed"), bool)
+        if not (seeded or (isinstance(temperature, (int, float)) and temperature == 0)):
+            return None
+    digest = hashlib.blake2b(digest_size=16)
+    encoding = ",".join(sorted(e.strip() for e in accept_encoding.lower().split(",")))
+    for part in (token.encode(), model.encode(), path.encode(), encoding.encode(), fast_json.dumps_sorted(body)):
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class BufferedResponse:
+    """An upstream reply read in full, replayable to any number of waiters."""
+
+    __slots__ = ("status_code", "headers", "body")
+
+    def __init__(self, status_code: int, headers: dict[str, str], body: bytes) -> None:
+        self.status_code = status_code
+        self.headers = {k: v for k, v in headers.items() if k.lower() not in _FRAMING_HEADERS}
+        self.body = body
+
+    def response(self, leader: bool = True) -> Response:
+        headers = self.headers
+        if not leader:
+            headers = {k: v for k, v in headers.items() if k.lower() not in _LEADER_ONLY_HEADERS}
+        return Response(content=self.body, status_code=self.status_code, headers=headers)
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        # None result: the leader gave up (client went away); waiters retry on their own
+        self._inflight: dict[str, asyncio.Future[BufferedResponse | None]] = {}
+        self.coalesced = 0
+
+    async def run(self, key: str, fetch: Callable[[], Awaitable[BufferedResponse]]) -> Response:
+        """Return `fetch()`'s response, or a copy of the one already being fetched for `key`."""
+        while (pending := self._inflight.get(key)) is not None:
+            self.coalesced += 1
+            logger.debug(f"Coalescing onto in-flight request {key[:12]}")
+            result = await asyncio.shield(pending)
+            if result is not None:
+                return result.response(leader=False)
+
+        future: asyncio.Future[BufferedResponse | None] = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await fetch()
+        except asyncio.CancelledError:
+            future.set_result(None)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # retrieved here: waiters re-raise it, none is fine too
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self._inflight[key]
+        return result.response()
+
+    def stats(self) -> dict[str, int]:
+        return {"inflight": len(self._inflight), "coalesced": self.coalesced}
+
+
+single_flight = SingleFlight()
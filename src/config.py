@@ -22,6 +22,41 @@ class _Config:
     ALEPH_SENDER_PRIVATE_KEY: str
     REDIS_URL: str
     SEARCH_SERVICE_URL: str
+    LOAD_FLUSH_INTERVAL_MS: int
+    LOAD_SNAPSHOT_INTERVAL_MS: int
+    BALANCER_STRATEGY: str
+    PREFIX_AFFINITY_MESSAGES: int
+    PREFIX_AFFINITY_LOAD_FACTOR: float
+    CIRCUIT_FAILURE_THRESHOLD: int
+    CIRCUIT_OPEN_SECONDS: int
+    CIRCUIT_SYNC_INTERVAL_MS: int
+    HEDGE_MODELS: set[str]
+    HEDGE_BUDGET_PERCENT: float
+    STREAM_REQUEST_MIN_BYTES: int
+    UPSTREAM_MAX_CONCURRENCY: int
+    ADMISSION_QUEUE_SIZE: int
+    ADMISSION_TIMEOUT_SECONDS: float
+    RATE_LIMIT_RPS: float
+    RATE_LIMIT_TPS: float
+    RATE_LIMIT_CONCURRENCY: int
+    RATE_LIMIT_SYNC_MS: int
+    COALESCE_REQUESTS: bool
+    EMBEDDINGS_CACHE_MB: int
+    EMBEDDINGS_CACHE_REDIS: bool
+    EMBEDDINGS_CACHE_TTL_SECONDS: int
+    EMBEDDINGS_BATCH_WINDOW_MS: float
+    EMBEDDINGS_BATCH_MAX_INPUTS: int
+    EMBEDDINGS_BATCH_MAX_TOKENS: int
+    EMBEDDINGS_TRANSCODE: bool
+    STALL_TIMEOUT_MULTIPLIER: float
+    STALL_TIMEOUT_MIN_SECONDS: float
+    UPSTREAM_POOL_CONNECTIONS: int
+    UPSTREAM_HTTP2: bool
+    UPSTREAM_PREWARM_CONNECTIONS: int
+    HEALTH_CHECK_CONCURRENCY: int
+    UPSTREAM_METRICS: bool
+    HEALTH_PROBE_MIN_SECONDS: float
+    HEALTH_PROBE_MAX_SECONDS: float
 
     LOG_LEVEL: int
 
@@ -43,6 +78,66 @@ class _Config:
         self.ALEPH_SENDER_PRIVATE_KEY = os.getenv("ALEPH_SENDER_PRIVATE_KEY", "")
         self.REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
         self.SEARCH_SERVICE_URL = os.getenv("SEARCH_SERVICE_URL", "https://search.libertai.io").rstrip("/")
+        # >0: keep inflight leases replica-local and flush them to Redis in one pipeline this often
+        self.LOAD_FLUSH_INTERVAL_MS = int(os.getenv("LOAD_FLUSH_INTERVAL_MS", "0"))
+        # >0: serve per-request loads from a replica-wide snapshot refreshed this often
+        self.LOAD_SNAPSHOT_INTERVAL_MS = int(os.getenv("LOAD_SNAPSHOT_INTERVAL_MS", "0"))
+        # How to order a model's servers: "least_loaded" or "p2c" (see src/balancer.py)
+        self.BALANCER_STRATEGY = os.getenv("BALANCER_STRATEGY", "least_loaded").lower()
+        # >0: route cookie-less requests by a hash of their system prompt + first N messages
+        self.PREFIX_AFFINITY_MESSAGES = int(os.getenv("PREFIX_AFFINITY_MESSAGES", "0"))
+        # Spill a prefix to the next server once its target exceeds this x the average load
+        self.PREFIX_AFFINITY_LOAD_FACTOR = float(os.getenv("PREFIX_AFFINITY_LOAD_FACTOR", "1.25"))
+        # Open a server's circuit after N consecutive proxy failures (0 = disabled) for this long
+        self.CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+        self.CIRCUIT_OPEN_SECONDS = int(os.getenv("CIRCUIT_OPEN_SECONDS", "15"))
+        # How often each replica picks up circuits opened by other replicas
+        self.CIRCUIT_SYNC_INTERVAL_MS = int(os.getenv("CIRCUIT_SYNC_INTERVAL_MS", "1000"))
+        # Models whose non-streaming calls are hedged on a second server past their p95 latency
+        self.HEDGE_MODELS = {m.strip().lower() for m in os.getenv("HEDGE_MODELS", "").split(",") if m.strip()}
+        # Hedges may add at most this percentage of extra upstream requests
+        self.HEDGE_BUDGET_PERCENT = float(os.getenv("HEDGE_BUDGET_PERCENT", "5"))
+        # >0: stream request bodies of at least this size (or chunked) upstream instead of buffering
+        self.STREAM_REQUEST_MIN_BYTES = int(os.getenv("STREAM_REQUEST_MIN_BYTES", "0"))
+        # >0: queue requests once every server of a model has this many inflight (vLLM max_num_seqs)
+        self.UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "0"))
+        self.ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "200"))
+        self.ADMISSION_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_TIMEOUT_SECONDS", "30"))
+        # Default per-key / per-payer limits (0 = unlimited); backend per-key `limits` override them
+        self.RATE_LIMIT_RPS = float(os.getenv("RATE_LIMIT_RPS", "0"))
+        self.RATE_LIMIT_TPS = float(os.getenv("RATE_LIMIT_TPS", "0"))
+        self.RATE_LIMIT_CONCURRENCY = int(os.getenv("RATE_LIMIT_CONCURRENCY", "0"))
+        # How often each replica reconciles its rate-limit buckets with Redis
+        self.RATE_LIMIT_SYNC_MS = int(os.getenv("RATE_LIMIT_SYNC_MS", "200"))
+        # Identical deterministic non-streaming requests from one key share a single upstream call
+        self.COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "false").lower() in ("1", "true", "yes")
+        # Per-input embeddings cache: in-process LRU size (0 = off), shared Redis tier, entry lifetime
+        self.EMBEDDINGS_CACHE_MB = int(os.getenv("EMBEDDINGS_CACHE_MB", "0"))
+        self.EMBEDDINGS_CACHE_REDIS = os.getenv("EMBEDDINGS_CACHE_REDIS", "false").lower() in ("1", "true", "yes")
+        self.EMBEDDINGS_CACHE_TTL_SECONDS = int(os.getenv("EMBEDDINGS_CACHE_TTL_SECONDS", "86400"))
+        # >0: merge small embeddings requests from one key arriving within this window into one call
+        self.EMBEDDINGS_BATCH_WINDOW_MS = float(os.getenv("EMBEDDINGS_BATCH_WINDOW_MS", "0"))
+        self.EMBEDDINGS_BATCH_MAX_INPUTS = int(os.getenv("EMBEDDINGS_BATCH_MAX_INPUTS", "64"))
+        self.EMBEDDINGS_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDINGS_BATCH_MAX_TOKENS", "16384"))
+        # Apply embeddings `dimensions` / `encoding_format=base64` in the proxy, fetching base64 upstream
+        self.EMBEDDINGS_TRANSCODE = os.getenv("EMBEDDINGS_TRANSCODE", "false").lower() in ("1", "true", "yes")
+        # >0: a response is stalled past this x its model's p99 first-byte delay / chunk gap (src/stall.py)
+        self.STALL_TIMEOUT_MULTIPLIER = float(os.getenv("STALL_TIMEOUT_MULTIPLIER", "0"))
+        self.STALL_TIMEOUT_MIN_SECONDS = float(os.getenv("STALL_TIMEOUT_MIN_SECONDS", "15"))
+        # Connections per upstream pool (0 = UPSTREAM_MAX_CONCURRENCY + headroom, or 100 if unset)
+        self.UPSTREAM_POOL_CONNECTIONS = int(os.getenv("UPSTREAM_POOL_CONNECTIONS", "0"))
+        # Negotiate HTTP/2 with TLS upstreams that support it (needs the h2 package)
+        self.UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() in ("1", "true", "yes")
+        # Connections opened to each upstream at startup
+        self.UPSTREAM_PREWARM_CONNECTIONS = int(os.getenv("UPSTREAM_PREWARM_CONNECTIONS", "0"))
+        # Servers probed at once during a health sweep (also the probe client's connection pool size)
+        self.HEALTH_CHECK_CONCURRENCY = int(os.getenv("HEALTH_CHECK_CONCURRENCY", "32"))
+        # Scrape upstream /metrics (vLLM queue depth, KV cache) during health sweeps and route on it
+        self.UPSTREAM_METRICS = os.getenv("UPSTREAM_METRICS", "false").lower() in ("1", "true", "yes")
+        # >0: probe each server on its own schedule, from this interval after a change backing off
+        # to the max, instead of sweeping everything every HEALTH_CHECK_INTERVAL
+        self.HEALTH_PROBE_MIN_SECONDS = float(os.getenv("HEALTH_PROBE_MIN_SECONDS", "0"))
+        self.HEALTH_PROBE_MAX_SECONDS = float(os.getenv("HEALTH_PROBE_MAX_SECONDS", "30"))
 
         # Load models configuration from environment variable or file
         models_config = os.getenv("MODELS_CONFIG")
@@ -0,0 +1,179 @@
+"""Micro-batching of small embeddings requests (EMBEDDINGS_BATCH_WINDOW_MS > 0).
+
+Clients that embed one string per request pay a full round trip each and hand vLLM a
+batch of one, while embedding throughput grows with batch size. Requests from the same
+API key with the same parameters that arrive within the window are merged: one upstream
+call carries every caller's inputs as a single `input` array, and its `data` is split
+back out by position. The batch is sent early once it reaches EMBEDDINGS_BATCH_MAX_INPUTS
+inputs or about EMBEDDINGS_BATCH_MAX_TOKENS tokens.
+
+The upstream reports one `usage` for the whole batch; each caller gets a share of it
+proportional to the size of its inputs.
+"""
+
+import asyncio
+import hashlib
+from collections.abc import Awaitable, Callable
+from http import HTTPStatus
+from typing import Any
+
+from src import fast_json
+from src.coalescing import BufferedResponse
+from src.config import config
+from src.embeddings_cache import input_texts
+from src.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+Send = Callable[[dict[str, Any]], Awaitable[BufferedResponse]]
+
+
+def _estimate_tokens(texts: list[str]) -> int:
+    return sum(len(t) for t in texts) // 4 + 1
+
+
+class _Caller:
+    __slots__ = ("texts", "future")
+
+    def __init__(self, texts: list[str]) -> None:
+        self.texts = texts
+        self.future: asyncio.Future[BufferedResponse] = asyncio.get_running_loop().create_future()
+
+
+class _Batch:
+    __slots__ = ("body", "send", "callers", "inputs", "tokens", "timer")
+
+    def __init__(self, body: dict[str, Any], send: Send) -> None:
+        self.body = body  # the first caller's body: every member shares its parameters
+        self.send = send  # the first caller's upstream path (its headers and lease accounting)
+        self.callers: list[_Caller] = []
+        self.inputs = 0
+        self.tokens = 0
+        self.timer: asyncio.TimerHandle | None = None
+
+
+class EmbeddingBatcher:
+    def __init__(self) -> None:
+        self._open: dict[str, _Batch] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self.batches = 0
+        self.batched_requests = 0
+
+    def applies(self, path: str, body: dict[str, Any] | None) -> bool:
+        if config.EMBEDDINGS_BATCH_WINDOW_MS <= 0 or body is None or not path.endswith("embeddings"):
+            return False
+        texts = input_texts(body)
+        return texts is not None and len(texts) < config.EMBEDDINGS_BATCH_MAX_INPUTS
+
+    @staticmethod
+    def _key(token: str, path: str, body: dict[str, Any]) -> str:
+        params = {name: value for name, value in body.items() if name != "input"}
+        digest = hashlib.blake2b(digest_size=16)
+        for part in (token.encode(), path.encode(), fast_json.dumps_sorted(params)):
+            digest.update(part)
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    async def submit(self, token: str, path: str, body: dict[str, Any], send: Send) -> BufferedResponse:
+        """Embed `body`'s inputs as part of a batch; `send` is used if this request opens it."""
+        texts = input_texts(body) or []
+        tokens = _estimate_tokens(texts)
+        key = self._key(token, path, body)
+        batch = self._open.get(key)
+        if batch is not None and (
+            batch.inputs + len(texts) > config.EMBEDDINGS_BATCH_MAX_INPUTS
+            or batch.tokens + tokens > config.EMBEDDINGS_BATCH_MAX_TOKENS
+        ):
+            self._flush(key)
+            batch = None
+        if batch is None:
+            batch = self._open[key] = _Batch(body, send)
+            batch.timer = asyncio.get_running_loop().call_later(
+                config.EMBEDDINGS_BATCH_WINDOW_MS / 1000, self._flush, key
+            )
+        caller = _Caller(texts)
+        batch.callers.append(caller)
+        batch.inputs += len(texts)
+        batch.tokens += tokens
+        if batch.inputs >= config.EMBEDDINGS_BATCH_MAX_INPUTS or batch.tokens >= config.EMBEDDINGS_BATCH_MAX_TOKENS:
+            self._flush(key)
+        # Shielded: a caller going away must not cancel the batch the others are waiting on
+        return await asyncio.shield(caller.future)
+
+    def _flush(self, key: str) -> None:
+        batch = self._open.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: _Batch) -> None:
+        self.batches += 1
+        self.batched_requests += len(batch.callers)
+        try:
+            if len(batch.callers) == 1:
+                batch.callers[0].future.set_result(await batch.send(batch.body))
+                return
+            combined = [text for caller in batch.callers for text in caller.texts]
+            result = await batch.send(dict(batch.body, input=combined))
+            for caller, response in zip(batch.callers, self._split(batch, result)):
+                caller.future.set_result(response)
+        except asyncio.CancelledError:
+            for caller in batch.callers:
+                caller.future.cancel()
+            raise
+        except Exception as e:
+            for caller in batch.callers:
+                if not caller.future.done():
+                    caller.future.set_exception(e)
+                    caller.future.exception()  # may have no waiter left; don't warn about it
+
+    @staticmethod
+    def _split(batch: _Batch, result: BufferedResponse) -> list[BufferedResponse]:
+        """One response per caller, out of the batch's response (errors go to everyone)."""
+        if result.status_code != HTTPStatus.OK:
+            return [result] * len(batch.callers)
+        try:
+            doc = fast_json.loads(result.body)
+            items = sorted(doc["data"], key=lambda item: item["index"])
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Unexpected embeddings batch response: {e}")
+            items = None
+        if items is None or len(items) != batch.inputs:
+            error = b'{"error":{"message":"Invalid embeddings response from upstream","type":"server_error"}}'
+            return [BufferedResponse(HTTPStatus.BAD_GATEWAY, {"content-type": "application/json"}, error)] * len(
+                batch.callers
+            )
+
+        usage = doc.get("usage") if isinstance(doc.get("usage"), dict) else {}
+        total_size = sum(len(t) for caller in batch.callers for t in caller.texts) or 1
+        headers = {k: v for k, v in result.headers.items() if k.lower() != "set-cookie"}
+        responses = []
+        offset = 0
+        for caller in batch.callers:
+            share = sum(len(t) for t in caller.texts) / total_size
+            data = [
+                dict(item, index=i) for i, item in enumerate(items[offset : offset + len(caller.texts)])
+            ]
+            offset += len(caller.texts)
+            caller_usage = {
+                name: round(value * share) if isinstance(value, (int, float)) else value
+                for name, value in usage.items()
+            }
+            doc_out = dict(doc, data=data, usage=caller_usage)
+            responses.append(BufferedResponse(HTTPStatus.OK, headers, fast_json.dumps(doc_out)))
+        return responses
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "open": len(self._open),
+            "batches": self.batches,
+            "batched_requests": self.batched_requests,
+            "avg_batch_size": round(self.batched_requests / self.batches, 2) if self.batches else 0.0,
+        }
+
+
+embedding_batcher = EmbeddingBatcher()
@@ -0,0 +1,199 @@
+"""Per-item cache for embeddings requests (EMBEDDINGS_CACHE_MB / EMBEDDINGS_CACHE_REDIS).
+
+Embeddings are deterministic and RAG pipelines re-embed the same chunks over and over.
+Each input string's vector is cached under (API key, model, encoding_format, dimensions,
+text) in two tiers: an in-process LRU bounded in bytes, then a Redis tier shared by all replicas.
+For a batch, hits are served from the cache and only the misses go upstream, as a smaller
+(deduplicated) batch whose results are merged back in the original order. A batch that
+is all hits never leaves the replica.
+
+Vectors are kept as the JSON bytes the upstream returned them in, and the merged response
+is assembled from those bytes, so cached vectors are never re-parsed.
+
+Entries are per API key: a tenant only ever gets back vectors it embedded itself, and
+can't probe whether anyone else embedded a text. The proxy only consults the cache for
+keys it knows are valid, since an unknown key is otherwise only checked by the upstream.
+Billing happens upstream, on what it embeds, so cache hits are free: `usage` in a merged
+response only counts the tokens that were actually forwarded.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from http import HTTPStatus
+from typing import Any
+
+from fastapi import HTTPException, Response
+
+from src import fast_json
+from src.coalescing import BufferedResponse
+from src.config import config
+from src.logger import setup_logger
+from src.redis_client import get_redis, k
+
+logger = setup_logger(__name__)
+
+
+def input_texts(body: dict[str, Any]) -> list[str] | None:
+    """The request's input strings; None for token-id inputs, which aren't cached."""
+    inputs = body.get("input")
+    if isinstance(inputs, str):
+        return [inputs]
+    if isinstance(inputs, list) and inputs and all(isinstance(i, str) for i in inputs):
+        return inputs
+    return None
+
+
+class EmbeddingsCache:
+    def __init__(self) -> None:
+        self._lru: OrderedDict[str, tuple[bytes, float]] = OrderedDict()  # key -> (vector JSON, expiry)
+        self._bytes = 0
+        self.hits_local = 0
+        self.hits_redis = 0
+        self.misses = 0
+
+    def enabled(self) -> bool:
+        return config.EMBEDDINGS_CACHE_MB > 0 or config.EMBEDDINGS_CACHE_REDIS
+
+    def applies(self, path: str, body: dict[str, Any] | None) -> bool:
+        return self.enabled() and path.endswith("embeddings") and body is not None and input_texts(body) is not None
+
+    @staticmethod
+    def _key(tenant: str, model: str, body: dict[str, Any], text: str) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        encoding_format, dimensions = str(body.get("encoding_format") or "float"), str(body.get("dimensions") or "")
+        for part in (tenant, model, encoding_format, dimensions, text):
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return k("embcache", digest.hexdigest())
+
+    def _get_local(self, key: str, now: float) -> bytes | None:
+        entry = self._lru.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            self._evict(key)
+            return None
+        self._lru.move_to_end(key)
+        return entry[0]
+
+    def _put_local(self, key: str, value: bytes, now: float) -> None:
+        limit = config.EMBEDDINGS_CACHE_MB * 1024 * 1024
+        if limit <= 0 or len(value) > limit:
+            return
+        if key in self._lru:
+            self._evict(key)
+        self._lru[key] = (value, now + config.EMBEDDINGS_CACHE_TTL_SECONDS)
+        self._bytes += len(key) + len(value)
+        while self._bytes > limit:
+            self._evict(next(iter(self._lru)))
+
+    def _evict(self, key: str) -> None:
+        value, _ = self._lru.pop(key)
+        self._bytes -= len(key) + len(value)
+
+    async def _get_shared(self, keys: list[str]) -> list[bytes | None]:
+        if not config.EMBEDDINGS_CACHE_REDIS or not keys:
+            return [None] * len(keys)
+        try:
+            values = await get_redis().mget(keys)
+        except Exception as e:
+            logger.error(f"Failed to read embeddings cache from Redis: {e}", exc_info=True)
+            return [None] * len(keys)
+        return [v.encode() if isinstance(v, str) else v for v in values]
+
+    async def _put_shared(self, entries: dict[str, bytes]) -> None:
+        if not config.EMBEDDINGS_CACHE_REDIS or not entries:
+            return
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                for key, value in entries.items():
+                    pipe.set(key, value, ex=config.EMBEDDINGS_CACHE_TTL_SECONDS)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Failed to write embeddings cache to Redis: {e}", exc_info=True)
+
+    async def serve(
+        self,
+        tenant: str,
+        model: str,
+        body: dict[str, Any],
+        forward: Callable[[dict[str, Any]], Awaitable[BufferedResponse]],
+    ) -> Response:
+        """Answer an embeddings request from `tenant`'s (API key's) cache entries, sending
+        only the misses upstream through `forward(partial_body)`."""
+        texts = input_texts(body)
+        if texts is None:
+            return (await forward(body)).response()
+        now = time.monotonic()
+        keys = [self._key(tenant, model, body, text) for text in texts]
+        vectors: list[bytes | None] = [self._get_local(key, now) for key in keys]
+        self.hits_local += sum(v is not None for v in vectors)
+
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        shared = await self._get_shared([keys[i] for i in missing])
+        for i, value in zip(missing, shared):
+            if value is not None:
+                vectors[i] = value
+                self._put_local(keys[i], value, now)
+                self.hits_redis += 1
+
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        self.misses += len(missing)
+        usage: Any = {"prompt_tokens": 0, "total_tokens": 0}
+        response_model: Any = body.get("model", model)
+        headers = {"content-type": "application/json"}
+        if missing:
+            # Duplicates within the batch are only embedded once
+            unique = list(dict.fromkeys(texts[i] for i in missing))
+            partial = dict(body, input=unique if isinstance(body["input"], list) else unique[0])
+            result = await forward(partial)
+            if result.status_code != HTTPStatus.OK:
+                return result.response()
+            try:
+                doc = fast_json.loads(result.body)
+                items = sorted(doc["data"], key=lambda item: item["index"])
+                fresh = [fast_json.dumps(item["embedding"]) for item in items]
+                if len(fresh) != len(unique):
+                    raise ValueError(f"{len(fresh)} embeddings for {len(unique)} inputs")
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f"Unexpected embeddings response for {model}: {e}")
+                raise HTTPException(
+                    status_code=HTTPStatus.BAD_GATEWAY, detail="Invalid embeddings response from upstream"
+                )
+            by_text = dict(zip(unique, fresh))
+            stored: dict[str, bytes] = {}
+            for i in missing:
+                vectors[i] = stored[keys[i]] = by_text[texts[i]]
+                self._put_local(keys[i], by_text[texts[i]], now)
+            await self._put_shared(stored)
+            usage = doc.get("usage", usage)
+            response_model = doc.get("model", response_model)
+            headers = result.headers
+
+        data = b",".join(
+            b'{"index":%d,"object":"embedding","embedding":%s}' % (i, vector)
+            for i, vector in enumerate(vectors)
+            if vector is not None
+        )
+        content = b'{"object":"list","data":[%s],"model":%s,"usage":%s}' % (
+            data,
+            fast_json.dumps(response_model),
+            fast_json.dumps(usage),
+        )
+        return BufferedResponse(HTTPStatus.OK, headers, content).response()
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits_local + self.hits_redis + self.misses
+        return {
+            "entries": len(self._lru),
+            "bytes": self._bytes,
+            "hits_local": self.hits_local,
+            "hits_redis": self.hits_redis,
+            "misses": self.misses,
+            "hit_rate": round((self.hits_local + self.hits_redis) / lookups, 4) if lookups else 0.0,
+        }
+
+
+embeddings_cache = EmbeddingsCache()
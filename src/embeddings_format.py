@@ -0,0 +1,92 @@
+"""Proxy-side `dimensions` and `encoding_format=base64` for embeddings (EMBEDDINGS_TRANSCODE).
+
+Not every upstream supports OpenAI's `dimensions` (Matryoshka truncation) or base64
+output, and float JSON is several times larger and slower to parse than base64 float32.
+When a client asks for either, the proxy strips `dimensions`, requests base64 from the
+upstream, and converts the vectors itself: truncate, L2-renormalize, then encode as the
+client asked. Upstreams that ignore `encoding_format` and answer with float lists work too.
+
+The conversion is one batched NumPy operation over the whole response: decoding,
+truncation, normalization and re-encoding never loop over floats in Python.
+"""
+
+import base64
+from typing import Any
+
+import numpy as np
+
+from src import fast_json
+from src.coalescing import BufferedResponse
+from src.config import config
+from src.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+def _requested_dimensions(body: dict[str, Any]) -> int | None:
+    dimensions = body.get("dimensions")
+    if isinstance(dimensions, int) and not isinstance(dimensions, bool) and dimensions > 0:
+        return dimensions
+    return None
+
+
+def upstream_body(body: dict[str, Any]) -> dict[str, Any] | None:
+    """The body to send upstream when the proxy handles the output format, else None."""
+    if not config.EMBEDDINGS_TRANSCODE:
+        return None
+    if _requested_dimensions(body) is None and body.get("encoding_format") != "base64":
+        return None
+    rewritten = {name: value for name, value in body.items() if name != "dimensions"}
+    rewritten["encoding_format"] = "base64"
+    return rewritten
+
+
+def _decode(embedding: Any) -> list[float] | bytes:
+    """float32 little-endian bytes for a base64 vector, the list itself otherwise."""
+    if isinstance(embedding, str):
+        return base64.b64decode(embedding)
+    if isinstance(embedding, list):
+        return embedding
+    raise TypeError(f"unexpected embedding type {type(embedding).__name__}")
+
+
+def _convert(vectors: list[list[float] | bytes], dimensions: int | None, as_base64: bool) -> list[Any]:
+    rows = [
+        np.frombuffer(v, dtype="<f4") if isinstance(v, bytes) else np.asarray(v, dtype=np.float32) for v in vectors
+    ]
+    if len({len(r) for r in rows}) == 1:
+        matrices = [np.vstack(rows)]  # the common case: one matrix for the whole response
+    else:
+        matrices = [r[np.newaxis, :] for r in rows]
+    out: list[Any] = []
+    for matrix in matrices:
+        if dimensions is not None and dimensions < matrix.shape[1]:
+            matrix = matrix[:, :dimensions]
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix = matrix / np.where(norms == 0, 1, norms)
+        if as_base64:
+            matrix = matrix.astype("<f4", copy=False)
+            out += [base64.b64encode(row.tobytes()).decode() for row in matrix]
+        else:
+            out += matrix.astype(np.float32, copy=False).tolist()
+    return out
+
+
+def transcode(result: BufferedResponse, body: dict[str, Any]) -> BufferedResponse:
+    """Convert an upstream embeddings response to the format the client's `body` asked for."""
+    if result.status_code != 200:
+        return result
+    dimensions, as_base64 = _requested_dimensions(body), body.get("encoding_format") == "base64"
+    try:
+        doc = fast_json.loads(result.body)
+        items = doc["data"]
+        if dimensions is None and as_base64 and all(isinstance(item["embedding"], str) for item in items):
+            return result  # already what the client asked for
+        vectors = [_decode(item["embedding"]) for item in items]
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error(f"Cannot transcode embeddings response: {e}")
+        return result
+    converted = _convert(vectors, dimensions, as_base64)
+    for item, embedding in zip(items, converted):
+        item["embedding"] = embedding
+    return BufferedResponse(result.status_code, result.headers, fast_json.dumps(doc))
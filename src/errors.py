@@ -1,3 +1,4 @@
+import math
 from http import HTTPStatus
 
 from fastapi.responses import JSONResponse
@@ -19,3 +20,12 @@ def invalid_key_response(info: dict) -> JSONResponse:
             }
         },
     )
+
+
+def rate_limit_response(message: str, retry_after: float) -> JSONResponse:
+    """OpenAI-shaped 429 with a Retry-After the OpenAI/Anthropic SDKs honour for backoff."""
+    return JSONResponse(
+        status_code=HTTPStatus.TOO_MANY_REQUESTS,
+        content={"error": {"message": message, "type": "rate_limit_error", "code": "rate_limit_exceeded"}},
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
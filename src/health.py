@@ -1,17 +1,35 @@
 import asyncio
 import json
+import random
+import time
+from collections.abc import Iterable
 from http import HTTPStatus
+from typing import Any, cast
 
 import httpx
 
 from src.config import config
+from src.leader import leader
 from src.logger import setup_logger
 from src.redis_client import get_redis, k
+from src.routing import routing_table
 from src.ssl_trust import SSL_CONTEXT
+from src.upstream_metrics import MetricsParser, UpstreamLoad
 
 logger = setup_logger(__name__)
 
 REDIS_KEY = k("health", "snapshot")
+PROBE_TIMEOUT = 30.0  # seconds
+
+# Adaptive probing (HEALTH_PROBE_MIN_SECONDS > 0): one hash field per server, written only
+# when that server's state changes, and a version counter followers poll to notice changes.
+SERVERS_KEY = k("health", "servers")
+VERSION_KEY = k("health", "version")
+POLL_INTERVAL = 0.5  # seconds between scheduler ticks / follower version checks
+JITTER = 0.2  # +-20% on every probe interval, so servers don't fall into lockstep
+# Servers that are down back off to at most this fraction of HEALTH_PROBE_MAX_SECONDS, so a
+# recovery is still noticed well before a stable server's next probe.
+DOWN_MAX_FRACTION = 0.25
 
 
 class ServerMetrics:
@@ -23,11 +41,16 @@ class ServerMetrics:
         requests_deferred: int = 0,
         is_healthy: bool = True,
         is_loaded: bool = False,
+        kv_cache_usage: float | None = None,
+        tokens_per_second: float | None = None,
     ):
         self.requests_processing = requests_processing
         self.requests_deferred = requests_deferred
         self.is_healthy = is_healthy
         self.is_loaded = is_loaded
+        # Only known when UPSTREAM_METRICS scraping is on and the box exposes them
+        self.kv_cache_usage = kv_cache_usage
+        self.tokens_per_second = tokens_per_second
 
     @property
     def load_score(self) -> int:
@@ -35,6 +58,44 @@ class ServerMetrics:
         return self.requests_processing + self.requests_deferred
 
 
+class _Schedule:
+    __slots__ = ("interval", "next_due")
+
+    def __init__(self, interval: float, next_due: float) -> None:
+        self.interval = interval
+        self.next_due = next_due
+
+
+def _jittered(interval: float) -> float:
+    return interval * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+def _status(results: dict[str, ServerMetrics]) -> dict[str, tuple[bool, bool]]:
+    return {model: (m.is_healthy, m.is_loaded) for model, m in results.items()}
+
+
+def _metrics_dict(m: ServerMetrics) -> dict[str, Any]:
+    return {
+        "requests_processing": m.requests_processing,
+        "requests_deferred": m.requests_deferred,
+        "is_healthy": m.is_healthy,
+        "is_loaded": m.is_loaded,
+        "kv_cache_usage": m.kv_cache_usage,
+        "tokens_per_second": m.tokens_per_second,
+    }
+
+
+def _metrics_from(m: dict[str, Any]) -> ServerMetrics:
+    return ServerMetrics(
+        requests_processing=m.get("requests_processing", 0),
+        requests_deferred=m.get("requests_deferred", 0),
+        is_healthy=m.get("is_healthy", False),
+        is_loaded=m.get("is_loaded", False),
+        kv_cache_usage=m.get("kv_cache_usage"),
+        tokens_per_second=m.get("tokens_per_second"),
+    )
+
+
 class ServerHealthMonitor:
     def __init__(self) -> None:
         """
@@ -52,6 +113,35 @@ class ServerHealthMonitor:
         # Map of URL to metrics
         self.server_metrics: dict[str, ServerMetrics] = {}
 
+        # One pooled client for every probe, so boxes keep a warm connection between sweeps
+        self._client: httpx.AsyncClient | None = None
+
+        # Per URL: last scraped generation token counter and when, to derive tokens/s
+        self._generation_tokens: dict[str, tuple[float, float]] = {}
+
+        # Latest probe results per server and model (leader), or as published (followers)
+        self._box_results: dict[str, dict[str, ServerMetrics]] = {}
+
+        # Adaptive probing state: per-server schedule and in-flight probes (leader), last
+        # record written per server (leader) and last version seen (followers)
+        self._schedule: dict[str, _Schedule] = {}
+        self._probing: set[str] = set()
+        self._probe_tasks: set[asyncio.Task] = set()
+        self._slots: asyncio.Semaphore | None = None
+        self._published: dict[str, str] = {}
+        self._version: str | None = None
+        self.probes = 0
+        self.transitions = 0
+
+        # Sweep timings (leader only; followers just read the snapshot)
+        self.sweeps = 0
+        self.last_sweep_seconds = 0.0
+        self.max_sweep_seconds = 0.0
+        self.last_sweep_probes = 0
+        self.last_sweep_failures = 0
+
+        routing_table.update_health(self.healthy_model_urls, self.capable_model_urls)
+
     def get_healthy_model_urls(self) -> dict[str, list[str]]:
         """Get a dictionary of healthy servers grouped by model."""
         return self.healthy_model_urls
@@ -94,6 +184,61 @@ class ServerHealthMonitor:
 
         return best_server
 
+    def routing_loads(self, servers: Iterable[str], loads: dict[str, int]) -> dict[str, int]:
+        """Our lease counts, raised to a server's scraped running + waiting requests where
+        that is higher: leases can't see traffic reaching the box from outside this proxy."""
+        if not config.UPSTREAM_METRICS or not self.server_metrics:
+            return loads
+        out = dict(loads)
+        for url in servers:
+            metrics = self.server_metrics.get(url)
+            if metrics is not None and metrics.load_score > out.get(url, 0):
+                out[url] = metrics.load_score
+        return out
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            size = max(config.HEALTH_CHECK_CONCURRENCY, 1)
+            self._client = httpx.AsyncClient(
+                timeout=PROBE_TIMEOUT,
+                limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+                verify=SSL_CONTEXT,
+            )
+        return self._client
+
+    async def _probe(self, url: str, model: str) -> ServerMetrics:
+        response = await self._get_client().get(f"{url}/health/{model}")
+        if response.status_code == HTTPStatus.OK:
+            return ServerMetrics(is_healthy=True, is_loaded=True)
+        elif response.status_code == HTTPStatus.ACCEPTED:
+            return ServerMetrics(is_healthy=True, is_loaded=False)
+        else:
+            logger.warning(f"Health status error for {url}: {response.status_code}")
+            return ServerMetrics(is_healthy=False, is_loaded=False)
+
+    async def _scrape(self, url: str) -> UpstreamLoad | None:
+        """Queue depth and KV-cache usage from the server's Prometheus page, streamed line by line."""
+        parser = MetricsParser()
+        try:
+            async with self._get_client().stream("GET", f"{url}/metrics") as response:
+                if response.status_code != HTTPStatus.OK:
+                    logger.debug(f"No metrics from {url}: {response.status_code}")
+                    return None
+                async for line in response.aiter_lines():
+                    parser.feed(line)
+        except httpx.HTTPError as e:
+            logger.debug(f"Metrics scrape failed for {url}: {type(e).__name__}: {e}")
+            return None
+        load = parser.load
+        if load.tokens_per_second is None and load.generation_tokens is not None:
+            now = time.monotonic()
+            previous = self._generation_tokens.get(url)
+            self._generation_tokens[url] = (load.generation_tokens, now)
+            # A counter that went backwards means the server restarted: wait for the next scrape
+            if previous is not None and now > previous[1] and load.generation_tokens >= previous[0]:
+                load.tokens_per_second = (load.generation_tokens - previous[0]) / (now - previous[1])
+        return load
+
     async def check_server_metrics_async(self, url: str, model: str) -> ServerMetrics:
         """
         Asynchronously check server health via /health endpoint.
@@ -106,65 +251,221 @@ class ServerHealthMonitor:
             ServerMetrics object with health status and load information
         """
         try:
-            health_url = f"{url}/health/{model}"
-            async with httpx.AsyncClient(timeout=30.0, verify=SSL_CONTEXT) as client:
-                response = await client.get(health_url)
-                if response.status_code == HTTPStatus.OK:
-                    return ServerMetrics(is_healthy=True, is_loaded=True)
-                elif response.status_code == HTTPStatus.ACCEPTED:
-                    return ServerMetrics(is_healthy=True, is_loaded=False)
-                else:
-                    logger.warning(f"Health status error for {url}: {response.status_code}")
-                    return ServerMetrics(is_healthy=False, is_loaded=False)
+            return await self._probe(url, model)
         except (httpx.HTTPError, ValueError) as e:
             logger.warning(f"Health check error for {url}: {type(e).__name__}: {e or 'No error message'}")
             return ServerMetrics(is_healthy=False, is_loaded=False)
 
-    async def check_all_servers(self) -> None:
-        """Check health of all registered servers and update healthy/capable URLs per model."""
+    async def _check_box(self, url: str, models: list[str], slots: asyncio.Semaphore) -> dict[str, ServerMetrics]:
+        """Probe every model of one box in turn, over a single keep-alive connection."""
+        results: dict[str, ServerMetrics] = {}
+        async with slots:
+            for i, model in enumerate(models):
+                try:
+                    results[model] = await self._probe(url, model)
+                except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                    # The box itself is unreachable: its other models would fail the same way
+                    logger.warning(f"Health check error for {url}: {type(e).__name__}: {e or 'No error message'}")
+                    for skipped in models[i:]:
+                        results[skipped] = ServerMetrics(is_healthy=False, is_loaded=False)
+                    break
+                except (httpx.HTTPError, ValueError) as e:
+                    logger.warning(f"Health check error for {url}: {type(e).__name__}: {e or 'No error message'}")
+                    results[model] = ServerMetrics(is_healthy=False, is_loaded=False)
+            if config.UPSTREAM_METRICS and any(m.is_healthy for m in results.values()):
+                load = await self._scrape(url)
+                if load is not None:
+                    # Box-wide numbers: every model on the server shares its queue and KV cache
+                    for metrics in results.values():
+                        metrics.requests_processing = load.running
+                        metrics.requests_deferred = load.waiting
+                        metrics.kv_cache_usage = load.kv_cache_usage
+                        metrics.tokens_per_second = load.tokens_per_second
+        return results
+
+    def _box_models(self) -> dict[str, list[str]]:
+        box_models: dict[str, list[str]] = {}
+        for model, urls in self.model_urls.items():
+            for url in urls:
+                box_models.setdefault(url, []).append(model)
+        return box_models
+
+    def _rebuild(self) -> tuple[int, int]:
+        """Healthy/capable URLs and per-URL metrics from `_box_results`; (probes, failures)."""
         new_healthy_model_urls: dict[str, list[str]] = {model: [] for model in self.model_urls}
         new_capable_model_urls: dict[str, list[str]] = {model: [] for model in self.model_urls}
         new_server_metrics: dict[str, ServerMetrics] = {}
 
+        probes = failures = 0
         for model, urls in self.model_urls.items():
-            tasks = [self.check_server_metrics_async(url, model) for url in urls]
-
-            if tasks:
-                results = await asyncio.gather(*tasks)
-
-                for i, url in enumerate(urls):
-                    if i < len(results):
-                        metrics = results[i]
-                        new_server_metrics[url] = metrics
-                        if metrics.is_loaded:
-                            new_healthy_model_urls[model].append(url)
-                        elif metrics.is_healthy:
-                            new_capable_model_urls[model].append(url)
+            for url in urls:
+                metrics = self._box_results.get(url, {}).get(model)
+                if metrics is None:
+                    continue
+                new_server_metrics[url] = metrics
+                probes += 1
+                if metrics.is_loaded:
+                    new_healthy_model_urls[model].append(url)
+                elif metrics.is_healthy:
+                    new_capable_model_urls[model].append(url)
+                else:
+                    failures += 1
 
         self.healthy_model_urls = new_healthy_model_urls
         self.capable_model_urls = new_capable_model_urls
         self.server_metrics = new_server_metrics
+        routing_table.update_health(new_healthy_model_urls, new_capable_model_urls)
+        return probes, failures
+
+    async def check_all_servers(self) -> None:
+        """Check health of all registered servers and update healthy/capable URLs per model."""
+        started = time.monotonic()
+
+        # Group by box so a server hosting several models is probed by one task
+        box_models = self._box_models()
+        slots = asyncio.Semaphore(max(config.HEALTH_CHECK_CONCURRENCY, 1))
+        boxes = list(box_models)
+        results = await asyncio.gather(*(self._check_box(url, box_models[url], slots) for url in boxes))
+        self._box_results = dict(zip(boxes, results))
+        probes, failures = self._rebuild()
+
+        elapsed = time.monotonic() - started
+        self.sweeps += 1
+        self.last_sweep_seconds = elapsed
+        self.max_sweep_seconds = max(self.max_sweep_seconds, elapsed)
+        self.last_sweep_probes = probes
+        self.last_sweep_failures = failures
+        logger.debug(f"Health sweep: {probes} probes over {len(boxes)} servers in {elapsed:.2f}s ({failures} down)")
+
+        if config.HEALTH_PROBE_MIN_SECONDS > 0:
+            self._published.clear()  # a full sweep republishes every server
+            await self._publish(boxes)
+            return
 
         try:
             snapshot = {
-                "healthy_model_urls": new_healthy_model_urls,
-                "capable_model_urls": new_capable_model_urls,
-                "server_metrics": {
-                    url: {
-                        "requests_processing": m.requests_processing,
-                        "requests_deferred": m.requests_deferred,
-                        "is_healthy": m.is_healthy,
-                        "is_loaded": m.is_loaded,
-                    }
-                    for url, m in new_server_metrics.items()
-                },
+                "healthy_model_urls": self.healthy_model_urls,
+                "capable_model_urls": self.capable_model_urls,
+                "server_metrics": {url: _metrics_dict(m) for url, m in self.server_metrics.items()},
             }
             await get_redis().set(REDIS_KEY, json.dumps(snapshot))
         except Exception as e:
             logger.error(f"Failed to publish health snapshot to Redis: {e}", exc_info=True)
 
+    def _record(self, url: str) -> str:
+        """What followers need about one server: per-model status and box-wide load."""
+        results = self._box_results.get(url, {})
+        record: dict[str, Any] = {"models": {model: [m.is_healthy, m.is_loaded] for model, m in results.items()}}
+        if results:
+            record["metrics"] = _metrics_dict(next(iter(results.values())))
+        return json.dumps(record, sort_keys=True)
+
+    async def _publish(self, urls: list[str]) -> None:
+        """Write the records of `urls` that changed since they were last published."""
+        changed = {}
+        for url in urls:
+            record = self._record(url)
+            if self._published.get(url) != record:
+                changed[url] = record
+        if not changed:
+            return
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                for url, record in changed.items():
+                    pipe.hset(SERVERS_KEY, url, record)
+                pipe.incr(VERSION_KEY)
+                await pipe.execute()
+            self._published.update(changed)
+        except Exception as e:
+            logger.error(f"Failed to publish health state to Redis: {e}", exc_info=True)
+
+    async def probe_due(self) -> None:
+        """Leader, adaptive probing: start a probe for every server whose turn has come.
+
+        A server whose status just changed is probed again after HEALTH_PROBE_MIN_SECONDS;
+        each unchanged probe doubles its interval up to HEALTH_PROBE_MAX_SECONDS (a fraction
+        of that while it is down)."""
+        if not self._schedule:
+            # New leader: one full sweep for a complete picture, then per-server schedules
+            await self.check_all_servers()
+            now = time.monotonic()
+            minimum = config.HEALTH_PROBE_MIN_SECONDS
+            self._schedule = {url: _Schedule(minimum, now + _jittered(minimum)) for url in self._box_results}
+            return
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(max(config.HEALTH_CHECK_CONCURRENCY, 1))
+        now = time.monotonic()
+        for url, entry in self._schedule.items():
+            if entry.next_due <= now and url not in self._probing:
+                self._probing.add(url)
+                task = asyncio.create_task(self._probe_box(url, self._slots))
+                self._probe_tasks.add(task)
+                task.add_done_callback(self._probe_tasks.discard)
+
+    async def _probe_box(self, url: str, slots: asyncio.Semaphore) -> None:
+        try:
+            results = await self._check_box(url, self._box_models().get(url, []), slots)
+            entry = self._schedule.get(url)
+            if entry is None:
+                return  # leadership was lost mid-probe
+            self.probes += 1
+            previous = self._box_results.get(url)
+            changed = previous is None or _status(previous) != _status(results)
+            self._box_results[url] = results
+            self._rebuild()
+
+            minimum, maximum = config.HEALTH_PROBE_MIN_SECONDS, config.HEALTH_PROBE_MAX_SECONDS
+            if changed:
+                self.transitions += 1
+                logger.info(f"Health of {url} changed: {_status(results)}")
+                entry.interval = minimum
+            else:
+                down = not any(m.is_healthy for m in results.values())
+                ceiling = max(minimum, maximum * DOWN_MAX_FRACTION if down else maximum)
+                entry.interval = min(entry.interval * 2, ceiling)
+            entry.next_due = time.monotonic() + _jittered(entry.interval)
+            await self._publish([url])
+        except Exception as e:
+            logger.error(f"Health probe of {url} failed: {e}", exc_info=True)
+            entry = self._schedule.get(url)
+            if entry is not None and entry.next_due <= time.monotonic():
+                entry.next_due = time.monotonic() + _jittered(entry.interval)  # retry at the current pace
+        finally:
+            self._probing.discard(url)
+
+    def stop_probing(self) -> None:
+        """Leadership lost: forget schedules so a later term starts with a full sweep."""
+        self._schedule.clear()
+        self._published.clear()
+        self._slots = None
+
+    async def sync_changes(self) -> None:
+        """Followers, adaptive probing: apply server records published since the last call."""
+        try:
+            r = get_redis()
+            version = cast(str | None, await r.get(VERSION_KEY))
+            if version is None or version == self._version:
+                return
+            records = cast(dict[str, str], await r.hgetall(SERVERS_KEY))
+            box_results: dict[str, dict[str, ServerMetrics]] = {}
+            for url, raw in records.items():
+                record = json.loads(raw)
+                metrics = record.get("metrics", {})
+                box_results[url] = {
+                    model: _metrics_from({**metrics, "is_healthy": is_healthy, "is_loaded": is_loaded})
+                    for model, (is_healthy, is_loaded) in record.get("models", {}).items()
+                }
+            self._box_results = box_results
+            self._rebuild()
+            self._version = version
+        except Exception as e:
+            logger.error(f"Failed to sync health state from Redis: {e}", exc_info=True)
+
     async def sync_from_redis(self) -> None:
         """All replicas: refresh local snapshot from Redis."""
+        if config.HEALTH_PROBE_MIN_SECONDS > 0:
+            await self.sync_changes()
+            return
         try:
             raw = await get_redis().get(REDIS_KEY)
             if not raw:
@@ -172,17 +473,43 @@ class ServerHealthMonitor:
             snap = json.loads(raw)
             self.healthy_model_urls = {m: list(urls) for m, urls in snap.get("healthy_model_urls", {}).items()}
             self.capable_model_urls = {m: list(urls) for m, urls in snap.get("capable_model_urls", {}).items()}
-            self.server_metrics = {
-                url: ServerMetrics(
-                    requests_processing=m.get("requests_processing", 0),
-                    requests_deferred=m.get("requests_deferred", 0),
-                    is_healthy=m.get("is_healthy", False),
-                    is_loaded=m.get("is_loaded", False),
-                )
-                for url, m in snap.get("server_metrics", {}).items()
-            }
+            self.server_metrics = {url: _metrics_from(m) for url, m in snap.get("server_metrics", {}).items()}
+            routing_table.update_health(self.healthy_model_urls, self.capable_model_urls)
         except Exception as e:
             logger.error(f"Failed to sync health snapshot from Redis: {e}", exc_info=True)
 
+    def stats(self) -> dict[str, Any]:
+        return {
+            "sweeps": self.sweeps,
+            "last_sweep_seconds": round(self.last_sweep_seconds, 3),
+            "max_sweep_seconds": round(self.max_sweep_seconds, 3),
+            "last_sweep_probes": self.last_sweep_probes,
+            "last_sweep_failures": self.last_sweep_failures,
+            "probes": self.probes,
+            "transitions": self.transitions,
+        }
+
+    async def aclose(self) -> None:
+        client, self._client = self._client, None
+        if client is not None:
+            await client.aclose()
+
 
 server_health_monitor = ServerHealthMonitor()
+
+
+async def run_probes() -> None:
+    """Background task (HEALTH_PROBE_MIN_SECONDS > 0): the leader probes each server on its
+    own schedule; other replicas pick up the changes it publishes."""
+    if config.HEALTH_PROBE_MIN_SECONDS <= 0:
+        return
+    while True:
+        try:
+            if leader.is_leader:
+                await server_health_monitor.probe_due()
+            else:
+                server_health_monitor.stop_probing()
+                await server_health_monitor.sync_changes()
+        except Exception as e:
+            logger.error(f"Error in health probe scheduler: {e}", exc_info=True)
+        await asyncio.sleep(POLL_INTERVAL)
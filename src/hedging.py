@@ -0,0 +1,62 @@
+"""Hedged requests for non-streaming inference (opt-in per model, HEDGE_MODELS).
+
+A non-streaming call waits on one upstream until its headers arrive, so one slow box sets
+the model's tail latency. For hedged models, if the first server hasn't answered within
+the model's recent p95 time-to-headers, the proxy sends a copy to the next server and
+keeps whichever answers first (see `proxy._send_hedged`).
+
+Hedges are capped by a budget: every eligible request earns HEDGE_BUDGET_PERCENT / 100 of
+a credit and each hedge spends one, so hedging never adds more than that share of extra
+upstream load, even when a whole model slows down.
+"""
+
+import math
+from collections import deque
+
+from src.config import config
+
+WINDOW = 256  # recent time-to-headers samples kept per model
+MIN_SAMPLES = 20  # don't hedge on a p95 computed from too little data
+MAX_CREDITS = 10.0  # lets a short burst of slow requests hedge without going over budget
+
+
+class HedgePolicy:
+    def __init__(self) -> None:
+        self._samples: dict[str, deque[float]] = {}
+        self._credits = 0.0
+
+    def enabled(self, model: str) -> bool:
+        return model in config.HEDGE_MODELS
+
+    def observe(self, model: str, seconds: float) -> None:
+        """Record how long an upstream took to return headers for a non-streaming call."""
+        samples = self._samples.get(model)
+        if samples is None:
+            samples = self._samples[model] = deque(maxlen=WINDOW)
+        samples.append(seconds)
+
+    def threshold(self, model: str) -> float | None:
+        """p95 time-to-headers for `model`, or None until there are enough samples."""
+        samples = self._samples.get(model)
+        if samples is None or len(samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(math.ceil(0.95 * len(ordered)) - 1, len(ordered) - 1)]
+
+    def delay(self, model: str) -> float | None:
+        """How long to wait before hedging this request, or None to not hedge it. Call once
+        per eligible request: it also earns that request's share of the budget."""
+        if not self.enabled(model):
+            return None
+        self._credits = min(self._credits + config.HEDGE_BUDGET_PERCENT / 100, MAX_CREDITS)
+        return self.threshold(model)
+
+    def try_spend(self) -> bool:
+        """Take one hedge from the budget; False when it is exhausted."""
+        if self._credits < 1:
+            return False
+        self._credits -= 1
+        return True
+
+
+hedge_policy = HedgePolicy()
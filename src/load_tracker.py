@@ -1,6 +1,10 @@
+import asyncio
 import time
+from collections.abc import Iterable, Sequence
 from typing import Awaitable, cast
 
+from redis.commands.core import AsyncScript
+
 from src.config import config
 from src.logger import setup_logger
 from src.redis_client import get_redis, k
@@ -8,16 +12,72 @@ from src.redis_client import get_redis, k
 logger = setup_logger(__name__)
 
 # A lease self-expires LEASE_TTL after its last (re)acquire, so a dropped release
-# (cancelled request, killed process, Redis blip) can't leak load forever. The
-# streaming path re-acquires every LEASE_REFRESH_INTERVAL to outlive long generations.
+# (cancelled request, killed process, Redis blip) can't leak load forever. Each replica
+# re-stamps all of its live leases every LEASE_REFRESH_INTERVAL (run_refresher) so long
+# generations outlive the TTL without any per-chunk work on the stream itself.
 LEASE_TTL = 720
 LEASE_REFRESH_INTERVAL = 300
 
+# Leases live in one sorted set per server: member = request id, score = deadline. Pruning
+# expired leases and counting the rest happens server-side in one script call for all
+# servers, so a load read is O(log n) per server instead of shipping every lease to Python.
+COUNT_SCRIPT = """
+local counts = {}
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', ARGV[1])
+    counts[i] = redis.call('ZCARD', key)
+end
+return counts
+"""
+
+# Transitional: moves live leases from the pre-sorted-set hash format (field = request id,
+# value = deadline) into the sorted set, atomically, then drops the hash. Run by the leader
+# each job cycle while old replicas may still be writing hashes during a rolling deploy;
+# their later HDELs miss the moved lease, which then just expires at its deadline.
+# Can go (with _legacy_key) once no deployment runs the hash-based tracker.
+MIGRATE_SCRIPT = """
+local entries = redis.call('HGETALL', KEYS[1])
+local moved = 0
+for i = 1, #entries, 2 do
+    local deadline = tonumber(entries[i + 1])
+    if deadline and deadline > tonumber(ARGV[1]) then
+        redis.call('ZADD', KEYS[2], 'GT', deadline, entries[i])
+        moved = moved + 1
+    end
+end
+redis.call('DEL', KEYS[1])
+if moved > 0 then
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+end
+return moved
+"""
+
 
 def _key(server: str) -> str:
+    return k("leases", server)
+
+
+def _legacy_key(server: str) -> str:
     return k("inflight", server)
 
 
+_scripts: dict[str, AsyncScript] = {}
+_scripts_client: object = None
+
+
+def _script(source: str) -> AsyncScript:
+    """Registered script for the current Redis client (EVALSHA, falling back to EVAL)."""
+    global _scripts_client
+    r = get_redis()
+    if r is not _scripts_client:
+        _scripts.clear()
+        _scripts_client = r
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = r.register_script(source)
+    return script
+
+
 def _all_servers() -> list[str]:
     seen: set[str] = set()
     out: list[str] = []
@@ -29,60 +89,170 @@ def _all_servers() -> list[str]:
     return out
 
 
-def _prune_and_count(entries: dict[str, str], now: float) -> tuple[int, list[str]]:
-    """Count live leases; return (load, expired_request_ids). Value is a "<deadline>"."""
-    live = 0
-    expired: list[str] = []
-    for rid, val in entries.items():
+def _batched() -> bool:
+    return config.LOAD_FLUSH_INTERVAL_MS > 0
+
+
+class LeaseBuffer:
+    """Replica-local lease changes waiting for the next flush (LOAD_FLUSH_INTERVAL_MS > 0).
+
+    acquire/release only touch these dicts; `flush` writes them in one pipeline. A lease
+    acquired and released within the same interval never reaches Redis at all.
+    """
+
+    def __init__(self) -> None:
+        self.acquires: dict[str, dict[str, float]] = {}  # server -> {request_id: deadline}
+        self.releases: dict[str, set[str]] = {}
+        # This replica's leases that are (or are being) written to Redis, with their deadline.
+        self.flushed: dict[str, dict[str, float]] = {}
+
+    def acquire(self, server: str, request_id: str, deadline: float) -> None:
+        released = self.releases.get(server)
+        if released:
+            released.discard(request_id)
+        self.acquires.setdefault(server, {})[request_id] = deadline
+
+    def release(self, server: str, request_id: str) -> None:
+        pending = self.acquires.get(server)
+        if pending:
+            pending.pop(request_id, None)
+        if request_id in self.flushed.get(server, {}):
+            self.releases.setdefault(server, set()).add(request_id)
+
+    def local_delta(self, server: str) -> int:
+        """Net change this replica has made to `server`'s load that Redis doesn't show yet."""
+        flushed = self.flushed.get(server, {})
+        new = sum(1 for rid in self.acquires.get(server, ()) if rid not in flushed)
+        return new - len(self.releases.get(server, ()))
+
+    async def flush(self) -> None:
+        acquires = {s: leases for s, leases in self.acquires.items() if leases}
+        releases = {s: rids for s, rids in self.releases.items() if rids}
+        self.acquires, self.releases = {}, {}
+        if not acquires and not releases:
+            return
+
+        # Mark acquires as flushed before the await: a release arriving mid-flush must
+        # become a ZREM, since the lease is about to exist in Redis.
+        now = time.time()
+        for server, leases in acquires.items():
+            flushed = self.flushed.setdefault(server, {})
+            flushed.update(leases)
+            for rid in [rid for rid, deadline in flushed.items() if deadline <= now]:
+                del flushed[rid]  # never released (lost request): it has expired in Redis too
+        released: dict[str, dict[str, float]] = {}  # server -> {request_id: deadline}, for a retry
+        for server, rids in releases.items():
+            flushed = self.flushed.get(server, {})
+            released[server] = {rid: flushed.pop(rid) for rid in rids if rid in flushed}
+
         try:
-            deadline = float(val)
-        except (ValueError, TypeError):
-            expired.append(rid)
-            continue
-        if deadline <= now:
-            expired.append(rid)
-        else:
-            live += 1
-    return live, expired
+            async with get_redis().pipeline(transaction=False) as pipe:
+                for server, leases in acquires.items():
+                    pipe.zadd(_key(server), leases)
+                    pipe.expire(_key(server), LEASE_TTL + 60)
+                for server, rids in releases.items():
+                    pipe.zrem(_key(server), *rids)
+                await pipe.execute()
+        except Exception as e:
+            # Same outcome as a failed write-through acquire: the lease is under-counted.
+            logger.error(f"Failed to flush inflight leases to Redis: {e}", exc_info=True)
+            for server, leases in acquires.items():
+                flushed = self.flushed.get(server, {})
+                pending = self.releases.get(server)
+                for rid in leases:
+                    flushed.pop(rid, None)
+                    if pending:
+                        pending.discard(rid)  # released mid-flush: there is nothing to remove
+            # Releases go back in the buffer for the next flush: their leases are still in Redis
+            for server, leases in released.items():
+                if leases:
+                    self.flushed.setdefault(server, {}).update(leases)
+                    self.releases.setdefault(server, set()).update(leases)
 
 
-async def get_all_loads() -> dict[str, int]:
-    servers = _all_servers()
+_buffer = LeaseBuffer()
+
+# This replica's live leases (server -> request ids), between acquire and release.
+_live: dict[str, set[str]] = {}
+
+
+async def _count(servers: Sequence[str]) -> dict[str, int] | None:
+    """Live lease count per server straight from Redis, or None if Redis failed."""
     if not servers:
         return {}
-    now = time.time()
-    r = get_redis()
     try:
-        async with r.pipeline(transaction=False) as pipe:
-            for s in servers:
-                pipe.hgetall(_key(s))
-            raw = await pipe.execute()
-
-        loads: dict[str, int] = {}
-        to_prune: list[tuple[str, list[str]]] = []
-        for s, entries in zip(servers, raw):
-            live, expired = _prune_and_count(entries or {}, now)
-            loads[s] = live
-            if expired:
-                to_prune.append((s, expired))
-
-        if to_prune:
-            async with r.pipeline(transaction=False) as pipe:
-                for s, rids in to_prune:
-                    pipe.hdel(_key(s), *rids)
-                await pipe.execute()
-        return loads
+        counts = await _script(COUNT_SCRIPT)(keys=[_key(s) for s in servers], args=[time.time()])
     except Exception as e:
         logger.error(f"Failed to read inflight loads from Redis: {e}", exc_info=True)
-        return {}
+        return None
+    return {s: int(c) for s, c in zip(servers, counts)}
+
+
+def _with_local(counts: dict[str, int], servers: Iterable[str]) -> dict[str, int]:
+    if not _batched():
+        return counts
+    # Other replicas come from the aggregated Redis view; ours also counts what hasn't
+    # been flushed yet, so local routing stays exact.
+    return {s: max(counts.get(s, 0) + _buffer.local_delta(s), 0) for s in servers}
+
+
+class LoadSnapshot:
+    """Replica-wide copy of every server's load, refreshed by one background task
+    (LOAD_SNAPSHOT_INTERVAL_MS > 0) so requests read loads from memory and Redis reads
+    scale with the number of replicas rather than the request rate."""
+
+    def __init__(self) -> None:
+        self.counts: dict[str, int] = {}
+        self.taken_at = 0.0  # time.monotonic()
+
+    def fresh(self) -> bool:
+        # Tolerate a few missed refreshes; past that (Redis down, task died) read directly.
+        max_age = 5 * config.LOAD_SNAPSHOT_INTERVAL_MS / 1000
+        return time.monotonic() - self.taken_at <= max_age
+
+    async def refresh(self) -> None:
+        counts = await _count(_all_servers())
+        if counts is not None:
+            self.counts = counts
+            self.taken_at = time.monotonic()
+
+    def note(self, server: str, delta: int) -> None:
+        """Apply one of our own write-through lease changes before the next refresh shows it."""
+        if server in self.counts:
+            self.counts = {**self.counts, server: max(self.counts[server] + delta, 0)}
+
+
+_snapshot = LoadSnapshot()
+
+
+async def get_all_loads() -> dict[str, int]:
+    servers = _all_servers()
+    counts = await _count(servers)
+    return {} if counts is None else _with_local(counts, servers)
+
+
+async def get_loads(servers: Sequence[str]) -> dict[str, int]:
+    """Loads for one route's servers: from the shared snapshot when it is fresh and covers
+    them, else a Redis read of just these servers. The result must not be mutated."""
+    if config.LOAD_SNAPSHOT_INTERVAL_MS > 0 and _snapshot.fresh():
+        counts = _snapshot.counts
+        if all(s in counts for s in servers):
+            return _with_local(counts, servers)
+    counts_or_none = await _count(servers)
+    return {} if counts_or_none is None else _with_local(counts_or_none, servers)
 
 
 async def acquire(server: str, request_id: str) -> None:
+    _live.setdefault(server, set()).add(request_id)
+    if _batched():
+        _buffer.acquire(server, request_id, time.time() + LEASE_TTL)
+        return
+    _snapshot.note(server, 1)
     try:
         r = get_redis()
         deadline = time.time() + LEASE_TTL
         async with r.pipeline(transaction=False) as pipe:
-            pipe.hset(_key(server), request_id, f"{deadline}")
+            pipe.zadd(_key(server), {request_id: deadline})
             pipe.expire(_key(server), LEASE_TTL + 60)
             await pipe.execute()
     except Exception as e:
@@ -90,7 +260,80 @@ async def acquire(server: str, request_id: str) -> None:
 
 
 async def release(server: str, request_id: str) -> None:
+    live = _live.get(server)
+    if live is not None:
+        live.discard(request_id)
+        if not live:
+            del _live[server]
+    if _batched():
+        _buffer.release(server, request_id)
+        return
+    _snapshot.note(server, -1)
     try:
-        await cast("Awaitable[int]", get_redis().hdel(_key(server), request_id))
+        await cast("Awaitable[int]", get_redis().zrem(_key(server), request_id))
     except Exception as e:
         logger.error(f"Failed to release inflight lease for {server} ({request_id}): {e}", exc_info=True)
+
+
+async def migrate_legacy_leases() -> None:
+    """Leader-only: fold leases still stored in the legacy hash format into the sorted sets."""
+    try:
+        migrate = _script(MIGRATE_SCRIPT)
+        now = time.time()
+        moved = 0
+        for server in _all_servers():
+            moved += int(await migrate(keys=[_legacy_key(server), _key(server)], args=[now, LEASE_TTL + 60]))
+        if moved:
+            logger.info(f"Migrated {moved} inflight leases from legacy hashes to sorted sets")
+    except Exception as e:
+        logger.error(f"Failed to migrate legacy inflight leases: {e}", exc_info=True)
+
+
+async def refresh_live_leases() -> None:
+    """Push the deadline of every live lease on this replica forward, in one pipeline."""
+    if not _live:
+        return
+    deadline = time.time() + LEASE_TTL
+    if _batched():
+        for server, rids in _live.items():
+            for rid in rids:
+                _buffer.acquire(server, rid, deadline)
+        return
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for server, rids in _live.items():
+                # XX: only extend leases still in Redis, so a release racing this
+                # pipeline can't be undone by a late re-add.
+                pipe.zadd(_key(server), dict.fromkeys(rids, deadline), xx=True)
+                pipe.expire(_key(server), LEASE_TTL + 60)
+            await pipe.execute()
+    except Exception as e:
+        logger.error(f"Failed to refresh inflight leases: {e}", exc_info=True)
+
+
+async def flush() -> None:
+    """Write buffered lease changes to Redis (no-op in write-through mode)."""
+    await _buffer.flush()
+
+
+async def run_flusher() -> None:
+    """Background task: flush buffered leases every LOAD_FLUSH_INTERVAL_MS."""
+    interval = config.LOAD_FLUSH_INTERVAL_MS / 1000
+    while True:
+        await asyncio.sleep(interval)
+        await flush()
+
+
+async def run_refresher() -> None:
+    """Background task: refresh this replica's live leases every LEASE_REFRESH_INTERVAL."""
+    while True:
+        await asyncio.sleep(LEASE_REFRESH_INTERVAL)
+        await refresh_live_leases()
+
+
+async def run_snapshot_refresher() -> None:
+    """Background task: refresh the shared load snapshot every LOAD_SNAPSHOT_INTERVAL_MS."""
+    interval = config.LOAD_SNAPSHOT_INTERVAL_MS / 1000
+    while True:
+        await _snapshot.refresh()
+        await asyncio.sleep(interval)
@@ -2,29 +2,42 @@ import asyncio
 import json
 import time
 import uuid
+from collections.abc import Awaitable, Callable
 from http import HTTPStatus
+from typing import cast
 
 import httpx
-from fastapi import APIRouter, HTTPException, Request, Response, Cookie
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.exceptions import RequestValidationError
 from fastapi.security import HTTPBearer
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
+from starlette.types import Receive, Scope, Send
 
+from src.admission import admission
+from src.api_keys import KeysManager
+from src.balancer import affinity_server, order_servers, prefix_key, upstream_latency
+from src.circuit_breaker import circuit_breakers
+from src.coalescing import BufferedResponse, coalesce_key, single_flight
 from src.config import config
+from src.embedding_batcher import embedding_batcher
+from src.embeddings_cache import embeddings_cache
+from src.embeddings_format import transcode as transcode_embeddings
+from src.embeddings_format import upstream_body as upstream_embeddings_body
+from src.errors import invalid_key_response, rate_limit_response
 from src.health import server_health_monitor
+from src.hedging import hedge_policy
 from src.image_stripping import IMAGE_STRIP_PATHS, strip_images
-from src.load_tracker import (
-    LEASE_REFRESH_INTERVAL,
-    acquire as load_acquire,
-    release as load_release,
-    get_all_loads,
-)
+from src.load_tracker import acquire as load_acquire
+from src.load_tracker import get_loads
+from src.load_tracker import release as load_release
 from src.logger import setup_logger
-from src.aleph import aleph_service
-from src.ssl_trust import SSL_CONTEXT
+from src.rate_limit import Limits, estimate_tokens, identity_for_key, identity_for_payer, limits_from, rate_limiter
+from src.request_context import RequestContext
+from src.request_stream import ClientDisconnected
+from src.routing import CompiledRoute, routing_table
+from src.stall import stall_detector
+from src.upstream_pool import UpstreamPools
 from src.x402 import x402_manager
-from src.api_keys import KeysManager
-from src.errors import invalid_key_response
 
 router = APIRouter(tags=["Proxy"])
 security = HTTPBearer()
@@ -42,17 +55,18 @@ timeout = httpx.Timeout(
     write=10.0,  # Write timeout (text prompts only)
     pool=5.0,  # Pool connection timeout
 )
-limits = httpx.Limits(
-    max_connections=500,  # Max total concurrent connections
-    max_keepalive_connections=100,  # Max idle connections to keep alive
-)
-client = httpx.AsyncClient(timeout=timeout, limits=limits, verify=SSL_CONTEXT)
+# One pool per upstream box, so a black-holed box can't starve the others (src/upstream_pool.py)
+client = UpstreamPools(timeout)
 
 
 async def close_http_client() -> None:
     await client.aclose()
 
 
+async def prewarm_upstreams() -> None:
+    await client.prewarm(list(dict.fromkeys(u for urls in config.MODELS.values() for u in urls)))
+
+
 logger = setup_logger(__name__)
 
 
@@ -63,73 +77,326 @@ class ProxyRequest(BaseModel):
         extra = "allow"  # Allow extra fields
 
 
-@router.post("/{full_path:path}")
-async def proxy_request(
-    full_path: str,
-    request: Request,
-    proxy_request_data: ProxyRequest,
-    preferred_instances: str = Cookie(default="{}"),  # JSON-encoded map
-):
-    # Get model from request
-    model_name = proxy_request_data.model
+async def _wait_for_disconnect(receive: Receive) -> None:
+    while (await receive())["type"] != "http.disconnect":
+        pass
 
-    logger.debug(f"Received proxy request to {full_path} for model {model_name}")
 
+async def until_disconnect(work: Awaitable[Response], receive: Receive) -> Response | None:
+    """Await `work` (routing, then waiting for the upstream's headers, which for a
+    non-streaming call means the whole generation), cancelling it if the client disconnects
+    first: httpx aborts the upstream request so the box stops generating, and the lease is
+    released on the way out. Returns None when the client is gone.
+
+    Only for requests whose body has been read in full: `receive` must be free to watch.
+    """
+    task = asyncio.ensure_future(work)
+    disconnect = asyncio.create_task(_wait_for_disconnect(receive))
     try:
-        preferred_instances_map = json.loads(preferred_instances)
-    except json.JSONDecodeError:
-        preferred_instances_map = {}
-
-    model = model_name.lower()
-    # Resolve model redirections (e.g. deprecated model names)
-    model = aleph_service.resolve(model)
-    if model != model_name.lower():
-        logger.debug(f"Redirected model '{model_name}' -> '{model}'")
+        await asyncio.wait((task, disconnect), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect.cancel()
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            logger.debug("Client disconnected before the upstream answered, request cancelled")
+    return None if task.cancelled() else task.result()
+
+
+class UpstreamResponse(Response):
+    """Relays an upstream response straight to the ASGI `send` callable, chunk by chunk.
+
+    Used for SSE and plain bodies alike, so large responses (images, audio, embedding
+    batches) are never buffered whole. Chunks go from `aiter_raw` to `send` without an
+    async-generator hop, with the upstream's Content-Length/Content-Encoding passed through,
+    and a single watcher task stops the relay as soon as the client disconnects. The
+    upstream is closed and the lease released however it ends.
+
+    `prefetch` reads the first chunk before anything is sent to the client, so a stall there
+    can still fail over; later chunks are bounded by the model's idle timeout (src/stall.py).
+    """
+
+    def __init__(
+        self,
+        upstream: httpx.Response,
+        headers: dict[str, str],
+        server: str,
+        request_id: str,
+        url: str,
+        started: float,
+        sse: bool,
+        model: str,
+        on_close: Callable[[], None] | None = None,
+    ) -> None:
+        self.upstream = upstream
+        self.status_code = upstream.status_code
+        self.raw_headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()]
+        self.background = None
+        self.server = server
+        self.request_id = request_id
+        self.url = url
+        self.started = started  # time.monotonic() when the upstream request was sent
+        self.sse = sse  # only event streams feed the latency EWMAs
+        self.model = model
+        # Token counting only makes sense on an unencoded event stream
+        self.count_events = sse and headers.get("content-encoding", "identity") == "identity"
+        self.on_close = on_close  # e.g. the caller's rate-limit concurrency slot
+        # aiter_raw (not aiter_bytes) so we forward the body exactly as the upstream
+        # encoded it, matching the Content-Encoding header we pass on.
+        self._chunks = upstream.aiter_raw()
+        self._first = b""
+        self._first_at = 0.0  # time.monotonic() the first chunk arrived; 0 = not read yet
+
+    async def prefetch(self) -> bool:
+        """Read the first chunk; False if the upstream stalled before sending it."""
+        timeout = stall_detector.first_byte_timeout(self.model, self.sse)
+        headers_at = time.monotonic()
+        try:
+            async with asyncio.timeout(timeout):
+                self._first = await anext(self._chunks, b"")
+        except TimeoutError:
+            stall_detector.first_byte_stalls += 1
+            return False
+        self._first_at = time.monotonic()
+        stall_detector.observe_first_byte(self.model, self.sse, self._first_at - headers_at)
+        return True
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        relay = asyncio.create_task(self._relay(send))
+        disconnect = asyncio.create_task(_wait_for_disconnect(receive))
+        try:
+            await asyncio.wait((relay, disconnect), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnect.cancel()
+            if not relay.done():
+                relay.cancel()  # client disconnect — normal; the relay's finally still cleans up
+        await asyncio.gather(relay, return_exceptions=True)
 
-    # Handle thinking model variants
-    thinking_requested = False
-    if model.endswith("-thinking"):
-        base_model = model.removesuffix("-thinking")
-        # Resolve redirections on the base model too (e.g. old-model-thinking -> new-model)
-        resolved_base = aleph_service.resolve(base_model)
-        if aleph_service.is_reasoning_model(resolved_base):
-            thinking_requested = True
-            model = resolved_base
-            logger.debug(f"Thinking variant requested for model '{model}'")
-        # If base model isn't a reasoning model, let it fall through to 404
+    async def _relay(self, send: Send) -> None:
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            events = 0  # SSE events after the first chunk; one per token for vLLM streams
+            try:
+                if not self._first_at:
+                    await self.prefetch()
+                if self.sse:
+                    upstream_latency.observe_ttfb(self.server, self._first_at - self.started)
+                if self._first:
+                    await send({"type": "http.response.body", "body": self._first, "more_body": True})
+                idle = stall_detector.idle_timeout(self.model, self.sse)
+                max_gap = 0.0
+                waiting_since = time.monotonic()
+                loop = asyncio.get_running_loop()
+                # The lease is kept alive by load_tracker's replica-wide refresher.
+                async with asyncio.timeout_at(None if idle is None else loop.time() + idle) as deadline:
+                    async for chunk in self._chunks:
+                        max_gap = max(max_gap, time.monotonic() - waiting_since)
+                        if self.count_events:
+                            events += chunk.count(b"data:")
+                        await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                        waiting_since = time.monotonic()
+                        if idle is not None:
+                            deadline.reschedule(loop.time() + idle)
+                stall_detector.observe_max_gap(self.model, self.sse, max_gap)
+                if events:
+                    upstream_latency.observe_throughput(self.server, events, time.monotonic() - self._first_at)
+            except asyncio.CancelledError:
+                raise
+            except TimeoutError:
+                stall_detector.idle_stalls += 1
+                logger.warning(f"Stream from {self.url} stalled, ending it")
+                await circuit_breakers.record_failure(self.server)
+            except Exception as e:
+                # Headers already sent; end the stream instead of raising into ASGI.
+                logger.warning(f"Stream from {self.url} interrupted: {type(e).__name__}: {e}")
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            await self._close()
 
-    preferred_server: str | None = preferred_instances_map.get(model)
-    if model not in config.MODELS or not config.MODELS[model]:
+    async def read(self) -> bytes:
+        """Read the whole (still encoded) body instead of relaying it, then clean up."""
+        try:
+            if not self._first_at:
+                await self.prefetch()
+            parts = [self._first] if self._first else []
+            idle = stall_detector.idle_timeout(self.model, self.sse)
+            loop = asyncio.get_running_loop()
+            async with asyncio.timeout_at(None if idle is None else loop.time() + idle) as deadline:
+                async for chunk in self._chunks:
+                    parts.append(chunk)
+                    if idle is not None:
+                        deadline.reschedule(loop.time() + idle)
+            return b"".join(parts)
+        except TimeoutError:
+            stall_detector.idle_stalls += 1
+            logger.warning(f"Response from {self.url} stalled")
+            await circuit_breakers.record_failure(self.server)
+            raise HTTPException(status_code=HTTPStatus.GATEWAY_TIMEOUT, detail="Upstream stalled")
+        finally:
+            await self._close()
+
+    async def _close(self) -> None:
+        if self.on_close is not None:
+            self.on_close()
+        await self.upstream.aclose()
+        await load_release(self.server, self.request_id)
+
+
+async def _discard(task: "asyncio.Task[httpx.Response]") -> None:
+    """Cancel an upstream send (or close the response it already got)."""
+    if not task.done():
+        task.cancel()
+    (result,) = await asyncio.gather(task, return_exceptions=True)
+    if isinstance(result, httpx.Response):
+        await result.aclose()
+
+
+async def _send_hedged(
+    req: httpx.Request,
+    server: str,
+    request_id: str,
+    backup: str,
+    build: Callable[[str], httpx.Request],
+    delay: float,
+    tried: set[str],
+) -> tuple[str, str, httpx.Response, float]:
+    """Send `req` to `server`; if it hasn't returned headers after `delay` and the hedge
+    budget allows, race a copy on `backup` (added to `tried`) and keep the first non-5xx
+    answer.
+
+    Returns (server, request id, response, monotonic time it was sent) of the answer kept,
+    or the primary's own outcome when neither succeeded. The caller owns `server`'s lease
+    going in and the returned server's lease coming out; the loser's is released here.
+    """
+    started = time.monotonic()
+    primary = asyncio.create_task(client.send(req, stream=True))
+    hedge: asyncio.Task[httpx.Response] | None = None
+    winner: asyncio.Task[httpx.Response] | None = None
+    backup_id = uuid.uuid4().hex
+    try:
+        await asyncio.wait((primary,), timeout=delay)
+        if primary.done() or not hedge_policy.try_spend():
+            winner = primary
+            return server, request_id, await primary, started
+
+        await load_acquire(backup, backup_id)
+        circuit_breakers.on_attempt(backup)
+        tried.add(backup)
+        logger.debug(f"No headers from {server} after {delay:.2f}s, hedging on {backup}")
+        hedge_started = time.monotonic()
+        hedge = asyncio.create_task(client.send(build(backup), stream=True))
+        pending: set[asyncio.Task[httpx.Response]] = {primary, hedge}
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in (primary, hedge):  # primary first on a tie
+                if task in done and task.exception() is None and task.result().status_code < 500:
+                    winner = task
+                    break
+        if winner is hedge:
+            await load_release(server, request_id)
+            return backup, backup_id, hedge.result(), hedge_started
+        if winner is None:  # both failed; the caller records the primary's failure
+            await circuit_breakers.record_failure(backup)
+        winner = primary
+        return server, request_id, await primary, started
+    finally:
+        for racer in (primary, hedge):
+            if racer is not None and racer is not winner:
+                await _discard(racer)
+        if hedge is not None and winner is not hedge:
+            await load_release(backup, backup_id)
+
+
+def _validation_error(ctx: RequestContext) -> RequestValidationError:
+    """FastAPI-shaped 422 for a body without a usable `model` (only built on the error path)."""
+    try:
+        ProxyRequest.model_validate(ctx.json)
+        errors = []
+    except ValidationError as e:
+        errors = [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
+    return RequestValidationError(errors, body=ctx.json)
+
+
+# The body is read raw (not as a `ProxyRequest` parameter) so it's parsed once by RequestContext;
+# the schema is still advertised for the docs.
+@router.post(
+    "/{full_path:path}",
+    openapi_extra={
+        "requestBody": {
+            "content": {"application/json": {"schema": ProxyRequest.model_json_schema()}},
+            "required": True,
+        }
+    },
+)
+async def proxy_request(full_path: str, request: Request):
+    ctx = RequestContext(request.scope, full_path, await request.body())
+    if ctx.model_name is None:
+        raise _validation_error(ctx)
+    response = await until_disconnect(handle_proxy(ctx), request.receive)
+    return response if response is not None else Response(status_code=499)  # nobody is listening
+
+
+async def handle_proxy(ctx: RequestContext) -> Response:
+    """Route, authorize and forward one inference request; shared by the FastAPI route and
+    the raw ASGI fast path. Expects `ctx.model_name` to be set; errors raise HTTPException."""
+    full_path = ctx.full_path
+    model_name = cast(str, ctx.model_name)
+
+    logger.debug(f"Received proxy request to {full_path} for model {model_name}")
+
+    preferred_instances_map = ctx.preferred_instances
+
+    route = routing_table.get(model_name)
+    if route is None:
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND,
             detail=f"Model '{model_name}' not found",
         )
+    model = route.model
+    if route.thinking_requested:
+        logger.debug(f"Thinking variant requested for model '{model}'")
+    elif model != model_name.lower():
+        logger.debug(f"Redirected model '{model_name}' -> '{model}'")
 
-    # Get the original request body & headers
-    headers = dict(request.headers)
-    body = await request.body()
+    preferred_server: str | None = preferred_instances_map.get(model)
 
-    # Strip image content for text-only models (avoids upstream errors on non-vision models)
-    should_strip_images = full_path in IMAGE_STRIP_PATHS and not aleph_service.is_vision_model(model)
+    headers = dict(ctx.headers)
 
-    # Update request body if model changed, needs thinking kwargs, or needs image stripping
-    needs_body_update = (model != model_name.lower()) or aleph_service.is_reasoning_model(model) or should_strip_images
-    if needs_body_update:
-        try:
-            body_json = json.loads(body)
+    # Strip image content for text-only models (avoids upstream errors on non-vision models)
+    should_strip_images = full_path in IMAGE_STRIP_PATHS and not route.is_vision
+
+    # A streamed body is passed through untouched unless something below needs the document:
+    # a model rewrite, thinking kwargs, image stripping, x402 pricing or prefix affinity.
+    if ctx.streaming and (
+        model_name != model
+        or (route.is_reasoning and not route.thinking_requested)
+        or should_strip_images
+        or not ctx.headers.get("authorization")
+        or (config.PREFIX_AFFINITY_MESSAGES > 0 and preferred_server not in route.preferable)
+    ):
+        await ctx.load_body()
+
+    # Rewrite the parsed body in place if the model changed, needs thinking kwargs, or needs
+    # image stripping; the bytes are only re-serialized if something actually changed.
+    body_json = ctx.json
+    if body_json is not None:
+        if body_json.get("model") != model:
             body_json["model"] = model
-            # Reasoning models: disable thinking by default, enable only with -thinking suffix
-            if aleph_service.is_reasoning_model(model) and not thinking_requested:
-                body_json.setdefault("chat_template_kwargs", {}).setdefault("enable_thinking", False)
-            # Non-vision models: drop any image parts so the upstream doesn't reject the request
-            if should_strip_images:
-                body_json, stripped = strip_images(full_path, body_json)
-                if stripped:
-                    logger.debug(f"Stripped image content for non-vision model '{model}' on {full_path}")
-            body = json.dumps(body_json).encode()
-            headers["content-length"] = str(len(body))
-        except json.JSONDecodeError:
-            pass
+            ctx.mark_dirty()
+        # Reasoning models: disable thinking by default, enable only with -thinking suffix
+        if route.is_reasoning and not route.thinking_requested:
+            template_kwargs = body_json.setdefault("chat_template_kwargs", {})
+            if isinstance(template_kwargs, dict) and "enable_thinking" not in template_kwargs:
+                template_kwargs["enable_thinking"] = False
+                ctx.mark_dirty()
+        # Non-vision models: drop any image parts so the upstream doesn't reject the request
+        if should_strip_images:
+            stripped_json, stripped = strip_images(full_path, body_json)
+            if stripped:
+                ctx.replace_json(stripped_json)
+                logger.debug(f"Stripped image content for non-vision model '{model}' on {full_path}")
+    if not ctx.streaming and ctx.body is not ctx.raw_body:
+        headers["content-length"] = str(len(ctx.body))
 
     # Clean up headers
     headers.pop("host", None)
@@ -143,7 +410,7 @@ async def proxy_request(
         headers["accept-encoding"] = "identity"
 
     # Conditional auth: if no Authorization header, use x402 payment flow
-    has_auth = request.headers.get("authorization")
+    has_auth = ctx.headers.get("authorization")
     if has_auth:
         # Known-but-blocked key: answer with the reason instead of forwarding
         # to a box that would return a generic 401. Unknown keys still fall
@@ -156,19 +423,14 @@ async def proxy_request(
             if invalid_info is not None:
                 return invalid_key_response(invalid_info)
     if not has_auth:
-        try:
-            body_json = json.loads(body)
-        except json.JSONDecodeError:
-            body_json = {}
-
-        max_price = await x402_manager.compute_max_price(model, body_json)
+        max_price = await x402_manager.compute_max_price(model, ctx.json or {})
         if max_price is None:
             raise HTTPException(
                 status_code=HTTPStatus.NOT_FOUND,
                 detail=f"Model '{model_name}' not available for x402 payments",
             )
 
-        resource_url = f"{config.PUBLIC_BASE_URL}/{full_path}" if config.PUBLIC_BASE_URL else str(request.url)
+        resource_url = f"{config.PUBLIC_BASE_URL}/{full_path}" if config.PUBLIC_BASE_URL else ctx.url
 
         requirements = await x402_manager.fetch_payment_requirements(model_name, max_price, resource_url)
         if not requirements:
@@ -177,7 +439,7 @@ async def proxy_request(
                 detail="Failed to get payment requirements from facilitator",
             )
 
-        payment_header = request.headers.get("x-payment") or request.headers.get("payment-signature")
+        payment_header = ctx.headers.get("x-payment") or ctx.headers.get("payment-signature")
         if not payment_header:
             return x402_manager.build_402_response(requirements)
 
@@ -190,47 +452,113 @@ async def proxy_request(
         headers["x-payment"] = payment_header
         headers["x-payment-requirements"] = json.dumps(requirements[0])
 
-    # Build ordered server pool: healthy first, then capable, then remaining
-    healthy_servers = server_health_monitor.healthy_model_urls.get(model, [])
-    capable_servers = server_health_monitor.capable_model_urls.get(model, [])
-    all_servers = config.MODELS.get(model, [])
-
-    if not all_servers:
-        raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND,
-            detail=f"No server configured for model {model_name}",
-        )
+    # Per-key / per-payer limits (no-op unless configured); x402 payments are verified first
+    # so a forged header can't spend someone else's budget.
+    if has_auth:
+        identity = identity_for_key(token)
+        limits = limits_from(keys_manager.key_limits(token))
+    else:
+        payer = x402_manager.payer_address(headers["x-payment"])
+        identity = identity_for_payer(payer) if payer else ""
+        limits = limits_from(None) if payer else Limits()
+    admitted = rate_limiter.acquire(identity, limits, estimate_tokens(ctx))
+    if not callable(admitted):
+        return rate_limit_response("Rate limit exceeded, please retry later.", admitted)
+    try:
 
-    # Snapshot inflight request counts from Redis once for sorting
-    loads = await get_all_loads()
-
-    # Tiered ordering: healthy > capable > unknown. Sort BY LOAD within each tier, not
-    # across tiers — otherwise a known-bad server with zero inflight load gets tried
-    # first over an actually-healthy server that happens to be busy.
-    healthy_set = set(healthy_servers)
-    capable_set = set(capable_servers)
-    unknown_servers = [s for s in all_servers if s not in healthy_set and s not in capable_set]
-
-    def by_load(urls: list[str]) -> list[str]:
-        return sorted(urls, key=lambda s: loads.get(s, 0))
-
-    tiered = [*by_load(healthy_servers), *by_load(capable_servers), *by_load(unknown_servers)]
-
-    # Deduplicate preserving tier order
-    seen: set[str] = set()
-    servers_to_try: list[str] = []
-    for s in tiered:
-        if s not in seen:
-            seen.add(s)
-            servers_to_try.append(s)
-
-    # Cookie stickiness (KV cache locality) — promote to front only if currently in the pool.
-    # If the cookie points to a known-bad server, ignore it.
-    if preferred_server and preferred_server in servers_to_try:
-        if preferred_server in healthy_set or preferred_server in capable_set:
-            servers_to_try.remove(preferred_server)
-            servers_to_try.insert(0, preferred_server)
-        # else: cookie server is unknown/bad — let tier ordering pick first
+        async def fetch() -> BufferedResponse:
+            response = await _forward(ctx, route, headers, preferred_instances_map, ctx.json, has_auth, admitted)
+            return BufferedResponse(response.status_code, dict(response.headers), await response.read())
+
+        # Embeddings: per-input cache, then micro-batching of whatever still has to go upstream
+        # (API keys only, like coalescing: x402 requests each carry their own payment), and the
+        # proxy-side `dimensions` / base64 output for every caller.
+        transcoded = full_path.endswith("embeddings") and body_json is not None and upstream_embeddings_body(body_json)
+        if transcoded or (
+            has_auth
+            and (embeddings_cache.applies(full_path, body_json) or embedding_batcher.applies(full_path, body_json))
+        ):
+            headers["accept-encoding"] = "identity"  # the reply is parsed and merged or split
+
+            async def send_body(body: dict) -> BufferedResponse:
+                ctx.replace_json(body)
+                headers["content-length"] = str(len(ctx.body))
+                return await fetch()
+
+            async def fetch_embeddings(body: dict) -> BufferedResponse:
+                # The proxy handles `dimensions` / base64 itself: the upstream body drops them, so
+                # clients asking for different formats can still share a batch.
+                upstream = upstream_embeddings_body(body) or body
+                if has_auth and embedding_batcher.applies(full_path, upstream):
+                    result = await embedding_batcher.submit(token, full_path, upstream, send_body)
+                else:
+                    result = await send_body(upstream)
+                return transcode_embeddings(result, body) if upstream is not body else result
+
+            # Only keys known to be valid: an unknown key is only checked by the upstream, so a
+            # cache hit would answer it without any auth check at all.
+            if has_auth and embeddings_cache.applies(full_path, body_json) and keys_manager.key_exists(token):
+                embedded = await embeddings_cache.serve(token, model, cast(dict, body_json), fetch_embeddings)
+            else:
+                embedded = (await fetch_embeddings(cast(dict, body_json))).response()
+            admitted()
+            return embedded
+
+        # Identical deterministic API-key requests share one upstream call (COALESCE_REQUESTS);
+        # x402 requests each carry their own payment, so they are never coalesced.
+        encoding = headers["accept-encoding"]
+        key = coalesce_key(token, model, full_path, body_json, encoding) if has_auth else None
+        if key is None:
+            return await _forward(ctx, route, headers, preferred_instances_map, body_json, has_auth, admitted)
+        coalesced = await single_flight.run(key, fetch)
+        admitted()
+        return coalesced
+    except BaseException:
+        admitted()
+        raise
+
+
+async def _forward(
+    ctx: RequestContext,
+    route: CompiledRoute,
+    headers: dict[str, str],
+    preferred_instances_map: dict[str, str],
+    body_json: dict | None,
+    has_auth: str | None,
+    on_close: Callable[[], None],
+) -> UpstreamResponse:
+    """Pick servers and send the request, failing over until one answers. `on_close` is
+    handed to the returned response, which calls it once the relay ends."""
+    full_path = ctx.full_path
+    model_name = cast(str, ctx.model_name)
+    model = route.model
+    preferred_server = preferred_instances_map.get(model)
+
+    # Inflight request counts for this model's servers (shared snapshot or one Redis read)
+    loads = await get_loads(route.servers)
+    # Saturated model: wait for a free upstream slot (no-op unless UPSTREAM_MAX_CONCURRENCY is set)
+    caller = has_auth or ctx.headers.get("x-payment") or ctx.headers.get("payment-signature") or ""
+    admitted_loads = loads = await admission.admit(route, loads, caller)
+    reserved = True  # the admitted slot, until our first lease is taken (admission.settle)
+    # Route on the upstreams' real queue depth where it exceeds our leases (UPSTREAM_METRICS)
+    loads = server_health_monitor.routing_loads(route.servers, loads)
+    servers_to_try = order_servers(route, loads)
+
+    # Cookie stickiness (KV cache locality) — promote to front only if currently healthy or
+    # capable. If the cookie points to a known-bad server, let tier ordering pick first.
+    if preferred_server and preferred_server in route.preferable and not circuit_breakers.is_open(preferred_server):
+        servers_to_try.remove(preferred_server)
+        servers_to_try.insert(0, preferred_server)
+    elif body_json is not None and (key := prefix_key(model, body_json)) is not None:
+        # No cookie (most SDK clients): same-prefix requests share a server's prefix cache.
+        affine = affinity_server(route, key, loads)
+        if affine is not None and not circuit_breakers.is_open(affine):
+            servers_to_try.remove(affine)
+            servers_to_try.insert(0, affine)
+
+    # Servers at UPSTREAM_MAX_CONCURRENCY go behind the ones with room, and servers whose
+    # circuit breaker is open go last (both are still tried if nothing else answers)
+    servers_to_try = circuit_breakers.order(admission.order(route, servers_to_try, admitted_loads))
 
     logger.debug(
         f"Load balancing for {model}: servers_to_try={[f'{s}(load={loads.get(s, 0)})' for s in servers_to_try]}, "
@@ -238,10 +566,26 @@ async def proxy_request(
     )
 
     last_error = None
+    query = f"?{ctx.query_string}" if ctx.query_string else ""
+
+    def build(target: str) -> httpx.Request:
+        return client.build_request("POST", f"{target}/{full_path}{query}", content=ctx.upload(), headers=headers)
+
+    # Hedging is for non-streaming, API-key calls only: a copy of an x402 request would
+    # carry the same payment to two upstreams. Streamed uploads can't be sent twice at once.
+    request_json = ctx.json or {}
+    hedgeable = (
+        bool(has_auth) and not ctx.streaming and request_json.get("stream") is not True and hedge_policy.enabled(model)
+    )
+    hedge_delay = hedge_policy.delay(model) if hedgeable and len(servers_to_try) > 1 else None
 
     # Try each server with automatic failover
+    tried: set[str] = set()
     for attempt, server in enumerate(servers_to_try, 1):
-        url = f"{server}/{full_path}"
+        if server in tried:
+            continue  # already raced (and failed) as a hedge
+        tried.add(server)
+        url = f"{server}/{full_path}{query}"
 
         # Release is best-effort (cancelled cleanup, uncancelled non-streaming
         # disconnects, killed process) — the lease deadline is the real leak guard.
@@ -249,23 +593,36 @@ async def proxy_request(
         owned = False
         try:
             logger.debug(f"Attempt {attempt}/{len(servers_to_try)}: Forwarding to {url}")
-            req = client.build_request("POST", url, content=body, headers=headers, params=request.query_params)
+            req = build(server)
             await load_acquire(server, request_id)
             owned = True
-            response = await client.send(req, stream=True)
+            if reserved:
+                reserved = False
+                admission.settle(model)
+            circuit_breakers.on_attempt(server)
+            started = time.monotonic()
+            if attempt == 1 and hedge_delay is not None:
+                server, request_id, response, started = await _send_hedged(
+                    req, server, request_id, servers_to_try[1], build, hedge_delay, tried
+                )
+                url = f"{server}/{full_path}{query}"
+            else:
+                response = await client.send(req, stream=True)
+            if hedgeable:
+                hedge_policy.observe(model, time.monotonic() - started)
 
             # Retry on server errors (5xx) — upstream is broken, try next server
             if response.status_code >= 500:
                 await response.aclose()
+                await circuit_breakers.record_failure(server)
                 logger.warning(
                     f"Server error {response.status_code} from {url} (attempt {attempt}/{len(servers_to_try)})"
                 )
                 last_error = Exception(f"HTTP {response.status_code} from {server}")
                 continue
 
-            # Success! Update the preferred instances map and create the cookie header
-            preferred_instances_map[model] = server
-            updated_cookie_value = json.dumps(preferred_instances_map)
+            # Headers in: point the stickiness cookie at this server
+            updated_cookie_value = json.dumps({**preferred_instances_map, model: server})
 
             # Build the Set-Cookie header string manually
             cookie_header = (
@@ -277,47 +634,31 @@ async def proxy_request(
             response_headers["set-cookie"] = cookie_header
 
             is_streaming_response = "text/event-stream" in response.headers.get("content-type", "")
+            upstream = UpstreamResponse(
+                response,
+                response_headers,
+                server,
+                request_id,
+                url,
+                started,
+                sse=is_streaming_response,
+                model=model,
+                on_close=on_close,
+            )
 
-            if is_streaming_response:
-
-                async def generate_chunks(_server=server, _rid=request_id, _url=url):
-                    last_refresh = time.monotonic()
-                    try:
-                        # aiter_raw (not aiter_bytes) so we forward the body exactly as the
-                        # upstream encoded it, matching the Content-Encoding header we pass on.
-                        async for chunk in response.aiter_raw():
-                            now = time.monotonic()
-                            # Refresh the lease so streams outlasting LEASE_TTL stay counted.
-                            if now - last_refresh >= LEASE_REFRESH_INTERVAL:
-                                await load_acquire(_server, _rid)
-                                last_refresh = now
-                            yield chunk
-                    except asyncio.CancelledError:
-                        raise  # client disconnect — normal
-                    except Exception as e:
-                        # Headers already sent; end the stream instead of raising into ASGI.
-                        logger.warning(f"Stream from {_url} interrupted: {type(e).__name__}: {e}")
-                    finally:
-                        await response.aclose()
-                        await load_release(_server, _rid)
-
-                owned = False  # generator's finally now owns the release
-                return StreamingResponse(
-                    content=generate_chunks(),
-                    status_code=response.status_code,
-                    headers=response_headers,
-                    media_type=response.headers.get("Content-Type", ""),
-                )
-            else:
-                # Raw bytes, still encoded — kept consistent with the Content-Encoding header.
-                response_bytes = b"".join([chunk async for chunk in response.aiter_raw()])
+            # A box can send 200 headers and then stall before its first token. Nothing has
+            # reached the client yet, so that's still a failover.
+            if not await upstream.prefetch():
                 await response.aclose()
-                return Response(
-                    content=response_bytes,
-                    status_code=response.status_code,
-                    headers=response_headers,
-                    media_type=response.headers.get("Content-Type", ""),
-                )
+                await circuit_breakers.record_failure(server)
+                logger.warning(f"No first byte from {url} in time (attempt {attempt}/{len(servers_to_try)})")
+                last_error = TimeoutError(f"Stalled before first byte: {server}")
+                continue
+
+            await circuit_breakers.record_success(server)
+            preferred_instances_map[model] = server
+            owned = False  # the relay's cleanup now owns the release
+            return upstream
 
         except (httpx.ConnectTimeout, httpx.ConnectError, httpx.TimeoutException, httpx.ProxyError) as e:
             # Connection error (incl. upstream HTTP-proxy failures) - try next server
@@ -325,14 +666,21 @@ async def proxy_request(
                 f"Connection failed to {url} (attempt {attempt}/{len(servers_to_try)}): {type(e).__name__}: {e}"
             )
             last_error = e
+            await circuit_breakers.record_failure(server)
             continue
 
+        except ClientDisconnected:
+            raise  # mid-upload; nobody is left to answer
+
         except Exception as e:
             # Other errors - log and fail immediately
             logger.error(f"Error forwarding request to {url}: {type(e).__name__}: {e}", exc_info=True)
             raise HTTPException(status_code=500, detail=f"Error forwarding request: {type(e).__name__}: {str(e)}")
 
         finally:
+            if reserved:  # gave up before the first lease was taken
+                reserved = False
+                admission.settle(model)
             if owned:
                 await load_release(server, request_id)
 
@@ -0,0 +1,292 @@
+"""Per-API-key and per-x402-payer rate limits and concurrency caps.
+
+Each caller (identity) gets two token buckets, requests/s and estimated tokens/s, plus a
+cap on concurrent requests. Limits come from the backend's per-key metadata (`limits` in
+the keys snapshot, see KeysManager.key_limits) over the RATE_LIMIT_* defaults; a 0 limit
+is unlimited, and a caller with no limits at all costs nothing here.
+
+The hot path only touches replica-local state. Every RATE_LIMIT_SYNC_MS one Lua call
+pushes each active identity's consumption and local inflight count to Redis and returns
+the cluster-wide bucket levels and inflight total, which the local buckets then continue
+from. Overshoot is bounded by what all replicas admit within one sync interval.
+"""
+
+import asyncio
+import hashlib
+import time
+import uuid
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from redis.commands.core import AsyncScript
+
+from src.config import config
+from src.logger import setup_logger
+from src.redis_client import get_redis, k
+from src.request_context import RequestContext
+from src.x402 import prompt_text
+
+logger = setup_logger(__name__)
+
+# Buckets hold this many seconds' worth of their rate, so short bursts are fine.
+BURST_SECONDS = 2.0
+# A replica's inflight count older than this no longer counts (replica died, sync stopped).
+INFLIGHT_STALE_SECONDS = 10
+# Identities with nothing inflight and no request for this long are dropped from memory.
+IDLE_SECONDS = 300
+
+# Per identity: KEYS = bucket hash, inflight hash. ARGV = now, replica, stale cutoff, then per
+# identity: request rate, request capacity, requests used, token rate, token capacity,
+# tokens used, this replica's inflight. Returns per identity: request level, token level,
+# cluster inflight (levels as strings: Lua numbers are truncated to integers in replies).
+SYNC_SCRIPT = """
+local now = tonumber(ARGV[1])
+local out = {}
+for i = 1, #KEYS / 2 do
+    local bucket, inflight = KEYS[2 * i - 1], KEYS[2 * i]
+    local a = 3 + (i - 1) * 7
+    local levels = {}
+    local ttl = 60
+    for j, field in ipairs({'req', 'tok'}) do
+        local rate = tonumber(ARGV[a + 3 * (j - 1) + 1])
+        local cap = tonumber(ARGV[a + 3 * (j - 1) + 2])
+        local used = tonumber(ARGV[a + 3 * (j - 1) + 3])
+        local level = cap
+        if rate > 0 then
+            local state = redis.call('HMGET', bucket, field, field .. '_ts')
+            level = tonumber(state[1]) or cap
+            local ts = tonumber(state[2]) or now
+            level = math.min(cap, level + math.max(0, now - ts) * rate) - used
+            redis.call('HSET', bucket, field, level, field .. '_ts', now)
+            ttl = math.max(ttl, math.ceil(cap / rate) + 60)
+        end
+        levels[j] = tostring(level)
+    end
+    redis.call('EXPIRE', bucket, ttl)
+    redis.call('HSET', inflight, ARGV[2], ARGV[a + 7] .. ':' .. ARGV[1])
+    redis.call('EXPIRE', inflight, 60)
+    local total = 0
+    local entries = redis.call('HGETALL', inflight)
+    for e = 1, #entries, 2 do
+        local count, ts = string.match(entries[e + 1], '([^:]+):(.+)')
+        if tonumber(ts) and tonumber(ts) >= tonumber(ARGV[3]) then
+            total = total + tonumber(count)
+        else
+            redis.call('HDEL', inflight, entries[e])
+        end
+    end
+    out[i] = {levels[1], levels[2], total}
+end
+return out
+"""
+
+
+@dataclass(frozen=True, slots=True)
+class Limits:
+    rps: float = 0.0
+    tps: float = 0.0
+    concurrency: int = 0
+
+    def unlimited(self) -> bool:
+        return not (self.rps > 0 or self.tps > 0 or self.concurrency > 0)
+
+
+def limits_from(metadata: dict | None) -> Limits:
+    """Backend per-key metadata ({rps, tps, concurrency}, all optional) over the defaults."""
+    metadata = metadata or {}
+
+    def pick(name: str, default: float) -> float:
+        value = metadata.get(name)
+        return float(value) if isinstance(value, (int, float)) else default
+
+    return Limits(
+        rps=pick("rps", config.RATE_LIMIT_RPS),
+        tps=pick("tps", config.RATE_LIMIT_TPS),
+        concurrency=int(pick("concurrency", config.RATE_LIMIT_CONCURRENCY)),
+    )
+
+
+def estimate_tokens(ctx: RequestContext) -> int:
+    """Rough token cost of a request: ~4 characters per prompt token plus the completion
+    budget. Only prompt text counts (see x402.prompt_text), not base64 images or audio;
+    streamed uploads aren't parsed, so their size stands in (one debit is capped at the
+    bucket's capacity anyway)."""
+    if ctx.streaming:
+        size = ctx.headers.get("content-length", "")
+        return int(size) // 4 if size.isdigit() else 0
+    body = ctx.json or {}
+    text, token_ids = prompt_text([body.get("messages"), body.get("prompt"), body.get("input")])
+    max_tokens = body.get("max_tokens") or body.get("max_completion_tokens") or 0
+    return len(text) // 4 + token_ids + (max_tokens if isinstance(max_tokens, int) else 0)
+
+
+def identity_for_key(api_key: str) -> str:
+    # Never put raw API keys into Redis key names
+    return "key:" + hashlib.blake2b(api_key.encode(), digest_size=12).hexdigest()
+
+
+def identity_for_payer(address: str) -> str:
+    return "payer:" + address.lower()
+
+
+class _Bucket:
+    __slots__ = ("rate", "capacity", "level", "updated", "used")
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.capacity = rate * BURST_SECONDS
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.used = 0.0  # consumed since the last sync
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate: float) -> None:
+        if rate != self.rate:
+            self.rate = rate
+            self.capacity = rate * BURST_SECONDS
+            self.level = min(self.level, self.capacity)
+
+
+class _Identity:
+    __slots__ = ("limits", "requests", "tokens", "inflight", "remote_inflight", "last_active")
+
+    def __init__(self, limits: Limits) -> None:
+        self.limits = limits
+        self.requests = _Bucket(limits.rps)
+        self.tokens = _Bucket(limits.tps)
+        self.inflight = 0  # on this replica
+        self.remote_inflight = 0  # on other replicas, as of the last sync
+        self.last_active = time.monotonic()
+
+
+class RateLimiter:
+    def __init__(self) -> None:
+        self._identities: dict[str, _Identity] = {}
+        self.replica = uuid.uuid4().hex  # this replica's field in each inflight hash
+
+    def acquire(self, identity: str, limits: Limits, tokens: int) -> float | Callable[[], None]:
+        """Admit one request estimated at `tokens`: returns a release callback to call once
+        it finishes, or the seconds to wait (Retry-After) when a limit is hit."""
+        if limits.unlimited():
+            return _noop
+        state = self._identities.get(identity)
+        if state is None:
+            state = self._identities[identity] = _Identity(limits)
+        elif state.limits != limits:
+            state.limits = limits
+            state.requests.set_rate(limits.rps)
+            state.tokens.set_rate(limits.tps)
+        now = time.monotonic()
+        state.last_active = now
+
+        if limits.concurrency > 0 and state.inflight + state.remote_inflight >= limits.concurrency:
+            return 1.0
+        wait = 0.0
+        if limits.rps > 0:
+            state.requests.refill(now)
+            if state.requests.level < 1:
+                wait = max(wait, (1 - state.requests.level) / limits.rps)
+        if limits.tps > 0:
+            state.tokens.refill(now)
+            # A request larger than the whole bucket only needs (and drains) a full bucket
+            tokens = min(tokens, int(state.tokens.capacity))
+            if state.tokens.level < tokens:
+                wait = max(wait, (tokens - state.tokens.level) / limits.tps)
+        if wait > 0:
+            return wait
+
+        if limits.rps > 0:
+            state.requests.level -= 1
+            state.requests.used += 1
+        if limits.tps > 0:
+            state.tokens.level -= tokens
+            state.tokens.used += tokens
+        state.inflight += 1
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                state.inflight -= 1
+                state.last_active = time.monotonic()
+
+        return release
+
+    async def sync(self) -> None:
+        """Exchange consumption and inflight counts with Redis for every active identity."""
+        now = time.monotonic()
+        for identity in [i for i, s in self._identities.items() if _idle(s, now)]:
+            del self._identities[identity]
+        if not self._identities:
+            return
+
+        identities = list(self._identities.items())
+        keys: list[str] = []
+        args: list[str | float | int] = [time.time(), self.replica, time.time() - INFLIGHT_STALE_SECONDS]
+        for identity, state in identities:
+            keys += [k("ratelimit", identity), k("ratelimit", identity, "inflight")]
+            for bucket in (state.requests, state.tokens):
+                args += [bucket.rate, bucket.capacity, bucket.used]
+            args.append(state.inflight)
+        used = [(s.requests.used, s.tokens.used) for _, s in identities]
+        sent_inflight = [s.inflight for _, s in identities]
+        for _, state in identities:
+            state.requests.used = state.tokens.used = 0.0
+
+        try:
+            results = await _sync_script()(keys=keys, args=args)
+        except Exception as e:
+            logger.error(f"Failed to sync rate limits with Redis: {e}", exc_info=True)
+            for (_, state), (req, tok) in zip(identities, used):  # retry next time
+                state.requests.used += req
+                state.tokens.used += tok
+            return
+
+        synced = time.monotonic()
+        for (_, state), mine, (req_level, tok_level, total) in zip(identities, sent_inflight, results):
+            # Cluster level minus whatever this replica consumed while the script ran
+            for bucket, level in ((state.requests, req_level), (state.tokens, tok_level)):
+                if bucket.rate > 0:
+                    bucket.level = min(float(level), bucket.capacity) - bucket.used
+                    bucket.updated = synced
+            state.remote_inflight = max(int(total) - mine, 0)
+
+    def inflight(self, identity: str) -> int:
+        state = self._identities.get(identity)
+        return state.inflight if state is not None else 0
+
+
+def _noop() -> None:
+    pass
+
+
+_script: AsyncScript | None = None
+_script_client: object = None
+
+
+def _sync_script() -> AsyncScript:
+    """SYNC_SCRIPT registered once per Redis client (EVALSHA, falling back to EVAL)."""
+    global _script, _script_client
+    r = get_redis()
+    if _script is None or r is not _script_client:
+        _script, _script_client = r.register_script(SYNC_SCRIPT), r
+    return _script
+
+
+def _idle(state: _Identity, now: float) -> bool:
+    return state.inflight == 0 and now - state.last_active > IDLE_SECONDS
+
+
+rate_limiter = RateLimiter()
+
+
+async def run_sync() -> None:
+    """Background task: sync rate-limit state with Redis every RATE_LIMIT_SYNC_MS."""
+    interval = config.RATE_LIMIT_SYNC_MS / 1000
+    while True:
+        await asyncio.sleep(interval)
+        await rate_limiter.sync()
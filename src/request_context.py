@@ -0,0 +1,120 @@
+import json
+from collections.abc import AsyncIterator
+from typing import Any
+
+from starlette.datastructures import URL
+from starlette.requests import cookie_parser
+from starlette.types import Scope
+
+from src import fast_json
+from src.request_stream import StreamedBody
+
+
+class RequestContext:
+    """Parse-once view of a proxied inference request.
+
+    The body is decoded at most once and that same dict is shared by model routing, the
+    model/thinking rewrite, image stripping and x402 pricing. The bytes sent upstream are
+    the original body unless a rewrite actually changed something, in which case they are
+    re-serialized once, lazily, on first access to `body`.
+
+    Built from the raw ASGI scope so the FastAPI route and the raw ASGI fast path
+    (src/asgi_proxy.py) hand the proxy exactly the same view.
+
+    The fast path may also pass a still-arriving `stream` whose top-level `model` has been
+    scanned (src/request_stream.py). Until `load_body` is awaited such a context has no
+    `json` and is forwarded by `upload` as a stream.
+    """
+
+    def __init__(
+        self,
+        scope: Scope,
+        full_path: str,
+        raw_body: bytes,
+        stream: StreamedBody | None = None,
+        scanned_model: str | None = None,
+    ) -> None:
+        self.scope = scope
+        self.full_path = full_path
+        self.raw_body = raw_body
+        self.stream = stream
+        self._scanned_model = scanned_model
+        # ASGI header names are already lowercase; duplicates keep the last value, like dict(request.headers)
+        self.headers: dict[str, str] = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+        self.query_string: str = scope.get("query_string", b"").decode("latin-1")
+        self._json: dict[str, Any] | None = None
+        self._parsed = False
+        self._rewritten: bytes | None = None
+        self._dirty = False
+
+    @property
+    def streaming(self) -> bool:
+        return self.stream is not None
+
+    async def load_body(self) -> None:
+        """Read the rest of a streamed body so it can be parsed and rewritten."""
+        if self.stream is not None:
+            self.raw_body = await self.stream.read_all()
+            self.stream = None
+            self._scanned_model = None  # the parsed document is authoritative from here on
+
+    @property
+    def json(self) -> dict[str, Any] | None:
+        """Decoded body, or None when it isn't a JSON object (or is still streaming)."""
+        if self.stream is not None:
+            return None
+        if not self._parsed:
+            self._parsed = True
+            try:
+                data = fast_json.loads(self.raw_body)
+            except ValueError:  # orjson.JSONDecodeError, including invalid UTF-8
+                data = None
+            self._json = data if isinstance(data, dict) else None
+        return self._json
+
+    @property
+    def model_name(self) -> str | None:
+        if self._scanned_model is not None:
+            return self._scanned_model
+        data = self.json
+        model = data.get("model") if data is not None else None
+        return model if isinstance(model, str) else None
+
+    def replace_json(self, data: dict[str, Any]) -> None:
+        """Swap in a rewritten document; `body` re-serializes it on next access."""
+        self._json = data
+        self._parsed = True
+        self.mark_dirty()
+
+    def mark_dirty(self) -> None:
+        """Flag an in-place change to `json` so `body` re-serializes it."""
+        self._dirty = True
+        self._rewritten = None
+
+    @property
+    def body(self) -> bytes:
+        if not self._dirty:
+            return self.raw_body
+        if self._rewritten is None:
+            self._rewritten = fast_json.dumps(self._json)
+        return self._rewritten
+
+    def upload(self) -> bytes | AsyncIterator[bytes]:
+        """Content for one upstream attempt: `body`, or a fresh replay of a streamed body."""
+        return self.stream.replay() if self.stream is not None else self.body
+
+    @property
+    def preferred_instances(self) -> dict[str, str]:
+        """The `preferred_instances` stickiness cookie (JSON map of model -> server), or {}."""
+        raw = cookie_parser(self.headers.get("cookie", "")).get("preferred_instances")
+        if not raw:
+            return {}
+        try:
+            data = json.loads(raw)
+        except json.JSONDecodeError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    @property
+    def url(self) -> str:
+        return str(URL(scope=self.scope))
@@ -0,0 +1,214 @@
+"""Streaming passthrough for large request bodies (STREAM_REQUEST_MIN_BYTES > 0).
+
+Routing only needs the body's top-level `model`. For a multi-MB base64 image or audio
+upload that the proxy forwards unchanged, reading, joining and parsing the whole body
+first copies it through replica memory several times before a byte goes upstream.
+Instead the raw ASGI app scans chunks as they arrive for `model` (`TopLevelScanner`,
+which skips string contents and nested values with C-level searches), then forwards the
+body as a stream (`StreamedBody.replay`). Chunks are kept once, unjoined, so a failover
+attempt can replay them. When a rewrite or x402 pricing needs the document, the proxy
+falls back to the buffered path (`RequestContext.load_body`).
+
+The scan runs to the end of the object: with a duplicated key the last occurrence wins,
+as in the buffered path's parser and the upstream's, so a second `model` can't route the
+request to one model and have it served (and priced) as another.
+"""
+
+import json
+import re
+from collections.abc import AsyncIterator
+from typing import Any
+
+from starlette.types import Receive
+
+# Stop bytes while skipping a nested value: only strings and brackets matter there.
+_NESTED_STOP = re.compile(rb'["{}\[\]]')
+_WHITESPACE = frozenset(b" \t\r\n")
+_MAX_CAPTURE = 1024  # longest top-level key or wanted string value kept
+
+
+class ClientDisconnected(Exception):
+    """The client went away while its request body was still being streamed."""
+
+
+class TopLevelScanner:
+    """Incremental scanner for top-level scalar fields of a JSON object.
+
+    Feed it chunks in order; `values` fills in as wanted fields are seen. Only the object's
+    own keys and wanted values are ever copied; the input is not fully validated (the
+    upstream does that), but anything that isn't an object sets `failed`. The last
+    occurrence of a duplicated key wins, as with json.loads and orjson.
+    """
+
+    def __init__(self, fields: frozenset[str]) -> None:
+        self.fields = fields
+        self.values: dict[str, Any] = {}
+        self.failed = False
+        self.done = False  # closing brace of the top-level object seen
+        self._depth = 0  # 0 = before '{', 1 = top-level object, > 1 = inside a nested value
+        self._expect = "key"  # at depth 1: key, colon, value, comma
+        self._in_string = False
+        self._escape = False
+        self._capture: bytearray | None = None  # current top-level key or wanted string value
+        self._scalar: bytearray | None = None  # current top-level number / literal
+        self._key: str | None = None
+
+    def feed(self, chunk: bytes) -> None:
+        i, n = 0, len(chunk)
+        while i < n and not (self.failed or self.done):
+            if self._in_string:
+                i = self._string(chunk, i)
+            elif self._depth > 1:
+                m = _NESTED_STOP.search(chunk, i)
+                if m is None:
+                    return
+                i = m.end()
+                c = chunk[m.start()]
+                if c == 0x22:  # "
+                    self._in_string = True
+                elif c in b"{[":
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 1:
+                        self._expect = "comma"
+            else:
+                self._structural(chunk[i])
+                i += 1
+
+    def _string(self, chunk: bytes, i: int) -> int:
+        if self._escape:
+            self._escape = False
+            if self._capture is not None:
+                self._capture += chunk[i : i + 1]
+            return i + 1
+        # Two memchr-speed finds beat a regex over long base64 strings
+        quote = chunk.find(b'"', i)
+        end = chunk.find(b"\\", i, len(chunk) if quote < 0 else quote)
+        if end < 0:
+            end = len(chunk) if quote < 0 else quote
+        if self._capture is not None:
+            self._capture += chunk[i:end]
+            if len(self._capture) > _MAX_CAPTURE:
+                self._capture = None  # too long to be a key or value we want
+        if end == len(chunk):
+            return end
+        if chunk[end] == 0x5C:  # backslash: keep it, the escaped byte comes next
+            self._escape = True
+            if self._capture is not None:
+                self._capture += b"\\"
+            return end + 1
+        self._in_string = False
+        if self._depth == 1:
+            self._end_top_level_string()
+        return end + 1
+
+    def _end_top_level_string(self) -> None:
+        raw, self._capture = self._capture, None
+        try:
+            text = json.loads(b'"' + raw + b'"') if raw is not None else None
+        except ValueError:  # bad escape or invalid UTF-8
+            self.failed = True
+            return
+        if self._expect == "key":
+            self._key = text
+            self._expect = "colon"
+            return
+        if text is not None and self._key is not None:
+            self.values[self._key] = text
+        self._expect = "comma"
+
+    def _end_scalar(self) -> None:
+        raw, self._scalar = self._scalar, None
+        try:
+            value = json.loads(bytes(raw or b""))
+        except ValueError:
+            self.failed = True
+            return
+        if self._key in self.fields:
+            self.values[self._key] = value
+        self._expect = "comma"
+
+    def _structural(self, c: int) -> None:
+        if self._scalar is not None:
+            if c not in _WHITESPACE and c not in b",}":
+                self._scalar.append(c)
+                return
+            self._end_scalar()
+            if self.failed or c in _WHITESPACE:
+                return
+        if c in _WHITESPACE:
+            return
+        if self._depth == 0:
+            if c == 0x7B:  # {
+                self._depth = 1
+            else:
+                self.failed = True
+            return
+        expect = self._expect
+        if expect == "key" and c == 0x22:
+            self._in_string = True
+            self._capture = bytearray()
+        elif expect == "colon" and c == 0x3A:  # :
+            self._expect = "value"
+        elif expect == "value":
+            if c == 0x22:
+                self._in_string = True
+                self._capture = bytearray() if self._key in self.fields else None
+            elif c in b"{[":
+                self._depth = 2
+            else:
+                self._scalar = bytearray((c,))
+        elif expect == "comma" and c == 0x2C:  # ,
+            self._expect = "key"
+        elif expect in ("key", "comma") and c == 0x7D:  # } (also accepts the empty object)
+            self.done = True
+        else:
+            self.failed = True
+
+
+class StreamedBody:
+    """A request body pulled from ASGI `receive` on demand and kept, unjoined, for replays."""
+
+    def __init__(self, receive: Receive) -> None:
+        self._receive = receive
+        self.chunks: list[bytes] = []
+        self.complete = False
+
+    async def _pull(self) -> bytes:
+        message = await self._receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        chunk = message.get("body", b"")
+        if chunk:
+            self.chunks.append(chunk)
+        if not message.get("more_body", False):
+            self.complete = True
+        return chunk
+
+    async def scan(self, field: str) -> Any:
+        """Read to the end of the top-level object and return its `field` (the last one if
+        repeated), or None if it has none or the body turns out not to be a JSON object."""
+        scanner = TopLevelScanner(frozenset((field,)))
+        for chunk in self.chunks:
+            scanner.feed(chunk)
+        while not (self.complete or scanner.failed or scanner.done):
+            scanner.feed(await self._pull())
+        return scanner.values.get(field)
+
+    async def read_all(self) -> bytes:
+        while not self.complete:
+            await self._pull()
+        return self.chunks[0] if len(self.chunks) == 1 else b"".join(self.chunks)
+
+    async def replay(self) -> AsyncIterator[bytes]:
+        """The whole body: chunks read so far, then the rest as it arrives. One replay at a
+        time (each upstream attempt starts a new one after the previous gave up)."""
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.complete:
+                return
+            await self._pull()
@@ -0,0 +1,139 @@
+"""Precompiled per-model routing table.
+
+Resolving a request's model (lowercasing, Aleph redirections, `-thinking` variants) and
+tiering its servers by health used to happen from scratch on every request. Instead the
+table below is recompiled whenever its inputs change — a health sweep/sync or an Aleph
+refresh/sync — and a request only does one dict lookup and applies live loads.
+
+Inputs are pushed in by their owners (ServerHealthMonitor, AlephService) so this module
+depends on config alone.
+"""
+
+from dataclasses import dataclass
+
+from src.config import config
+
+THINKING_SUFFIX = "-thinking"
+
+
+@dataclass(frozen=True, slots=True)
+class CompiledRoute:
+    """Everything the proxy needs to route one request model name."""
+
+    model: str  # resolved upstream model name
+    thinking_requested: bool
+    is_reasoning: bool
+    is_vision: bool
+    # Server tiers in preference order, each deduplicated and disjoint: healthy (model
+    # loaded) > capable (box up, model not loaded) > unknown (no health data / failing).
+    healthy: tuple[str, ...]
+    capable: tuple[str, ...]
+    unknown: tuple[str, ...]
+    # Servers a stickiness cookie may promote to the front (healthy or capable).
+    preferable: frozenset[str]
+    servers: tuple[str, ...]  # every tier, in tier order (what loads are fetched for)
+
+    def servers_by_load(self, loads: dict[str, int]) -> list[str]:
+        """Tiered order, sorted BY LOAD within each tier, not across tiers — otherwise a
+        known-bad server with zero inflight load would be tried before a busy healthy one."""
+
+        def by_load(s: str) -> int:
+            return loads.get(s, 0)
+
+        return [
+            *sorted(self.healthy, key=by_load),
+            *sorted(self.capable, key=by_load),
+            *sorted(self.unknown, key=by_load),
+        ]
+
+
+def _resolve(name: str, redirections: dict[str, str], reasoning: set[str]) -> tuple[str, bool]:
+    """(resolved model, thinking requested) for a lowercased request model name."""
+    # Resolve model redirections (e.g. deprecated model names)
+    model = redirections.get(name, name)
+    if model.endswith(THINKING_SUFFIX):
+        # Resolve redirections on the base model too (e.g. old-model-thinking -> new-model)
+        resolved_base = redirections.get(model.removesuffix(THINKING_SUFFIX), model.removesuffix(THINKING_SUFFIX))
+        if resolved_base in reasoning:
+            return resolved_base, True
+        # If the base model isn't a reasoning model, let it fall through to 404
+    return model, False
+
+
+def _dedupe(urls: list[str], exclude: set[str]) -> tuple[str, ...]:
+    out: list[str] = []
+    for u in urls:
+        if u not in exclude:
+            exclude.add(u)
+            out.append(u)
+    return tuple(out)
+
+
+class RoutingTable:
+    def __init__(self) -> None:
+        self._healthy: dict[str, list[str]] = {}
+        self._capable: dict[str, list[str]] = {}
+        self._redirections: dict[str, str] = {}
+        self._reasoning: set[str] = set()
+        self._vision: set[str] = set()
+        self._models: dict[str, list[str]] | None = None
+        self._routes: dict[str, CompiledRoute] = {}
+
+    def update_health(self, healthy: dict[str, list[str]], capable: dict[str, list[str]]) -> None:
+        self._healthy = healthy
+        self._capable = capable
+        self.rebuild()
+
+    def update_aleph(self, redirections: dict[str, str], reasoning: set[str], vision: set[str]) -> None:
+        self._redirections = redirections
+        self._reasoning = reasoning
+        self._vision = vision
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        models = config.MODELS
+        compiled: dict[str, CompiledRoute] = {}
+        by_model: dict[tuple[str, bool], CompiledRoute] = {}
+
+        # Every name that can resolve to a configured model: the models themselves, redirect
+        # sources, and the -thinking form of each. Any other name resolves to nothing.
+        names = set(models) | set(self._redirections)
+        names |= {n + THINKING_SUFFIX for n in names}
+
+        for name in names:
+            model, thinking = _resolve(name, self._redirections, self._reasoning)
+            servers = models.get(model)
+            if not servers:
+                continue
+            route = by_model.get((model, thinking))
+            if route is None:
+                seen: set[str] = set()
+                healthy = _dedupe(self._healthy.get(model, []), seen)
+                capable = _dedupe(self._capable.get(model, []), seen)
+                unknown = _dedupe(servers, seen)
+                route = CompiledRoute(
+                    model=model,
+                    thinking_requested=thinking,
+                    is_reasoning=model in self._reasoning,
+                    is_vision=model in self._vision,
+                    healthy=healthy,
+                    capable=capable,
+                    unknown=unknown,
+                    preferable=frozenset(healthy) | frozenset(capable),
+                    servers=(*healthy, *capable, *unknown),
+                )
+                by_model[(model, thinking)] = route
+            compiled[name] = route
+
+        self._routes = compiled
+        self._models = models
+
+    def get(self, name: str) -> CompiledRoute | None:
+        """Route for a request model name (any case), or None if it resolves to no configured model."""
+        # config.MODELS is only ever replaced wholesale (startup, tests); recompile if it was.
+        if config.MODELS is not self._models:
+            self.rebuild()
+        return self._routes.get(name.lower())
+
+
+routing_table = RoutingTable()
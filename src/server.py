@@ -13,17 +13,30 @@ from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 from starlette.middleware.cors import CORSMiddleware
 
+from src.aleph import aleph_service
+from src.aleph_credits import router as aleph_credits_router
 from src.api_keys import KeysManager
+from src.asgi_proxy import ProxyASGIApp
 from src.auth import router as auth_router
+from src.circuit_breaker import run_sync as run_circuit_sync
+from src.config import config
+from src.health import run_probes as run_health_probes
 from src.health import server_health_monitor
 from src.leader import leader
+from src.load_tracker import flush as flush_leases
+from src.load_tracker import migrate_legacy_leases
+from src.load_tracker import run_flusher as run_lease_flusher
+from src.load_tracker import run_refresher as run_lease_refresher
+from src.load_tracker import run_snapshot_refresher as run_load_snapshot_refresher
 from src.logger import setup_logger
 from src.model import router as model_router
-from src.aleph_credits import router as aleph_credits_router
-from src.proxy import router as proxy_router, close_http_client
+from src.proxy import close_http_client, prewarm_upstreams
+from src.proxy import router as proxy_router
+from src.rate_limit import run_sync as run_rate_limit_sync
 from src.redis_client import close_redis
-from src.search import router as search_router, close_http_client as close_search_http_client
-from src.aleph import aleph_service
+from src.search import close_http_client as close_search_http_client
+from src.search import router as search_router
+from src.stats import router as stats_router
 from src.x402 import x402_manager
 
 # The Telegram bot now runs as its own dokploy service (replicas: 1, entrypoint
@@ -47,9 +60,11 @@ async def run_jobs():
         try:
             if leader.is_leader:
                 await keys_manager.refresh_keys()
-                await server_health_monitor.check_all_servers()
+                if config.HEALTH_PROBE_MIN_SECONDS <= 0:  # else run_health_probes owns probing
+                    await server_health_monitor.check_all_servers()
                 await x402_manager.refresh_prices()
                 await aleph_service.refresh()
+                await migrate_legacy_leases()
             else:
                 await keys_manager.sync_from_redis()
                 await server_health_monitor.sync_from_redis()
@@ -65,26 +80,39 @@ async def run_jobs():
 
 
 @asynccontextmanager
-async def lifespan(_app: FastAPI):
-    leader_task = asyncio.create_task(leader.run())
-    jobs_task = asyncio.create_task(run_jobs())
+async def lifespan(_api: FastAPI):
+    tasks = [
+        asyncio.create_task(leader.run()),
+        asyncio.create_task(run_jobs()),
+        asyncio.create_task(run_lease_refresher()),
+        asyncio.create_task(run_circuit_sync()),
+        asyncio.create_task(run_rate_limit_sync()),
+        asyncio.create_task(prewarm_upstreams()),
+        asyncio.create_task(run_health_probes()),
+    ]
+    if config.LOAD_FLUSH_INTERVAL_MS > 0:
+        tasks.append(asyncio.create_task(run_lease_flusher()))
+    if config.LOAD_SNAPSHOT_INTERVAL_MS > 0:
+        tasks.append(asyncio.create_task(run_load_snapshot_refresher()))
 
     try:
         yield
     finally:
         await leader.shutdown()
-        for t in (leader_task, jobs_task):
+        for t in tasks:
             t.cancel()
-        await asyncio.gather(leader_task, jobs_task, return_exceptions=True)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await flush_leases()  # don't strand buffered releases until their TTL
         await close_http_client()
+        await server_health_monitor.aclose()
         await close_search_http_client()
         await close_redis()
 
 
-app = FastAPI(title="LibertAI API", lifespan=lifespan)
+api = FastAPI(title="LibertAI API", lifespan=lifespan)
 
 
-app.add_middleware(
+api.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_methods=["*"],
@@ -92,7 +120,7 @@ app.add_middleware(
 )
 
 
-@app.get("/health")
+@api.get("/health")
 async def health():
     """Health check that reports ready only after first full initialization cycle."""
     if not _ready:
@@ -108,8 +136,13 @@ async def health():
     }
 
 
-app.include_router(auth_router)
-app.include_router(model_router)
-app.include_router(aleph_credits_router)
-app.include_router(search_router)
-app.include_router(proxy_router)
+api.include_router(auth_router)
+api.include_router(model_router)
+api.include_router(aleph_credits_router)
+api.include_router(search_router)
+api.include_router(stats_router)
+api.include_router(proxy_router)
+
+# Inference POSTs skip FastAPI routing/DI and the middleware stack (see src/asgi_proxy.py);
+# everything else, including lifespan, is passed through to `api`.
+app = ProxyASGIApp(api)
@@ -0,0 +1,83 @@
+"""Adaptive stall timeouts for upstream responses (STALL_TIMEOUT_MULTIPLIER > 0).
+
+The HTTP client's only read timeout is the global 600s, so an upstream that sends its
+headers and then never a first token, or freezes mid-stream, holds the client and a lease
+for up to ten minutes. Per model, and separately for event streams and plain bodies, this
+learns two distributions from completed responses: the delay between the headers and the
+first body chunk, and each response's longest gap between chunks. A response that exceeds
+STALL_TIMEOUT_MULTIPLIER x the p99 (never less than STALL_TIMEOUT_MIN_SECONDS) is stalled.
+
+A stall before the first byte fails over to the next server, since nothing reached the
+client yet; a stall mid-stream ends the response. Both count as failures for the circuit
+breaker. Until a model has MIN_SAMPLES responses, only the global timeout applies.
+"""
+
+import math
+from collections import deque
+
+from src.config import config
+
+WINDOW = 512  # recent samples kept per (model, kind)
+MIN_SAMPLES = 50  # don't cut requests off based on too little data
+RECOMPUTE_EVERY = 32  # new samples between p99 recomputations
+
+
+class _Distribution:
+    __slots__ = ("samples", "p99", "pending")
+
+    def __init__(self) -> None:
+        self.samples: deque[float] = deque(maxlen=WINDOW)
+        self.p99: float | None = None
+        self.pending = 0  # samples since p99 was computed
+
+    def observe(self, seconds: float) -> None:
+        self.samples.append(seconds)
+        self.pending += 1
+        if len(self.samples) >= MIN_SAMPLES and (self.p99 is None or self.pending >= RECOMPUTE_EVERY):
+            ordered = sorted(self.samples)
+            self.p99 = ordered[min(math.ceil(0.99 * len(ordered)) - 1, len(ordered) - 1)]
+            self.pending = 0
+
+
+class StallDetector:
+    def __init__(self) -> None:
+        self._first_byte: dict[tuple[str, bool], _Distribution] = {}
+        self._max_gap: dict[tuple[str, bool], _Distribution] = {}
+        self.first_byte_stalls = 0
+        self.idle_stalls = 0
+
+    @staticmethod
+    def _observe(table: dict[tuple[str, bool], _Distribution], key: tuple[str, bool], seconds: float) -> None:
+        distribution = table.get(key)
+        if distribution is None:
+            distribution = table[key] = _Distribution()
+        distribution.observe(seconds)
+
+    @staticmethod
+    def _timeout(table: dict[tuple[str, bool], _Distribution], key: tuple[str, bool]) -> float | None:
+        if config.STALL_TIMEOUT_MULTIPLIER <= 0:
+            return None
+        distribution = table.get(key)
+        if distribution is None or distribution.p99 is None:
+            return None
+        return max(config.STALL_TIMEOUT_MIN_SECONDS, config.STALL_TIMEOUT_MULTIPLIER * distribution.p99)
+
+    def observe_first_byte(self, model: str, sse: bool, seconds: float) -> None:
+        """Headers-to-first-chunk delay of a response."""
+        self._observe(self._first_byte, (model, sse), seconds)
+
+    def observe_max_gap(self, model: str, sse: bool, seconds: float) -> None:
+        """Longest wait between two chunks of a response that completed."""
+        self._observe(self._max_gap, (model, sse), seconds)
+
+    def first_byte_timeout(self, model: str, sse: bool) -> float | None:
+        return self._timeout(self._first_byte, (model, sse))
+
+    def idle_timeout(self, model: str, sse: bool) -> float | None:
+        return self._timeout(self._max_gap, (model, sse))
+
+    def stats(self) -> dict[str, int]:
+        return {"first_byte_stalls": self.first_byte_stalls, "idle_stalls": self.idle_stalls}
+
+
+stall_detector = StallDetector()
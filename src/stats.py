@@ -0,0 +1,38 @@
+import hmac
+from http import HTTPStatus
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+
+from src.admission import admission
+from src.coalescing import single_flight
+from src.config import config
+from src.embedding_batcher import embedding_batcher
+from src.embeddings_cache import embeddings_cache
+from src.health import server_health_monitor
+from src.proxy import client as upstream_pools
+from src.stall import stall_detector
+
+router = APIRouter(tags=["Stats"])
+
+
+async def require_admin(x_admin_token: Annotated[str | None, Header()] = None) -> None:
+    """Internal endpoints: same `x-admin-token` secret the backend's admin API uses."""
+    secret = config.BACKEND_SECRET_TOKEN
+    if not secret or x_admin_token is None or not hmac.compare_digest(x_admin_token.encode(), secret.encode()):
+        raise HTTPException(status_code=HTTPStatus.UNAUTHORIZED)
+
+
+@router.get("/libertai/stats", dependencies=[Depends(require_admin)], include_in_schema=False)
+async def stats():
+    """Replica-local proxy stats: admission queues, coalescing, embeddings, stalls, upstream
+    pools, health sweeps. Admin only, since they expose internal upstream origins."""
+    return {
+        "admission": admission.stats(),
+        "coalescing": single_flight.stats(),
+        "embeddings_cache": embeddings_cache.stats(),
+        "embeddings_batching": embedding_batcher.stats(),
+        "stalls": stall_detector.stats(),
+        "upstream_pools": upstream_pools.stats(),
+        "health_sweeps": server_health_monitor.stats(),
+    }
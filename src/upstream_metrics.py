@@ -0,0 +1,81 @@
+"""Upstream load from vLLM's Prometheus `/metrics` page (UPSTREAM_METRICS).
+
+Our leases only count requests this proxy sent; the real queue on a box also holds
+traffic from other clients. During health sweeps the monitor scrapes each reachable
+upstream's `/metrics` and keeps the few series routing cares about. The page is mostly
+histogram buckets, so `MetricsParser` is fed one line at a time as the body streams in
+and drops every line that doesn't start with a wanted name before doing any parsing.
+
+Values are summed over label sets (a box serving several models reports one series per
+`model_name`), except KV-cache usage which keeps the highest.
+"""
+
+from dataclasses import dataclass
+
+RUNNING = "vllm:num_requests_running"
+WAITING = "vllm:num_requests_waiting"
+# vLLM V1 renamed gpu_cache_usage_perc; both are a 0-1 fraction despite the name
+KV_CACHE = ("vllm:kv_cache_usage_perc", "vllm:gpu_cache_usage_perc")
+THROUGHPUT = "vllm:avg_generation_throughput_toks_per_s"  # V0 gauge; V1 only has the counter
+GENERATION_TOKENS = "vllm:generation_tokens_total"
+
+_WANTED = (RUNNING, WAITING, *KV_CACHE, THROUGHPUT, GENERATION_TOKENS)
+
+
+@dataclass(slots=True)
+class UpstreamLoad:
+    running: int = 0
+    waiting: int = 0
+    kv_cache_usage: float | None = None
+    tokens_per_second: float | None = None  # from the gauge, else left to the caller
+    generation_tokens: float | None = None  # counter; the caller derives a rate across scrapes
+
+
+def _sample(line: str) -> tuple[str, float] | None:
+    """(metric name, value) of an exposition line, ignoring labels and timestamp."""
+    brace = line.find("{")
+    if brace == -1:
+        name, _, rest = line.partition(" ")
+    else:
+        close = line.rfind("}")
+        if close < brace:
+            return None
+        name, rest = line[:brace], line[close + 1 :]
+    fields = rest.split()
+    if not fields:
+        return None
+    try:
+        return name, float(fields[0])
+    except ValueError:
+        return None
+
+
+class MetricsParser:
+    def __init__(self) -> None:
+        self.load = UpstreamLoad()
+
+    def feed(self, line: str) -> None:
+        if not line.startswith(_WANTED):
+            return  # comments, histograms and everything else we don't route on
+        sample = _sample(line)
+        if sample is None:
+            return
+        name, value = sample
+        load = self.load
+        if name == RUNNING:
+            load.running += int(value)
+        elif name == WAITING:
+            load.waiting += int(value)
+        elif name in KV_CACHE:
+            load.kv_cache_usage = max(load.kv_cache_usage or 0.0, value)
+        elif name == THROUGHPUT:
+            load.tokens_per_second = (load.tokens_per_second or 0.0) + value
+        elif name == GENERATION_TOKENS:
+            load.generation_tokens = (load.generation_tokens or 0.0) + value
+
+
+def parse(text: str) -> UpstreamLoad:
+    parser = MetricsParser()
+    for line in text.splitlines():
+        parser.feed(line)
+    return parser.load
@@ -0,0 +1,146 @@
+"""One isolated connection pool per upstream box.
+
+With a single shared client, a slow or black-holed box holds on to connections until the
+whole pool is used up, and requests for every other model then fail with PoolTimeout.
+`UpstreamPools` is a drop-in for that client (`build_request` / `send` / `aclose`) that
+sends each request through its upstream's own pool, so one bad box can only exhaust its
+own connections. Pools are sized from the box's capacity: UPSTREAM_POOL_CONNECTIONS, or
+else UPSTREAM_MAX_CONCURRENCY plus headroom for hedges and probes.
+
+Optional extras: HTTP/2 (UPSTREAM_HTTP2, when the `h2` package is installed) multiplexes
+requests to upstreams that negotiate it over TLS, and `prewarm` opens connections (TCP and
+TLS, verified with the pinned certs) before the first request needs them.
+"""
+
+import asyncio
+from collections.abc import AsyncIterator, Callable
+from typing import Any
+
+import httpx
+
+from src.config import config
+from src.logger import setup_logger
+from src.ssl_trust import SSL_CONTEXT
+
+try:
+    import h2  # type: ignore[import-not-found]  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = setup_logger(__name__)
+
+DEFAULT_POOL_SIZE = 100  # per upstream, when no capacity is configured
+POOL_HEADROOM = 16  # on top of UPSTREAM_MAX_CONCURRENCY: hedges, probes, requests finishing up
+
+
+def _origin(url: httpx.URL) -> str:
+    return f"{url.scheme}://{url.host}:{url.port or (443 if url.scheme == 'https' else 80)}"
+
+
+def pool_size() -> int:
+    if config.UPSTREAM_POOL_CONNECTIONS > 0:
+        return config.UPSTREAM_POOL_CONNECTIONS
+    if config.UPSTREAM_MAX_CONCURRENCY > 0:
+        return config.UPSTREAM_MAX_CONCURRENCY + POOL_HEADROOM
+    return DEFAULT_POOL_SIZE
+
+
+class _TrackedStream(httpx.AsyncByteStream):
+    """A streamed response body that calls `on_close` once the response is closed."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, on_close: Callable[[], None]) -> None:
+        self._stream = stream
+        self._on_close = on_close
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self._on_close()
+
+
+class UpstreamPools:
+    def __init__(self, timeout: httpx.Timeout) -> None:
+        self.timeout = timeout
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        # Requests holding (or waiting for) a connection, per origin: sent until closed
+        self._inflight: dict[str, int] = {}
+        # Only builds requests (headers, timeout extension); never sends any
+        self._builder = httpx.AsyncClient(timeout=timeout)
+
+    def _client(self, origin: str) -> httpx.AsyncClient:
+        client = self._clients.get(origin)
+        if client is None:
+            size = pool_size()
+            client = self._clients[origin] = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=size, max_keepalive_connections=size),
+                verify=SSL_CONTEXT,
+                http2=config.UPSTREAM_HTTP2 and HTTP2_AVAILABLE,
+            )
+        return client
+
+    def build_request(self, method: str, url: str, **kwargs: Any) -> httpx.Request:
+        return self._builder.build_request(method, url, **kwargs)
+
+    async def send(self, request: httpx.Request, *, stream: bool = False) -> httpx.Response:
+        origin = _origin(request.url)
+        client = self._client(origin)
+        self._inflight[origin] = self._inflight.get(origin, 0) + 1
+        closed = False
+
+        def close() -> None:
+            nonlocal closed
+            if not closed:
+                closed = True
+                self._inflight[origin] -= 1
+
+        try:
+            response = await client.send(request, stream=stream)
+        except BaseException:
+            close()
+            raise
+        if stream and not response.is_closed and isinstance(response.stream, httpx.AsyncByteStream):
+            response.stream = _TrackedStream(response.stream, close)
+        else:
+            close()  # body already read, connection returned to the pool
+        return response
+
+    async def prewarm(self, servers: list[str]) -> None:
+        """Open UPSTREAM_PREWARM_CONNECTIONS connections to each server (cheap `/health` calls)."""
+        count = config.UPSTREAM_PREWARM_CONNECTIONS
+        if count <= 0 or not servers:
+            return
+
+        async def warm(server: str) -> None:
+            try:
+                await self._client(_origin(httpx.URL(server))).get(f"{server}/health")
+            except Exception as e:
+                logger.debug(f"Pre-warming a connection to {server} failed: {type(e).__name__}: {e}")
+
+        # Concurrent calls so HTTP/1.1 pools open `count` separate connections
+        await asyncio.gather(*(warm(server) for server in servers for _ in range(count)))
+        logger.info(f"Pre-warmed connections to {len(servers)} upstreams")
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """Per upstream: configured pool size and the requests currently using (or queued for)
+        one of its connections, counted here rather than read from httpcore's internals."""
+        size = pool_size()
+        return {
+            origin: {
+                "max": size,
+                "requests": self._inflight.get(origin, 0),
+                "http2": config.UPSTREAM_HTTP2 and HTTP2_AVAILABLE,
+            }
+            for origin in self._clients
+        }
+
+    async def aclose(self) -> None:
+        clients, self._clients = list(self._clients.values()), {}
+        await asyncio.gather(*(c.aclose() for c in clients), self._builder.aclose(), return_exceptions=True)
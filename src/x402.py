@@ -20,6 +20,36 @@ USDC_BASE_ADDRESS = "0x833589fCD6eDb6E08f4c7C32D4f71b54bdA02913"
 
 _enc = tiktoken.get_encoding("cl100k_base")
 
+# Content parts that carry media (base64 images or audio, URLs) rather than prompt text
+_MEDIA_PARTS = frozenset({"image_url", "input_image", "image", "input_audio", "audio"})
+
+
+def prompt_text(value: object) -> tuple[str, int]:
+    """The prompt text in a request field (`messages`, `input`, ...) and how many literal
+    token ids it holds. Every string counts except those inside media parts; the JSON
+    structure around them doesn't."""
+    texts: list[str] = []
+    ids = 0
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            texts.append(item)
+        elif isinstance(item, bool):
+            continue
+        elif isinstance(item, int):
+            ids += 1
+        elif isinstance(item, list):
+            stack.extend(reversed(item))
+        elif isinstance(item, dict) and item.get("type") not in _MEDIA_PARTS:
+            stack.extend(reversed([v for key, v in item.items() if key != "type"]))
+    return "\n".join(texts), ids
+
+
+async def count_tokens(value: object) -> int:
+    text, ids = prompt_text(value)
+    return ids + await asyncio.to_thread(lambda: len(_enc.encode(text)))
+
 
 class X402Manager:
     _instance = None
@@ -51,15 +81,11 @@ class X402Manager:
 
         # Embedding models are input-only: price the `input` payload, no completion tokens.
         if info.get("is_embedding"):
-            inputs = body.get("input", "")
-            input_text = inputs if isinstance(inputs, str) else json.dumps(inputs)
-            input_tokens = await asyncio.to_thread(lambda: len(_enc.encode(input_text)))
+            input_tokens = await count_tokens(body.get("input", ""))
             price = input_tokens / 1_000_000 * info["price_per_million_input_tokens"]
             return max(price, 0.0001)
 
-        messages = body.get("messages", [])
-        messages_text = json.dumps(messages)
-        input_tokens = await asyncio.to_thread(lambda: len(_enc.encode(messages_text)))
+        input_tokens = await count_tokens(body.get("messages", []))
 
         max_tokens = (
             body.get("max_tokens") or body.get("max_completion_tokens") or info.get("default_max_tokens", 4096)
@@ -162,6 +188,23 @@ class X402Manager:
             },
         )
 
+    @staticmethod
+    def payer_address(payment_header: str) -> str | None:
+        """Paying wallet (EIP-3009 `authorization.from`) of an x402 payment header, if present."""
+        for decode in (lambda h: json.loads(h), lambda h: json.loads(base64.b64decode(h))):
+            try:
+                payment_payload = decode(payment_header)
+                break
+            except Exception:
+                continue
+        else:
+            return None
+        try:
+            payer = payment_payload["payload"]["authorization"]["from"]
+        except (KeyError, TypeError):
+            return None
+        return payer if isinstance(payer, str) else None
+
     @staticmethod
     async def verify_payment(payment_header: str, requirements: dict) -> bool:
         """Verify x402 payment via thirdweb (no settlement)."""
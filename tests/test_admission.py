@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from src import admission as admission_module
+from src.admission import AdmissionController
+from src.routing import CompiledRoute
+
+ROUTE = CompiledRoute(
+    model="m",
+    thinking_requested=False,
+    is_reasoning=False,
+    is_vision=False,
+    healthy=("A", "B"),
+    capable=(),
+    unknown=(),
+    preferable=frozenset({"A", "B"}),
+    servers=("A", "B"),
+)
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    current = {"A": 2, "B": 2}
+
+    async def _get_loads(servers):
+        return dict(current)
+
+    monkeypatch.setattr(admission_module, "get_loads", _get_loads)
+    monkeypatch.setattr(admission_module, "POLL_INTERVAL", 0.001)
+    monkeypatch.setattr(admission_module.routing_table, "get", lambda name: None)
+    monkeypatch.setattr(admission_module.config, "UPSTREAM_MAX_CONCURRENCY", 2)
+    monkeypatch.setattr(admission_module.config, "ADMISSION_QUEUE_SIZE", 10)
+    monkeypatch.setattr(admission_module.config, "ADMISSION_TIMEOUT_SECONDS", 1)
+    return current
+
+
+def test_disabled_admits_everything(monkeypatch):
+    monkeypatch.setattr(admission_module.config, "UPSTREAM_MAX_CONCURRENCY", 0)
+    full = {"A": 100, "B": 100}
+    assert asyncio.run(AdmissionController().admit(ROUTE, full, "k")) is full
+
+
+def test_free_slot_admits_without_queueing(loads):
+    loads["B"] = 1
+    controller = AdmissionController()
+    asyncio.run(controller.admit(ROUTE, dict(loads), "k"))
+    assert controller.stats()["m"]["queued_total"] == 0
+
+
+def test_waiters_are_admitted_round_robin_as_slots_free(loads):
+    controller = AdmissionController()
+    order: list[str] = []
+
+    async def request(caller):
+        await controller.admit(ROUTE, dict(loads), caller)
+        loads[min(loads, key=loads.get)] += 1  # the admitted request takes its lease
+        controller.settle("m")
+        order.append(caller)
+
+    async def scenario():
+        tasks = [asyncio.create_task(request(c)) for c in ("greedy", "greedy", "greedy", "other")]
+        await asyncio.sleep(0.01)
+        assert order == [] and controller.stats()["m"]["queued"] == 4
+        loads["A"] = 0  # two leases released
+        await asyncio.sleep(0.01)
+        assert order == ["greedy", "other"]  # the greedy caller's burst doesn't go first
+        loads["B"] = 0
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    stats = controller.stats()["m"]
+    assert (stats["queued"], stats["admitted"], stats["queued_total"]) == (0, 4, 4)
+
+
+def test_deadline_and_queue_bound_answer_503(loads, monkeypatch):
+    monkeypatch.setattr(admission_module.config, "ADMISSION_TIMEOUT_SECONDS", 0.01)
+    monkeypatch.setattr(admission_module.config, "ADMISSION_QUEUE_SIZE", 1)
+    controller = AdmissionController()
+
+    async def scenario():
+        waiting = asyncio.create_task(controller.admit(ROUTE, dict(loads), "a"))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as full:
+            await controller.admit(ROUTE, dict(loads), "b")
+        with pytest.raises(HTTPException) as late:
+            await waiting
+        return full.value, late.value
+
+    full, late = asyncio.run(scenario())
+    assert full.status_code == late.status_code == 503
+    stats = controller.stats()["m"]
+    assert (stats["queued"], stats["rejected"], stats["timed_out"]) == (0, 1, 1)
+
+
+def test_only_healthy_servers_count_while_there_are_any(loads):
+    degraded = CompiledRoute(
+        model="m",
+        thinking_requested=False,
+        is_reasoning=False,
+        is_vision=False,
+        healthy=("A",),
+        capable=(),
+        unknown=("dead",),
+        preferable=frozenset({"A"}),
+        servers=("A", "dead"),
+    )
+    loads["A"] = 2  # at the cap; "dead" holds no leases but must not look free
+    controller = AdmissionController()
+
+    async def scenario():
+        waiting = asyncio.create_task(controller.admit(degraded, dict(loads), "k"))
+        await asyncio.sleep(0.01)
+        assert not waiting.done() and controller.stats()["m"]["queued"] == 1
+        loads["A"] = 1
+        await waiting
+
+    asyncio.run(scenario())
+
+
+def test_burst_against_stale_loads_admits_only_the_free_slots(loads, monkeypatch):
+    monkeypatch.setattr(admission_module.config, "UPSTREAM_MAX_CONCURRENCY", 1)
+    monkeypatch.setattr(admission_module.config, "ADMISSION_TIMEOUT_SECONDS", 0.05)
+    single = CompiledRoute(
+        model="m",
+        thinking_requested=False,
+        is_reasoning=False,
+        is_vision=False,
+        healthy=("A",),
+        capable=(),
+        unknown=(),
+        preferable=frozenset({"A"}),
+        servers=("A",),
+    )
+    loads["A"] = 0  # never updated: no admitted request has taken its lease yet
+    controller = AdmissionController()
+
+    async def scenario():
+        results = await asyncio.gather(
+            *(controller.admit(single, dict(loads), f"k{i}") for i in range(5)), return_exceptions=True
+        )
+        assert sum(not isinstance(r, Exception) for r in results) == 1
+        assert controller.stats()["m"]["reserved"] == 1
+        controller.settle("m")  # its lease lands and now shows in the loads
+        loads["A"] = 1
+        with pytest.raises(HTTPException):
+            await controller.admit(single, dict(loads), "late")
+
+    asyncio.run(scenario())
+    stats = controller.stats()["m"]
+    assert (stats["admitted"], stats["timed_out"], stats["reserved"]) == (1, 5, 0)
+
+
+def test_admitted_requests_are_routed_below_the_cap(loads):
+    controller = AdmissionController()
+    assert controller.order(ROUTE, ["A", "B", "C"], {"A": 2, "B": 1}) == ["B", "C", "A"]
+    assert controller.order(ROUTE, ["B", "A"], {"A": 1, "B": 1}) == ["B", "A"]
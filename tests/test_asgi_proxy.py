@@ -0,0 +1,554 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import src.proxy as proxy
+from src import circuit_breaker
+from src.api_keys import KeysManager
+from src.asgi_proxy import ProxyASGIApp
+from src.balancer import LatencyTracker
+from src.circuit_breaker import CircuitBreakers
+from src.embeddings_cache import EmbeddingsCache
+from src.rate_limit import RateLimiter, identity_for_key
+from src.stall import StallDetector
+
+
+class _Chunks(httpx.AsyncByteStream):
+    def __init__(self, *chunks: bytes):
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+@pytest.fixture(autouse=True)
+def _upstream(monkeypatch):
+    """One configured model, a valid key, no Redis, and a recorded upstream."""
+    monkeypatch.setattr(proxy.config, "MODELS", {"m": ["http://up"]})
+    proxy.routing_table.update_aleph({}, {"m"}, {"m"})  # reasoning + vision, no redirections
+
+    manager = KeysManager()
+    saved = manager.keys, manager.invalid_keys
+    manager.keys, manager.invalid_keys = {"good"}, {}
+
+    calls: dict = {"sent": [], "released": []}
+
+    async def _no_loads(servers):
+        return {}
+
+    async def _acquire(*args):
+        return None
+
+    async def _release(server, request_id):
+        calls["released"].append(server)
+
+    async def _send(req, stream=False):
+        calls["sent"].append(req)
+        await req.aread()
+        return httpx.Response(
+            200,
+            headers={"content-type": "text/event-stream"},
+            stream=_Chunks(b"data: a\n\n", b"data: b\n\n"),
+            request=req,
+        )
+
+    monkeypatch.setattr(proxy, "get_loads", _no_loads)
+    monkeypatch.setattr(proxy, "load_acquire", _acquire)
+    monkeypatch.setattr(proxy, "load_release", _release)
+    monkeypatch.setattr(proxy.client, "send", _send)
+    yield calls
+    manager.keys, manager.invalid_keys = saved
+    proxy.routing_table.update_aleph({}, set(), set())
+
+
+def _client():
+    api = FastAPI()
+
+    @api.post("/search")
+    async def search():
+        return {"route": "search"}
+
+    api.include_router(proxy.router)
+    return TestClient(ProxyASGIApp(api))
+
+
+def test_stream_is_relayed_with_cookie_and_lease_released(_upstream):
+    resp = _client().post("/v1/chat/completions?x=1", json={"model": "m"}, headers={"Authorization": "Bearer good"})
+    assert resp.status_code == 200
+    assert resp.content == b"data: a\n\ndata: b\n\n"
+    assert "preferred_instances=" in resp.headers["set-cookie"]
+    assert str(_upstream["sent"][0].url) == "http://up/v1/chat/completions?x=1"
+    assert _upstream["released"] == ["http://up"]
+
+
+def test_plain_body_is_relayed_unbuffered_with_length_passthrough(_upstream, monkeypatch):
+    async def _send(req, stream=False):
+        return httpx.Response(
+            200,
+            headers={"content-type": "audio/mpeg", "content-length": "6", "content-encoding": "identity"},
+            stream=_Chunks(b"abc", b"def"),
+            request=req,
+        )
+
+    monkeypatch.setattr(proxy.client, "send", _send)
+    resp = _client().post("/v1/audio/speech", json={"model": "m"}, headers={"Authorization": "Bearer good"})
+    assert resp.content == b"abcdef"
+    assert (resp.headers["content-length"], resp.headers["content-type"]) == ("6", "audio/mpeg")
+    assert _upstream["released"] == ["http://up"]
+
+
+def test_stream_feeds_upstream_latency(_upstream, monkeypatch):
+    tracker = LatencyTracker()
+    monkeypatch.setattr(proxy, "upstream_latency", tracker)
+    _client().post("/v1/chat/completions", json={"model": "m"}, headers={"Authorization": "Bearer good"})
+    assert tracker.cost("http://up") is not None
+
+
+def test_thinking_variant_rewrites_the_forwarded_body(_upstream):
+    _client().post("/v1/chat/completions", json={"model": "M-thinking"}, headers={"Authorization": "Bearer good"})
+    forwarded = json.loads(_upstream["sent"][0].content)
+    assert forwarded == {"model": "m"}
+
+    _client().post("/v1/chat/completions", json={"model": "m"}, headers={"Authorization": "Bearer good"})
+    forwarded = json.loads(_upstream["sent"][1].content)
+    assert forwarded == {"model": "m", "chat_template_kwargs": {"enable_thinking": False}}
+
+
+def test_rate_limited_key_gets_429_and_slot_is_released(_upstream, monkeypatch):
+    monkeypatch.setattr(proxy, "rate_limiter", RateLimiter())
+    monkeypatch.setattr(proxy.keys_manager, "limits", {"good": {"concurrency": 1, "rps": 1}})
+    headers = {"Authorization": "Bearer good"}
+
+    assert _client().post("/v1/chat/completions", json={"model": "m"}, headers=headers).status_code == 200
+    assert proxy.rate_limiter.inflight(identity_for_key("good")) == 0  # released once relayed
+
+    _client().post("/v1/chat/completions", json={"model": "m"}, headers=headers)
+    limited = _client().post("/v1/chat/completions", json={"model": "m"}, headers=headers)
+    assert limited.status_code == 429
+    assert limited.json()["error"]["code"] == "rate_limit_exceeded"
+    assert int(limited.headers["retry-after"]) >= 1
+
+
+def test_identical_deterministic_requests_are_coalesced(_upstream, monkeypatch):
+    monkeypatch.setattr(proxy.config, "COALESCE_REQUESTS", True)
+    release = asyncio.Event()
+
+    async def _send(req, stream=False):
+        _upstream["sent"].append(req)
+        await release.wait()
+        return httpx.Response(200, headers={"content-type": "application/json"}, stream=_Chunks(b"{}"), request=req)
+
+    monkeypatch.setattr(proxy.client, "send", _send)
+    app = ProxyASGIApp(FastAPI())
+    body = json.dumps({"model": "m", "input": "x"}).encode()
+
+    async def call():
+        sent: list[dict] = []
+        messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive():
+            return messages.pop(0) if messages else await asyncio.Event().wait()
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "path": "/v1/embeddings",
+            "query_string": b"",
+            "headers": [(b"authorization", b"Bearer good"), (b"content-type", b"application/json")],
+        }
+        await app(scope, receive, send)
+        return b"".join(m.get("body", b"") for m in sent if m["type"] == "http.response.body")
+
+    async def scenario():
+        calls = [asyncio.create_task(call()) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        release.set()
+        return await asyncio.gather(*calls)
+
+    assert asyncio.run(scenario()) == [b"{}"] * 3
+    assert len(_upstream["sent"]) == 1
+    assert _upstream["released"] == ["http://up"]
+
+
+def test_embeddings_cache_forwards_only_misses(_upstream, monkeypatch):
+    monkeypatch.setattr(proxy.config, "EMBEDDINGS_CACHE_MB", 1)
+    monkeypatch.setattr(proxy, "embeddings_cache", EmbeddingsCache())
+
+    async def _send(req, stream=False):
+        inputs = json.loads(await req.aread())["input"]
+        _upstream["sent"].append(inputs)
+        data = [{"index": i, "embedding": [len(t)]} for i, t in enumerate(inputs)]
+        body = json.dumps({"data": data, "model": "m", "usage": {}}).encode()
+        return httpx.Response(200, stream=_Chunks(body), request=req)
+
+    monkeypatch.setattr(proxy.client, "send", _send)
+    headers = {"Authorization": "Bearer good"}
+    _client().post("/v1/embeddings", json={"model": "m", "input": ["a"]}, headers=headers)
+    resp = _client().post("/v1/embeddings", json={"model": "m", "input": ["bb", "a"]}, headers=headers)
+    assert [d["embedding"] for d in resp.json()["data"]] == [[2], [1]]
+    assert _upstream["sent"] == [["a"], ["bb"]]
+    assert _upstream["released"] == ["http://up", "http://up"]
+
+    # An unknown key (left for the upstream to check) is never answered from the cache
+    unknown = {"Authorization": "Bearer totally-made-up"}
+    _client().post("/v1/embeddings", json={"model": "m", "input": ["a"]}, headers=unknown)
+    assert _upstream["sent"][-1] == ["a"]
+
+
+def test_x402_embeddings_get_proxy_side_dimensions(_upstream, monkeypatch):
+    monkeypatch.setattr(proxy.config, "EMBEDDINGS_TRANSCODE", True)
+
+    async def _max_price(model, body):
+        return 1.0
+
+    async def _requirements(model, max_price, resource_url):
+        return [{"scheme": "upto"}]
+
+    async def _verify(header, requirements):
+        return True
+
+    monkeypatch.setattr(proxy.x402_manager, "compute_max_price", _max_price)
+    monkeypatch.setattr(proxy.x402_manager, "fetch_payment_requirements", _requirements)
+    monkeypatch.setattr(proxy.x402_manager, "verify_payment", _verify)
+
+    async def _send(req, stream=False):
+        _upstream["sent"].append(json.loads(await req.aread()))
+        body = json.dumps({"data": [{"index": 0, "embedding": [3.0, 4.0, 12.0]}], "model": "m"}).encode()
+        return httpx.Response(200, stream=_Chunks(body), request=req)
+
+    monkeypatch.setattr(proxy.client, "send", _send)
+    body = {"model": "m", "input": "a", "dimensions": 2}
+    resp = _client().post("/v1/embeddings", json=body, headers={"X-Payment": "p"})
+    assert resp.json()["data"][0]["embedding"] == pytest.approx([0.6, 0.8])
+    assert "dimensions" not in _upstream["sent"][0]
+
+
+def test_client_disconnect_cancels_the_pending_upstream_call(_upstream, monkeypatch):
+    cancelled = asyncio.Event()
+
+    async def _send(req, stream=False):
+        try:
+            await asyncio.Event().wait()  # a long non-streaming generation
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    monkeypatch.setattr(proxy.client, "send", _send)
+    app = ProxyASGIApp(FastAPI())
+    sent: list[dict] = []
+
+    async def scenario():
+        messages = [{"type": "http.request", "body": b'{"model": "m"}', "more_body": False}]
+        gone = asyncio.Event()
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await gone.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "path": "/v1/chat/completions",
+            "query_string": b"",
+            "headers": [(b"authorization", b"Bearer good")],
+        }
+        call = asyncio.create_task(app(scope, receive, send))
+        await asyncio.sleep(0.01)
+        gone.set()
+        await asyncio.wait_for(call, 1)
+
+    asyncio.run(scenario())
+    assert cancelled.is_set()
+    assert _upstream["released"] == ["http://up"]
+    assert sent == []
+
+
+class _Stalling(httpx.AsyncByteStream):
+    def __init__(self, *chunks: bytes):
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+        await asyncio.Event().wait()  # then nothing, ever
+
+    async def aclose(self):
+        pass
+
+
+@pytest.fixture
+def stall_timeouts(monkeypatch):
+    detector = StallDetector()
+    for _ in range(50):
+        detector.observe_first_byte("m", True, 0.001)
+        detector.observe_max_gap("m", True, 0.001)
+    monkeypatch.setattr(proxy, "stall_detector", detector)
+    monkeypatch.setattr(proxy.config, "STALL_TIMEOUT_MULTIPLIER", 4)
+    monkeypatch.setattr(proxy.config, "STALL_TIMEOUT_MIN_SECONDS", 0.05)
+    monkeypatch.setattr(proxy, "circuit_breakers", CircuitBreakers())
+    return detector
+
+
+def test_stall_before_first_byte_fails_over(_upstream, stall_timeouts, monkeypatch):
+    original_send = proxy.client.send
+
+    async def _send(req, stream=False):
+        if req.url.host == "a":
+            return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=_Stalling(), request=req)
+        return await original_send(req, stream)
+
+    monkeypatch.setattr(proxy.client, "send", _send)
+    monkeypatch.setattr(proxy, "order_servers", lambda route, loads: ["http://a", "http://b"])
+    resp = _client().post("/v1/chat/completions", json={"model": "m"}, headers={"Authorization": "Bearer good"})
+    assert resp.content == b"data: a\n\ndata: b\n\n"
+    assert stall_timeouts.stats()["first_byte_stalls"] == 1
+    assert proxy.circuit_breakers._breakers["http://a"].failures == 1
+    assert _upstream["released"] == ["http://a", "http://b"]
+
+
+def test_stall_before_first_byte_demotes_the_server_for_the_next_request(_upstream, stall_timeouts, monkeypatch):
+    class _Redis:
+        async def set(self, key, value, ex=None):
+            pass
+
+    monkeypatch.setattr(proxy.config, "CIRCUIT_FAILURE_THRESHOLD", 1)
+    monkeypatch.setattr(circuit_breaker, "get_redis", lambda: _Redis())
+    original_send = proxy.client.send
+
+    async def _send(req, stream=False):
+        if req.url.host == "a":
+            return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=_Stalling(), request=req)
+        return await original_send(req, stream)
+
+    monkeypatch.setattr(proxy.client, "send", _send)
+    monkeypatch.setattr(proxy, "order_servers", lambda route, loads: ["http://a", "http://b"])
+    headers = {"Authorization": "Bearer good"}
+    _client().post("/v1/chat/completions", json={"model": "m"}, headers=headers)
+    assert [req.url.host for req in _upstream["sent"]] == ["b"]  # a stalled, never reached the recorder
+    resp = _client().post("/v1/chat/completions", json={"model": "m"}, headers=headers)
+    assert resp.content == b"data: a\n\ndata: b\n\n"
+    assert stall_timeouts.stats()["first_byte_stalls"] == 1  # b went first: a wasn't tried again
+    assert _upstream["released"] == ["http://a", "http://b", "http://b"]
+
+
+def test_stall_mid_stream_ends_the_response(_upstream, stall_timeouts, monkeypatch):
+    async def _send(req, stream=False):
+        stalling = _Stalling(b"data: a\n\n", b"data: b\n\n")
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=stalling, request=req)
+
+    monkeypatch.setattr(proxy.client, "send", _send)
+    resp = _client().post("/v1/chat/completions", json={"model": "m"}, headers={"Authorization": "Bearer good"})
+    assert resp.content == b"data: a\n\ndata: b\n\n"
+    assert stall_timeouts.stats()["idle_stalls"] == 1
+    assert _upstream["released"] == ["http://up"]
+
+
+def test_open_breaker_demotes_the_server(_upstream, monkeypatch):
+    breakers = CircuitBreakers()
+    breakers._get("http://a").open_until = time.time() + 60
+    monkeypatch.setattr(proxy, "circuit_breakers", breakers)
+    monkeypatch.setattr(proxy, "order_servers", lambda route, loads: ["http://a", "http://b"])
+    # Prefix affinity would otherwise pull the open server back to the front
+    monkeypatch.setattr(proxy, "affinity_server", lambda route, key, loads: "http://a")
+    body = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+    resp = _client().post("/v1/chat/completions", json=body, headers={"Authorization": "Bearer good"})
+    assert resp.status_code == 200
+    assert [req.url.host for req in _upstream["sent"]] == ["b"]
+
+
+class _AlwaysHedge:
+    def __init__(self):
+        self.observed: list[float] = []
+
+    def enabled(self, model):
+        return True
+
+    def delay(self, model):
+        return 0.05
+
+    def try_spend(self):
+        return True
+
+    def observe(self, model, seconds):
+        self.observed.append(seconds)
+
+
+def _hedging(_upstream, monkeypatch, replies: dict[str, tuple[float, int]]) -> _AlwaysHedge:
+    """Hedge every request; each upstream host answers `replies[host]` = (after seconds, status)."""
+    policy = _AlwaysHedge()
+    monkeypatch.setattr(proxy, "hedge_policy", policy)
+    monkeypatch.setattr(proxy, "circuit_breakers", CircuitBreakers())
+    monkeypatch.setattr(proxy.config, "MODELS", {"m": [f"http://{host}" for host in replies]})
+    monkeypatch.setattr(proxy, "order_servers", lambda route, loads: [f"http://{host}" for host in replies])
+    monkeypatch.setattr(proxy, "affinity_server", lambda route, key, loads: None)
+
+    async def _send(req, stream=False):
+        _upstream["sent"].append(req)
+        after, status = replies[req.url.host]
+        await asyncio.sleep(after)
+        body = json.dumps({"host": req.url.host}).encode()
+        return httpx.Response(status, stream=_Chunks(body), request=req)
+
+    monkeypatch.setattr(proxy.client, "send", _send)
+    return policy
+
+
+def test_failover_skips_the_server_already_raced_as_a_hedge(_upstream, monkeypatch):
+    _hedging(_upstream, monkeypatch, {"a": (0.1, 503), "b": (0, 503), "c": (0, 200)})
+    body = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+    resp = _client().post("/v1/chat/completions", json=body, headers={"Authorization": "Bearer good"})
+    assert resp.json() == {"host": "c"}
+    assert [req.url.host for req in _upstream["sent"]] == ["a", "b", "c"]
+
+
+def test_winning_hedge_is_timed_from_its_own_send(_upstream, monkeypatch):
+    policy = _hedging(_upstream, monkeypatch, {"a": (0.5, 200), "b": (0, 200)})
+    body = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+    resp = _client().post("/v1/chat/completions", json=body, headers={"Authorization": "Bearer good"})
+    assert resp.json() == {"host": "b"}
+    assert len(policy.observed) == 1 and policy.observed[0] < 0.05  # not the primary's head start
+
+
+def test_admitted_request_skips_a_preferred_server_at_the_cap(_upstream, monkeypatch):
+    async def _loads(servers):
+        return {"http://a": 2}
+
+    monkeypatch.setattr(proxy.config, "MODELS", {"m": ["http://a", "http://b"]})
+    monkeypatch.setattr(proxy.config, "UPSTREAM_MAX_CONCURRENCY", 2)
+    monkeypatch.setattr(proxy, "get_loads", _loads)
+    monkeypatch.setattr(proxy, "affinity_server", lambda route, key, loads: "http://a")
+    body = {"model": "m", "messages": [{"role": "user", "content": "hi"}]}
+    resp = _client().post("/v1/chat/completions", json=body, headers={"Authorization": "Bearer good"})
+    assert resp.status_code == 200
+    assert [req.url.host for req in _upstream["sent"]] == ["b"]
+
+
+def test_unknown_model_404_shape_matches_fastapi():
+    resp = _client().post("/v1/chat/completions", json={"model": "nope"}, headers={"Authorization": "Bearer good"})
+    assert resp.status_code == 404
+    assert resp.json() == {"detail": "Model 'nope' not found"}
+
+
+def test_missing_model_falls_back_to_fastapi_422():
+    resp = _client().post("/v1/chat/completions", json={"messages": []})
+    assert resp.status_code == 422
+    assert resp.json()["detail"][0]["loc"] == ["body", "model"]
+
+
+def test_explicit_routes_are_left_to_fastapi(_upstream):
+    resp = _client().post("/search", json={"model": "m"})
+    assert resp.json() == {"route": "search"}
+    assert _upstream["sent"] == []
+
+
+def test_cors_origin_header_on_fast_path():
+    client = _client()
+    resp = client.post(
+        "/v1/chat/completions",
+        json={"model": "m"},
+        headers={"Authorization": "Bearer good", "Origin": "https://app.example"},
+    )
+    assert resp.headers["access-control-allow-origin"] == "*"
+
+    client.cookies.set("other", "1")
+    resp = client.post(
+        "/v1/chat/completions",
+        json={"model": "m"},
+        headers={"Authorization": "Bearer good", "Origin": "https://app.example"},
+    )
+    assert resp.headers["access-control-allow-origin"] == "https://app.example"
+    assert resp.headers["vary"] == "Origin"
+
+
+def _call_raw(*chunks: bytes, headers: list[tuple[bytes, bytes]]) -> list[dict]:
+    """Drive the ASGI app directly so the body arrives in several messages."""
+    app = ProxyASGIApp(FastAPI())
+    app.app.include_router(proxy.router)
+    messages = [{"type": "http.request", "body": c, "more_body": i < len(chunks) - 1} for i, c in enumerate(chunks)]
+    sent: list[dict] = []
+
+    async def receive():
+        if not messages:
+            await asyncio.Event().wait()  # client stays connected
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/v1/chat/completions",
+        "raw_path": b"/v1/chat/completions",
+        "root_path": "",
+        "scheme": "http",
+        "query_string": b"",
+        "headers": [(b"authorization", b"Bearer good"), *headers],
+        "server": ("test", 80),
+    }
+    asyncio.run(app(scope, receive, send))
+    return sent
+
+
+@pytest.fixture
+def streamed(monkeypatch, _upstream):
+    monkeypatch.setattr(proxy.config, "STREAM_REQUEST_MIN_BYTES", 10)
+    proxy.routing_table.update_aleph({}, set(), {"m"})  # no thinking rewrite
+    return _upstream
+
+
+CHUNKS = (b'{"model": "m", ', b'"messages": [{"role": "user", "content": "', b"x" * 100, b'"}]}')
+
+
+def test_large_body_is_streamed_upstream_untouched(streamed, monkeypatch):
+    original_send = proxy.client.send
+    seen = {}
+
+    async def _send(req, stream=False):
+        seen["buffered"] = isinstance(req.stream, httpx.ByteStream)
+        return await original_send(req, stream)
+
+    monkeypatch.setattr(proxy.client, "send", _send)
+    sent = _call_raw(*CHUNKS, headers=[(b"transfer-encoding", b"chunked")])
+    assert sent[0]["status"] == 200
+    assert seen["buffered"] is False
+    assert streamed["sent"][0].content == b"".join(CHUNKS)
+
+
+def test_streamed_body_is_replayed_on_failover(streamed, monkeypatch):
+    monkeypatch.setattr(proxy.config, "MODELS", {"m": ["http://a", "http://b"]})
+    original_send = proxy.client.send
+
+    async def _send(req, stream=False):
+        if req.url.host == "a":
+            assert await req.aread() == b"".join(CHUNKS)
+            return httpx.Response(503, request=req)
+        return await original_send(req, stream)
+
+    monkeypatch.setattr(proxy.client, "send", _send)
+    monkeypatch.setattr(proxy, "order_servers", lambda route, loads: ["http://a", "http://b"])
+    sent = _call_raw(*CHUNKS, headers=[(b"content-length", b"999")])
+    assert sent[0]["status"] == 200
+    assert str(streamed["sent"][0].url).startswith("http://b/")
+    assert streamed["sent"][0].content == b"".join(CHUNKS)
+
+
+def test_streamed_body_is_buffered_when_a_rewrite_needs_it(streamed):
+    proxy.routing_table.update_aleph({}, {"m"}, {"m"})  # reasoning: thinking kwargs get injected
+    _call_raw(*CHUNKS, headers=[])
+    forwarded = json.loads(streamed["sent"][0].content)
+    assert forwarded["chat_template_kwargs"] == {"enable_thinking": False}
@@ -0,0 +1,107 @@
+import pytest
+
+from src import balancer
+from src.balancer import LatencyTracker, order_servers
+from src.routing import CompiledRoute
+
+
+def _route(healthy, capable=(), unknown=()):
+    return CompiledRoute(
+        model="m",
+        thinking_requested=False,
+        is_reasoning=False,
+        is_vision=False,
+        healthy=tuple(healthy),
+        capable=tuple(capable),
+        unknown=tuple(unknown),
+        preferable=frozenset(healthy) | frozenset(capable),
+        servers=(*healthy, *capable, *unknown),
+    )
+
+
+@pytest.fixture
+def latency(monkeypatch):
+    tracker = LatencyTracker()
+    monkeypatch.setattr(balancer, "upstream_latency", tracker)
+    monkeypatch.setattr(balancer.config, "BALANCER_STRATEGY", "p2c")
+    return tracker
+
+
+def test_ewma_cost_combines_ttfb_and_throughput():
+    tracker = LatencyTracker()
+    assert tracker.cost("A") is None
+    tracker.observe_ttfb("A", 1.0)
+    tracker.observe_ttfb("A", 2.0)
+    assert tracker.cost("A") == pytest.approx(1.2)
+    tracker.observe_throughput("A", 512, 4.0)  # 128 tok/s -> 2s for a nominal completion
+    assert tracker.cost("A") == pytest.approx(1.2 + balancer.NOMINAL_TOKENS / 128)
+
+
+def test_least_loaded_is_the_default(monkeypatch):
+    monkeypatch.setattr(balancer.config, "BALANCER_STRATEGY", "least_loaded")
+    route = _route(["A", "B"], unknown=["C"])
+    assert order_servers(route, {"A": 3, "B": 1, "C": 0}) == ["B", "A", "C"]
+
+
+def test_p2c_weights_load_by_latency(latency):
+    latency.observe_ttfb("fast", 0.1)
+    latency.observe_ttfb("slow", 1.0)
+    route = _route(["slow", "fast"], capable=["X"])
+    # 3 inflight on a 10x faster box still beats 1 inflight on the slow one.
+    assert order_servers(route, {"fast": 3, "slow": 1}) == ["fast", "slow", "X"]
+
+
+def test_p2c_first_pick_is_the_better_of_two_samples(latency, monkeypatch):
+    route = _route(["A", "B", "C"])
+    loads = {"A": 0, "B": 5, "C": 9}
+    monkeypatch.setattr(balancer.random, "sample", lambda pop, n: ["C", "B"])
+    # The globally least-loaded A wasn't sampled, so the herd doesn't all land on it.
+    assert order_servers(route, loads) == ["B", "A", "C"]
+
+
+def test_p2c_prices_unsampled_servers_at_the_median(latency, monkeypatch):
+    latency.observe_ttfb("A", 1.0)
+    latency.observe_ttfb("B", 3.0)
+    monkeypatch.setattr(balancer.random, "sample", lambda pop, n: ["new", "B"])
+    # new is priced at 3.0s: (1 + 1) * 3.0 = 6 loses to B's (0 + 1) * 3.0 = 3
+    assert order_servers(_route(["A", "B", "new"]), {"A": 2, "B": 0, "new": 1}) == ["B", "A", "new"]
+
+
+@pytest.fixture
+def affinity(monkeypatch):
+    monkeypatch.setattr(balancer.config, "PREFIX_AFFINITY_MESSAGES", 2)
+    monkeypatch.setattr(balancer.config, "PREFIX_AFFINITY_LOAD_FACTOR", 1.25)
+
+
+def _chat(system: str, *turns: str) -> dict:
+    return {"messages": [{"role": "system", "content": system}, *({"role": "user", "content": t} for t in turns)]}
+
+
+def test_prefix_key_ignores_messages_past_the_prefix(affinity):
+    key = balancer.prefix_key("m", _chat("agent", "task", "step 1"))
+    assert key == balancer.prefix_key("m", _chat("agent", "task", "step 2", "step 3"))
+    assert key != balancer.prefix_key("m", _chat("other agent", "task"))
+    assert balancer.prefix_key("m", {"prompt": "hi"}) is None
+
+
+def test_prefix_affinity_is_off_by_default():
+    assert balancer.prefix_key("m", _chat("agent", "task")) is None
+
+
+def test_same_prefix_lands_on_the_same_server(affinity):
+    route = _route(["A", "B", "C", "D"])
+    owners = {
+        balancer.affinity_server(route, balancer.prefix_key("m", _chat(f"agent {i}", "task")), {}) for i in range(50)
+    }
+    assert owners == {"A", "B", "C", "D"}  # different prefixes spread over the tier
+    key = balancer.prefix_key("m", _chat("agent", "task"))
+    assert len({balancer.affinity_server(route, key, {}) for _ in range(5)}) == 1
+
+
+def test_overloaded_target_spills_to_the_next_server(affinity):
+    route = _route(["A", "B", "C"])
+    key = balancer.prefix_key("m", _chat("agent", "task"))
+    target = balancer.affinity_server(route, key, {})
+    spill = balancer.affinity_server(route, key, {target: 10})
+    assert spill not in (None, target)
+    assert balancer.affinity_server(_route([]), key, {}) is None  # no healthy tier: load order stands
@@ -0,0 +1,84 @@
+import asyncio
+
+import pytest
+
+from src import circuit_breaker
+from src.circuit_breaker import CircuitBreakers
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.store: dict[str, str] = {}
+
+    async def set(self, key, value, ex=None):
+        self.store[key] = value
+
+    async def delete(self, key):
+        self.store.pop(key, None)
+
+    async def mget(self, keys):
+        return [self.store.get(key) for key in keys]
+
+
+@pytest.fixture
+def env(monkeypatch):
+    fake = _FakeRedis()
+    clock = {"now": 1000.0}
+    monkeypatch.setattr(circuit_breaker, "get_redis", lambda: fake)
+    monkeypatch.setattr(circuit_breaker.time, "time", lambda: clock["now"])
+    monkeypatch.setattr(circuit_breaker.config, "CIRCUIT_FAILURE_THRESHOLD", 3)
+    monkeypatch.setattr(circuit_breaker.config, "CIRCUIT_OPEN_SECONDS", 10)
+    return fake, clock
+
+
+def _fail(breakers, server, times):
+    for _ in range(times):
+        asyncio.run(breakers.record_failure(server))
+
+
+def test_opens_after_consecutive_failures_and_demotes(env):
+    breakers = CircuitBreakers()
+    _fail(breakers, "A", 2)
+    asyncio.run(breakers.record_success("A"))  # resets the streak
+    _fail(breakers, "A", 2)
+    assert breakers.order(["A", "B"]) == ["A", "B"]
+    _fail(breakers, "A", 1)
+    assert breakers.order(["A", "B", "C"]) == ["B", "C", "A"]
+
+
+def test_half_open_sends_one_probe_then_closes(env):
+    fake, clock = env
+    breakers = CircuitBreakers()
+    _fail(breakers, "A", 3)
+    clock["now"] += 10  # open period over: half-open
+    assert not breakers.is_open("A")
+    breakers.on_attempt("A")
+    assert breakers.is_open("A")  # other requests keep avoiding it while the probe runs
+    asyncio.run(breakers.record_success("A"))
+    assert not breakers.is_open("A")
+    assert fake.store == {}
+
+
+def test_failed_probe_reopens(env):
+    _, clock = env
+    breakers = CircuitBreakers()
+    _fail(breakers, "A", 3)
+    clock["now"] += 10
+    breakers.on_attempt("A")
+    _fail(breakers, "A", 1)
+    clock["now"] += 5
+    assert breakers.is_open("A")
+
+
+def test_open_state_is_shared_through_redis(env):
+    opener, follower = CircuitBreakers(), CircuitBreakers()
+    _fail(opener, "A", 3)
+    asyncio.run(follower.sync_from_redis(["A", "B"]))
+    assert follower.order(["A", "B"]) == ["B", "A"]
+
+
+def test_disabled_with_zero_threshold(env, monkeypatch):
+    monkeypatch.setattr(circuit_breaker.config, "CIRCUIT_FAILURE_THRESHOLD", 0)
+    breakers = CircuitBreakers()
+    _fail(breakers, "A", 10)
+    assert not breakers.is_open("A")
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from src import coalescing
+from src.coalescing import BufferedResponse, SingleFlight, coalesce_key
+
+
+@pytest.fixture(autouse=True)
+def _enabled(monkeypatch):
+    monkeypatch.setattr(coalescing.config, "COALESCE_REQUESTS", True)
+
+
+def test_only_deterministic_requests_get_a_key():
+    assert coalesce_key("k", "m", "v1/embeddings", {"input": "x"}) is not None
+    assert coalesce_key("k", "m", "v1/chat/completions", {"temperature": 0}) is not None
+    assert coalesce_key("k", "m", "v1/chat/completions", {"seed": 7, "temperature": 0.8}) is not None
+    assert coalesce_key("k", "m", "v1/chat/completions", {}) is None
+    assert coalesce_key("k", "m", "v1/chat/completions", {"temperature": 0, "stream": True}) is None
+    assert coalesce_key("k", "m", "v1/chat/completions", {"seed": True}) is None
+
+
+def test_key_is_canonical_and_per_caller():
+    a = coalesce_key("k", "m", "v1/embeddings", {"input": "x", "model": "m"})
+    assert a == coalesce_key("k", "m", "v1/embeddings", {"model": "m", "input": "x"})
+    assert a != coalesce_key("other", "m", "v1/embeddings", {"input": "x", "model": "m"})
+    assert a != coalesce_key("k", "m", "v1/embeddings", {"input": "y", "model": "m"})
+    # A gzip body from one request must never reach a request that didn't accept gzip
+    assert a != coalesce_key("k", "m", "v1/embeddings", {"input": "x", "model": "m"}, "gzip")
+    gzip_br = coalesce_key("k", "m", "v1/embeddings", {"input": "x"}, "gzip, br")
+    assert gzip_br == coalesce_key("k", "m", "v1/embeddings", {"input": "x"}, "br,gzip")
+
+
+def test_disabled_by_default(monkeypatch):
+    monkeypatch.setattr(coalescing.config, "COALESCE_REQUESTS", False)
+    assert coalesce_key("k", "m", "v1/embeddings", {"input": "x"}) is None
+
+
+def test_concurrent_duplicates_share_one_fetch():
+    flight = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        headers = {"content-type": "application/json", "set-cookie": "c=1", "content-length": "2"}
+        return BufferedResponse(200, headers, b"{}")
+
+    async def scenario():
+        return await asyncio.gather(*(flight.run("key", fetch) for _ in range(5)))
+
+    responses = asyncio.run(scenario())
+    assert calls == 1
+    assert all(r.body == b"{}" and r.status_code == 200 for r in responses)
+    assert [r.headers.get("set-cookie") for r in responses] == ["c=1", None, None, None, None]
+    assert flight.stats() == {"inflight": 0, "coalesced": 4}
+
+
+def test_errors_reach_every_waiter():
+    flight = SingleFlight()
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise HTTPException(status_code=503, detail="down")
+
+    async def scenario():
+        return await asyncio.gather(*(flight.run("key", fetch) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert all(isinstance(r, HTTPException) and r.status_code == 503 for r in results)
+
+
+def test_waiters_retry_when_the_leader_is_cancelled():
+    flight = SingleFlight()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return BufferedResponse(200, {}, b"ok")
+
+    async def scenario():
+        leader = asyncio.create_task(flight.run("key", fetch))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(flight.run("key", fetch))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await waiter
+
+    assert asyncio.run(scenario()).body == b"ok"
+    assert calls == 2
@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+import pytest
+
+from src import embedding_batcher as batcher_module
+from src.coalescing import BufferedResponse
+from src.embedding_batcher import EmbeddingBatcher
+
+
+@pytest.fixture(autouse=True)
+def _config(monkeypatch):
+    monkeypatch.setattr(batcher_module.config, "EMBEDDINGS_BATCH_WINDOW_MS", 5)
+    monkeypatch.setattr(batcher_module.config, "EMBEDDINGS_BATCH_MAX_INPUTS", 4)
+    monkeypatch.setattr(batcher_module.config, "EMBEDDINGS_BATCH_MAX_TOKENS", 10_000)
+
+
+class _Upstream:
+    """Embeds each input as [len(text)], recording the batches it was sent."""
+
+    def __init__(self, status: int = 200):
+        self.batches: list = []
+        self.status = status
+
+    async def __call__(self, body):
+        self.batches.append(body["input"])
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        data = [{"index": i, "object": "embedding", "embedding": [len(t)]} for i, t in enumerate(inputs)]
+        doc = {"object": "list", "data": data, "model": "m", "usage": {"prompt_tokens": 10, "total_tokens": 10}}
+        return BufferedResponse(self.status, {"content-type": "application/json"}, json.dumps(doc).encode())
+
+
+def _run(batcher, upstream, bodies, token="k"):
+    async def scenario():
+        return await asyncio.gather(
+            *(batcher.submit(token, "v1/embeddings", {"model": "m", **b}, upstream) for b in bodies)
+        )
+
+    return [(r.status_code, json.loads(r.body)) for r in asyncio.run(scenario())]
+
+
+def test_requests_within_the_window_share_one_call():
+    batcher, upstream = EmbeddingBatcher(), _Upstream()
+    results = _run(batcher, upstream, [{"input": "a"}, {"input": ["bb", "ccc"]}])
+    assert upstream.batches == [["a", "bb", "ccc"]]
+    (_, first), (_, second) = results
+    assert [d["embedding"] for d in first["data"]] == [[1]]
+    assert [(d["index"], d["embedding"]) for d in second["data"]] == [(0, [2]), (1, [3])]
+    assert first["usage"]["prompt_tokens"] + second["usage"]["prompt_tokens"] == 10
+    assert batcher.stats()["avg_batch_size"] == 2
+
+
+def test_full_batches_are_sent_without_waiting_and_split_at_the_cap():
+    batcher, upstream = EmbeddingBatcher(), _Upstream()
+    _run(batcher, upstream, [{"input": ["a", "b", "c"]}, {"input": ["d", "e"]}])
+    assert upstream.batches == [["a", "b", "c"], ["d", "e"]]
+
+
+def test_different_parameters_or_keys_are_not_mixed():
+    batcher, upstream = EmbeddingBatcher(), _Upstream()
+    _run(batcher, upstream, [{"input": "a"}, {"input": "b", "dimensions": 8}])
+    _run(batcher, upstream, [{"input": "c"}], token="other")
+    assert sorted(upstream.batches) == ["a", "b", "c"]  # alone in their batch: sent as-is
+
+
+def test_upstream_errors_reach_every_caller():
+    batcher, upstream = EmbeddingBatcher(), _Upstream(status=400)
+    results = _run(batcher, upstream, [{"input": "a"}, {"input": "b"}])
+    assert [status for status, _ in results] == [400, 400]
+
+
+def test_large_requests_bypass_the_batcher():
+    batcher = EmbeddingBatcher()
+    assert batcher.applies("v1/embeddings", {"input": "a"})
+    assert not batcher.applies("v1/embeddings", {"input": ["a"] * 4})
+    assert not batcher.applies("v1/embeddings", {"input": [1, 2, 3]})
+    assert not batcher.applies("v1/chat/completions", {"input": "a"})
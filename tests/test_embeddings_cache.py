@@ -0,0 +1,127 @@
+import asyncio
+import json
+
+import pytest
+
+from src import embeddings_cache as cache_module
+from src.coalescing import BufferedResponse
+from src.embeddings_cache import EmbeddingsCache
+
+
+class _FakePipeline:
+    def __init__(self, store: dict):
+        self.store = store
+        self.ops: list[tuple[str, bytes]] = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def set(self, key, value, ex=None):
+        self.ops.append((key, value))
+
+    async def execute(self):
+        for key, value in self.ops:
+            self.store[key] = value.decode()  # decode_responses=True
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.store: dict[str, str] = {}
+
+    async def mget(self, keys):
+        return [self.store.get(key) for key in keys]
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self.store)
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    fake = _FakeRedis()
+    monkeypatch.setattr(cache_module, "get_redis", lambda: fake)
+    monkeypatch.setattr(cache_module.config, "EMBEDDINGS_CACHE_MB", 1)
+    monkeypatch.setattr(cache_module.config, "EMBEDDINGS_CACHE_REDIS", True)
+    monkeypatch.setattr(cache_module.config, "EMBEDDINGS_CACHE_TTL_SECONDS", 60)
+    return fake
+
+
+class _Upstream:
+    """Embeds each input as [len(text)], recording the batches it was sent."""
+
+    def __init__(self):
+        self.batches: list = []
+
+    async def __call__(self, body):
+        self.batches.append(body["input"])
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        data = [{"index": i, "object": "embedding", "embedding": [len(t)]} for i, t in enumerate(inputs)]
+        doc = {"object": "list", "data": data[::-1], "model": "m", "usage": {"prompt_tokens": len(inputs)}}
+        return BufferedResponse(200, {"content-type": "application/json"}, json.dumps(doc).encode())
+
+
+def _embed(cache, upstream, inputs):
+    response = asyncio.run(cache.serve("key", "m", {"model": "m", "input": inputs}, upstream))
+    return response.status_code, json.loads(response.body)
+
+
+def test_only_misses_are_forwarded_and_merged_in_order(redis):
+    cache, upstream = EmbeddingsCache(), _Upstream()
+    _embed(cache, upstream, ["a", "bb"])
+    status, doc = _embed(cache, upstream, ["ccc", "a", "ccc", "bb"])
+    assert status == 200
+    assert upstream.batches == [["a", "bb"], ["ccc"]]  # deduplicated misses only
+    assert [d["embedding"] for d in doc["data"]] == [[3], [1], [3], [2]]
+    assert [d["index"] for d in doc["data"]] == [0, 1, 2, 3]
+    assert doc["usage"] == {"prompt_tokens": 1}
+
+
+def test_full_hit_never_goes_upstream(redis):
+    cache, upstream = EmbeddingsCache(), _Upstream()
+    _embed(cache, upstream, "hello")
+    status, doc = _embed(cache, upstream, ["hello"])
+    assert len(upstream.batches) == 1
+    assert doc["data"] == [{"index": 0, "object": "embedding", "embedding": [5]}]
+    assert cache.stats()["hits_local"] == 1
+
+
+def test_redis_tier_is_shared_across_replicas(redis):
+    upstream = _Upstream()
+    _embed(EmbeddingsCache(), upstream, ["a"])
+    other = EmbeddingsCache()
+    _embed(other, upstream, ["a"])
+    assert len(upstream.batches) == 1
+    assert other.stats()["hits_redis"] == 1
+
+
+def test_local_tier_is_bounded_in_bytes(redis, monkeypatch):
+    monkeypatch.setattr(cache_module.config, "EMBEDDINGS_CACHE_REDIS", False)
+    cache = EmbeddingsCache()
+    for i in range(2000):
+        cache._put_local(f"k{i}", b"x" * 1024, 0.0)
+    assert cache._bytes <= 1024 * 1024
+    assert "k1999" in cache._lru and "k0" not in cache._lru
+
+
+def test_parameters_that_change_vectors_are_part_of_the_key():
+    body = {"input": "a"}
+    key = EmbeddingsCache._key
+    assert key("k", "m", body, "a") != key("k", "m", {**body, "dimensions": 64}, "a")
+    assert key("k", "m", body, "a") == key("k", "m", {**body, "encoding_format": "float"}, "a")
+
+
+def test_entries_are_never_shared_across_api_keys(redis):
+    cache, upstream = EmbeddingsCache(), _Upstream()
+    asyncio.run(cache.serve("alice", "m", {"model": "m", "input": ["a"]}, upstream))
+    asyncio.run(cache.serve("bob", "m", {"model": "m", "input": ["a"]}, upstream))
+    assert upstream.batches == [["a"], ["a"]]
+
+
+def test_upstream_errors_are_passed_through(redis):
+    async def failing(body):
+        return BufferedResponse(400, {"content-type": "application/json"}, b'{"error": "bad"}')
+
+    status, doc = _embed(EmbeddingsCache(), failing, ["a"])
+    assert (status, doc) == (400, {"error": "bad"})
@@ -0,0 +1,73 @@
+import base64
+import json
+import math
+import struct
+
+import pytest
+
+from src import embeddings_format
+from src.coalescing import BufferedResponse
+from src.embeddings_format import transcode, upstream_body
+
+
+@pytest.fixture(autouse=True)
+def _enabled(monkeypatch):
+    monkeypatch.setattr(embeddings_format.config, "EMBEDDINGS_TRANSCODE", True)
+
+
+def _b64(values):
+    return base64.b64encode(struct.pack(f"<{len(values)}f", *values)).decode()
+
+
+def _unb64(text):
+    raw = base64.b64decode(text)
+    return list(struct.unpack(f"<{len(raw) // 4}f", raw))
+
+
+def _response(*embeddings):
+    data = [{"index": i, "object": "embedding", "embedding": e} for i, e in enumerate(embeddings)]
+    return BufferedResponse(200, {}, json.dumps({"data": data, "model": "m"}).encode())
+
+
+def test_upstream_body_only_changes_when_the_proxy_has_work():
+    assert upstream_body({"input": "a"}) is None
+    assert upstream_body({"input": "a", "encoding_format": "float"}) is None
+    assert upstream_body({"input": "a", "dimensions": 2}) == {"input": "a", "encoding_format": "base64"}
+    assert upstream_body({"input": "a", "encoding_format": "base64"}) == {"input": "a", "encoding_format": "base64"}
+
+
+def test_disabled_by_default(monkeypatch):
+    monkeypatch.setattr(embeddings_format.config, "EMBEDDINGS_TRANSCODE", False)
+    assert upstream_body({"input": "a", "dimensions": 2}) is None
+
+
+def test_base64_upstream_to_truncated_renormalized_floats():
+    out = transcode(_response(_b64([3.0, 4.0, 12.0])), {"dimensions": 2})
+    (item,) = json.loads(out.body)["data"]
+    assert item["embedding"] == pytest.approx([0.6, 0.8])
+    assert math.hypot(*item["embedding"]) == pytest.approx(1.0)
+
+
+def test_float_upstream_to_base64():
+    out = transcode(_response([1.0, 0.5], [0.25, 2.0]), {"encoding_format": "base64"})
+    data = json.loads(out.body)["data"]
+    assert [_unb64(d["embedding"]) for d in data] == [[1.0, 0.5], [0.25, 2.0]]
+
+
+def test_mixed_lengths_and_zero_vectors():
+    out = transcode(_response(_b64([0.0, 0.0, 0.0]), _b64([1.0, 1.0])), {"dimensions": 2, "encoding_format": "base64"})
+    data = json.loads(out.body)["data"]
+    assert _unb64(data[0]["embedding"]) == [0.0, 0.0]
+    assert _unb64(data[1]["embedding"]) == [1.0, 1.0]  # already within `dimensions`: untouched
+
+
+def test_errors_and_unparseable_bodies_pass_through():
+    error = BufferedResponse(400, {}, b'{"error": "bad"}')
+    assert transcode(error, {"dimensions": 2}) is error
+    garbage = BufferedResponse(200, {}, b"not json")
+    assert transcode(garbage, {"dimensions": 2}) is garbage
+
+
+def test_base64_without_dimensions_is_passed_through():
+    upstream = _response(_b64([1.0, 0.5]))
+    assert transcode(upstream, {"encoding_format": "base64"}) is upstream
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from src import health
+from src.health import ServerHealthMonitor
+
+
+class _Redis:
+    def __init__(self):
+        self.values = {}
+        self.hashes = {}
+        self.hset_calls = []
+
+    async def set(self, key, value):
+        self.values[key] = value
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def pipeline(self, transaction=True):
+        return _Pipeline(self)
+
+
+class _Pipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.ops = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def hset(self, key, field, value):
+        self.ops.append(("hset", key, field, value))
+
+    def incr(self, key):
+        self.ops.append(("incr", key))
+
+    async def execute(self):
+        for op in self.ops:
+            if op[0] == "hset":
+                self.redis.hset_calls.append(op[2])
+                self.redis.hashes.setdefault(op[1], {})[op[2]] = op[3]
+            else:
+                self.redis.values[op[1]] = str(int(self.redis.values.get(op[1], 0)) + 1)
+
+
+class _Routing:
+    def update_health(self, healthy, capable):
+        self.healthy, self.capable = healthy, capable
+
+
+@pytest.fixture
+def monitor(monkeypatch):
+    redis = _Redis()
+    monkeypatch.setattr(health, "routing_table", _Routing())
+    monkeypatch.setattr(health, "get_redis", lambda: redis)
+    m = ServerHealthMonitor()
+    m.model_urls = {"a": ["http://one", "http://two"], "b": ["http://one", "http://dead"], "c": ["http://dead"]}
+    return m
+
+
+def _serve(monitor, handler):
+    monitor._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_sweep_groups_probes_by_server_and_skips_unreachable_boxes(monitor):
+    seen: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(f"{request.url.host}{request.url.path}")
+        if request.url.host == "dead":
+            raise httpx.ConnectError("refused")
+        return httpx.Response(202 if request.url.path == "/health/b" else 200)
+
+    async def scenario():
+        _serve(monitor, handler)
+        await monitor.check_all_servers()
+        await monitor.aclose()
+
+    asyncio.run(scenario())
+    assert sorted(seen) == ["dead/health/b", "one/health/a", "one/health/b", "two/health/a"]
+    assert monitor.healthy_model_urls == {"a": ["http://one", "http://two"], "b": [], "c": []}
+    assert monitor.capable_model_urls == {"a": [], "b": ["http://one"], "c": []}
+    stats = monitor.stats()
+    assert (stats["sweeps"], stats["last_sweep_probes"], stats["last_sweep_failures"]) == (1, 5, 2)
+    snapshot = json.loads(health.get_redis().values[health.REDIS_KEY])
+    assert snapshot["healthy_model_urls"]["a"] == ["http://one", "http://two"]
+
+
+def test_servers_are_probed_in_parallel_up_to_the_limit(monitor, monkeypatch):
+    monkeypatch.setattr(health.config, "HEALTH_CHECK_CONCURRENCY", 2)
+    monitor.model_urls = {"a": [f"http://s{i}" for i in range(6)]}
+    active = peak = 0
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        return httpx.Response(200)
+
+    async def scenario():
+        _serve(monitor, handler)
+        await monitor.check_all_servers()
+        await monitor.aclose()
+
+    asyncio.run(scenario())
+    assert peak == 2
+    assert len(monitor.healthy_model_urls["a"]) == 6
+
+
+def test_probe_client_is_shared_and_closed():
+    m = ServerHealthMonitor()
+    client = m._get_client()
+    assert m._get_client() is client
+    asyncio.run(m.aclose())
+    assert client.is_closed and m._client is None
+
+
+def test_scraped_queue_depth_feeds_routing_and_the_snapshot(monitor, monkeypatch):
+    monkeypatch.setattr(health.config, "UPSTREAM_METRICS", True)
+    monitor.model_urls = {"a": ["http://one", "http://two"]}
+    pages = {
+        "one": "vllm:num_requests_running 6\nvllm:num_requests_waiting 2\nvllm:generation_tokens_total 100\n",
+        "two": "vllm:num_requests_running 1\n",
+    }
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/metrics":
+            return httpx.Response(200, text=pages[request.url.host])
+        return httpx.Response(200)
+
+    async def scenario():
+        _serve(monitor, handler)
+        await monitor.check_all_servers()
+        pages["one"] = pages["one"].replace("100", "400")
+        await monitor.check_all_servers()
+        await monitor.aclose()
+
+    asyncio.run(scenario())
+    one = monitor.get_server_metrics("http://one")
+    assert (one.requests_processing, one.requests_deferred, one.load_score) == (6, 2, 8)
+    assert one.tokens_per_second is not None and one.tokens_per_second > 0
+    assert monitor.get_least_busy_server("a") == "http://two"
+    # Leases win where they are higher; scraped depth where the box is busier than we know
+    assert monitor.routing_loads(["http://one", "http://two"], {"http://two": 3}) == {"http://one": 8, "http://two": 3}
+    snapshot = json.loads(health.get_redis().values[health.REDIS_KEY])
+    assert snapshot["server_metrics"]["http://one"]["requests_processing"] == 6
+
+
+def test_routing_loads_unchanged_without_scraping(monitor):
+    monitor.server_metrics = {"http://one": health.ServerMetrics(requests_processing=9)}
+    loads = {"http://one": 1}
+    assert monitor.routing_loads(["http://one"], loads) is loads
+
+
+def test_adaptive_probing_backs_off_when_stable_and_publishes_only_changes(monitor, monkeypatch):
+    monkeypatch.setattr(health.config, "HEALTH_PROBE_MIN_SECONDS", 2)
+    monkeypatch.setattr(health.config, "HEALTH_PROBE_MAX_SECONDS", 30)
+    monkeypatch.setattr(health, "JITTER", 0)
+    monitor.model_urls = {"a": ["http://one", "http://two"]}
+    up = {"one": True, "two": True}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200 if up[request.url.host] else 503)
+
+    async def probe(url):
+        monitor._schedule[url].next_due = 0
+        await monitor.probe_due()
+        await asyncio.gather(*monitor._probe_tasks)
+
+    async def scenario():
+        _serve(monitor, handler)
+        await monitor.probe_due()  # first term: full sweep, everything published once
+        assert sorted(health.get_redis().hset_calls) == ["http://one", "http://two"]
+        assert health.REDIS_KEY not in health.get_redis().values
+        health.get_redis().hset_calls.clear()
+
+        await probe("http://one")
+        await probe("http://one")
+        assert monitor._schedule["http://one"].interval == 8  # unchanged twice: 2 -> 4 -> 8
+        assert health.get_redis().hset_calls == []
+
+        up["one"] = False
+        await probe("http://one")
+        assert monitor._schedule["http://one"].interval == 2
+        assert monitor.healthy_model_urls["a"] == ["http://two"]
+        assert health.get_redis().hset_calls == ["http://one"]
+        for _ in range(5):
+            await probe("http://one")
+        assert monitor._schedule["http://one"].interval == 30 * health.DOWN_MAX_FRACTION
+        await monitor.aclose()
+
+    asyncio.run(scenario())
+    assert monitor.transitions == 1
+
+
+def test_followers_apply_published_changes(monitor, monkeypatch):
+    monkeypatch.setattr(health.config, "HEALTH_PROBE_MIN_SECONDS", 2)
+    monitor.model_urls = {"a": ["http://one", "http://two"], "b": ["http://one"]}
+    redis = health.get_redis()
+    redis.values[health.VERSION_KEY] = "3"
+    redis.hashes[health.SERVERS_KEY] = {
+        "http://one": json.dumps(
+            {"models": {"a": [True, True], "b": [True, False]}, "metrics": {"requests_deferred": 4}}
+        ),
+        "http://two": json.dumps({"models": {"a": [False, False]}}),
+    }
+    follower = ServerHealthMonitor()
+    follower.model_urls = monitor.model_urls
+
+    asyncio.run(follower.sync_from_redis())
+    assert follower.healthy_model_urls == {"a": ["http://one"], "b": []}
+    assert follower.capable_model_urls == {"a": [], "b": ["http://one"]}
+    assert follower.get_server_metrics("http://one").requests_deferred == 4
+
+    redis.hashes[health.SERVERS_KEY]["http://two"] = json.dumps({"models": {"a": [True, True]}})
+    asyncio.run(follower.sync_changes())  # version unchanged: nothing re-read
+    assert follower.healthy_model_urls["a"] == ["http://one"]
+    redis.values[health.VERSION_KEY] = "4"
+    asyncio.run(follower.sync_changes())
+    assert follower.healthy_model_urls["a"] == ["http://one", "http://two"]
+
+
+def test_failed_probe_is_rescheduled(monitor, monkeypatch):
+    monkeypatch.setattr(health.config, "HEALTH_PROBE_MIN_SECONDS", 2)
+    monkeypatch.setattr(health, "JITTER", 0)
+    monitor.model_urls = {"a": ["http://one"]}
+
+    async def scenario():
+        _serve(monitor, lambda request: httpx.Response(200))
+        await monitor.probe_due()  # first term: full sweep
+
+        async def _broken(*args):
+            raise RuntimeError("boom")
+
+        monkeypatch.setattr(monitor, "_check_box", _broken)
+        entry = monitor._schedule["http://one"]
+        entry.next_due = 0
+        await monitor.probe_due()
+        await asyncio.gather(*monitor._probe_tasks)
+        await monitor.aclose()
+        return entry
+
+    entry = asyncio.run(scenario())
+    assert entry.next_due > time.monotonic() + 1  # not due again on every tick
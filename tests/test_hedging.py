@@ -0,0 +1,99 @@
+import asyncio
+
+import httpx
+import pytest
+
+import src.proxy as proxy
+from src import hedging
+from src.hedging import HedgePolicy
+
+
+@pytest.fixture
+def policy(monkeypatch):
+    monkeypatch.setattr(hedging.config, "HEDGE_MODELS", {"m"})
+    monkeypatch.setattr(hedging.config, "HEDGE_BUDGET_PERCENT", 50)
+    return HedgePolicy()
+
+
+def test_threshold_is_p95_once_warmed_up(policy):
+    for i in range(hedging.MIN_SAMPLES - 1):
+        policy.observe("m", i / 10)
+    assert policy.delay("m") is None
+    for i in range(hedging.MIN_SAMPLES - 1, 100):
+        policy.observe("m", i / 10)
+    assert policy.delay("m") == pytest.approx(9.4)
+    assert policy.delay("other") is None  # not opted in
+
+
+def test_budget_caps_extra_load(policy):
+    hedges = 0
+    for _ in range(10):
+        policy.delay("m")
+        hedges += policy.try_spend()
+    assert hedges == 5  # 50% of 10 eligible requests
+
+
+@pytest.fixture
+def upstreams(monkeypatch):
+    """Upstream "slow" answers after 100ms, 'fast' at once; records leases and closes."""
+    monkeypatch.setattr(proxy, "hedge_policy", HedgePolicy())
+    proxy.hedge_policy._credits = 1
+    leases: dict = {"held": set(), "closed": []}
+
+    async def _acquire(server, request_id):
+        leases["held"].add((server, request_id))
+
+    async def _release(server, request_id):
+        leases["held"].discard((server, request_id))
+
+    async def _send(req, stream=False):
+        host = req.url.host
+        if host.startswith("slow"):
+            await asyncio.sleep(0.1)
+        return httpx.Response(503 if host.endswith("broken") else 200, content=host.encode(), request=req)
+
+    monkeypatch.setattr(proxy, "load_acquire", _acquire)
+    monkeypatch.setattr(proxy, "load_release", _release)
+    monkeypatch.setattr(proxy.client, "send", _send)
+    return leases
+
+
+def _hedged(primary: str, backup: str, leases: dict, tried: set[str] | None = None):
+    def build(server):
+        return httpx.Request("POST", f"http://{server}/v1/embeddings")
+
+    async def scenario():
+        leases["held"].add((primary, "r1"))  # the caller's lease
+        server, request_id, response, started = await proxy._send_hedged(
+            build(primary), primary, "r1", backup, build, 0.01, set() if tried is None else tried
+        )
+        leases["started"] = started
+        return server, request_id, await response.aread()
+
+    return asyncio.run(scenario())
+
+
+def test_slow_primary_loses_to_the_hedge(upstreams):
+    server, request_id, content = _hedged("slow", "fast", upstreams)
+    assert (server, content) == ("fast", b"fast")
+    assert upstreams["held"] == {("fast", request_id)}  # primary's lease released, winner's handed over
+
+
+def test_failed_hedge_keeps_waiting_for_the_primary(upstreams):
+    server, request_id, content = _hedged("slow", "broken", upstreams)
+    assert (server, request_id, content) == ("slow", "r1", b"slow")
+    assert upstreams["held"] == {("slow", "r1")}
+
+
+def test_both_failing_marks_the_backup_as_tried(upstreams):
+    tried: set[str] = set()
+    server, request_id, content = _hedged("slow-broken", "broken", upstreams, tried)
+    assert (server, request_id, content) == ("slow-broken", "r1", b"slow-broken")  # the caller fails over
+    assert tried == {"broken"}
+    assert upstreams["held"] == {("slow-broken", "r1")}
+
+
+def test_no_budget_no_hedge(upstreams):
+    proxy.hedge_policy._credits = 0
+    server, _, content = _hedged("slow", "fast", upstreams)
+    assert (server, content) == ("slow", b"slow")
@@ -1,26 +1,15 @@
 import asyncio
 from unittest.mock import patch
 
-from src import load_tracker
-from src.load_tracker import _prune_and_count, acquire, get_all_loads, release
-
+import pytest
 
-def test_prune_and_count_counts_live_drops_expired_and_malformed():
-    now = 1000.0
-    entries = {
-        "live1": f"{now + 100}",
-        "live2": f"{now + 5}",
-        "expired": f"{now - 1}",  # past deadline — must not count
-        "garbage": "not-a-lease",  # malformed — must not count
-    }
-    live, expired = _prune_and_count(entries, now)
-    assert live == 2
-    assert set(expired) == {"expired", "garbage"}
+from src import load_tracker
+from src.load_tracker import acquire, flush, get_all_loads, migrate_legacy_leases, release
 
 
 class _FakePipe:
-    def __init__(self, store):
-        self._store = store
+    def __init__(self, redis):
+        self._redis = redis
         self._ops: list[tuple] = []
 
     async def __aenter__(self):
@@ -29,53 +18,91 @@ class _FakePipe:
     async def __aexit__(self, *_):
         return False
 
-    def hgetall(self, key):
-        self._ops.append(("hgetall", key))
+    def zadd(self, key, mapping, xx=False):
+        self._ops.append(("zadd", key, dict(mapping), xx))
         return self
 
-    def hset(self, key, field, value):
-        self._ops.append(("hset", key, field, value))
+    def zrem(self, key, *members):
+        self._ops.append(("zrem", key, members))
         return self
 
     def expire(self, key, ttl):
         self._ops.append(("expire", key, ttl))
         return self
 
-    def hdel(self, key, *fields):
-        self._ops.append(("hdel", key, fields))
-        return self
-
     async def execute(self):
+        await asyncio.sleep(0)  # a real round trip yields to other tasks
+        if self._redis.down:
+            raise ConnectionError("Redis is down")
         res = []
         for op in self._ops:
-            if op[0] == "hgetall":
-                res.append(dict(self._store.get(op[1], {})))
-            elif op[0] == "hset":
-                self._store.setdefault(op[1], {})[op[2]] = op[3]
-                res.append(1)
-            elif op[0] == "expire":
-                res.append(True)
-            elif op[0] == "hdel":
-                h = self._store.get(op[1], {})
-                for f in op[2]:
-                    h.pop(f, None)
-                res.append(1)
+            if op[0] == "zadd":
+                z = self._redis.zsets.setdefault(op[1], {})
+                z.update({m: score for m, score in op[2].items() if not op[3] or m in z})
+            elif op[0] == "zrem":
+                for m in op[2]:
+                    self._redis.zsets.get(op[1], {}).pop(m, None)
+            res.append(1)
         self._ops = []
         return res
 
 
+class _FakeScript:
+    """Python stand-ins for the Lua scripts (same semantics, no Redis needed)."""
+
+    def __init__(self, redis, source):
+        self._redis = redis
+        self._source = source
+
+    async def __call__(self, keys, args):
+        zsets = self._redis.zsets
+        if self._source == load_tracker.COUNT_SCRIPT:
+            now = float(args[0])
+            counts = []
+            for key in keys:
+                z = zsets.get(key, {})
+                for m in [m for m, score in z.items() if score <= now]:
+                    del z[m]
+                counts.append(len(z))
+            return counts
+        legacy, zkey = keys
+        moved = 0
+        for rid, val in self._redis.hashes.pop(legacy, {}).items():
+            try:
+                deadline = float(val)
+            except ValueError:
+                continue
+            if deadline > float(args[0]):
+                z = zsets.setdefault(zkey, {})
+                z[rid] = max(z.get(rid, deadline), deadline)
+                moved += 1
+        return moved
+
+
 class _FakeRedis:
     def __init__(self):
-        self.store: dict[str, dict[str, str]] = {}
+        self.zsets: dict[str, dict[str, float]] = {}
+        self.hashes: dict[str, dict[str, str]] = {}
+        self.pipelines = 0
+        self.down = False
 
     def pipeline(self, transaction=False):
-        return _FakePipe(self.store)
+        self.pipelines += 1
+        return _FakePipe(self)
+
+    def register_script(self, source):
+        return _FakeScript(self, source)
 
-    async def hdel(self, key, field):
-        self.store.get(key, {}).pop(field, None)
+    async def zrem(self, key, member):
+        self.zsets.get(key, {}).pop(member, None)
         return 1
 
 
+@pytest.fixture(autouse=True)
+def _fresh_registry(monkeypatch):
+    monkeypatch.setattr(load_tracker, "_live", {})
+
+
 def _run(fake, models, coro_factory, clock=None):
     with patch.object(load_tracker, "get_redis", return_value=fake), patch.object(
         load_tracker.config, "MODELS", models
@@ -122,8 +149,8 @@ def test_unreleased_lease_self_heals_after_ttl():
     t["now"] = 1000.0 + load_tracker.LEASE_TTL + 1
     healed = _run(fake, models, get_all_loads, clock=lambda: t["now"])
     assert healed == {"A": 0}
-    # And the stale field was pruned from Redis.
-    assert fake.store.get(load_tracker._key("A"), {}) == {}
+    # And the stale lease was pruned from Redis.
+    assert fake.zsets.get(load_tracker._key("A"), {}) == {}
 
 
 def test_reacquire_keeps_long_stream_counted_past_original_ttl():
@@ -145,3 +172,171 @@ def test_reacquire_keeps_long_stream_counted_past_original_ttl():
     t["now"] = 1000.0 + load_tracker.LEASE_TTL + 10  # past original deadline
     loads = _run(fake, models, get_all_loads, clock=lambda: t["now"])
     assert loads == {"A": 1}  # still counted thanks to the refresh
+
+
+def test_refresher_extends_live_leases_only():
+    fake = _FakeRedis()
+    models = {"m": ["A", "B"]}
+    t = {"now": 1000.0}
+
+    async def start():
+        await acquire("A", "long")
+        await acquire("B", "short")
+        await release("B", "short")
+
+    async def refresh():
+        pipelines = fake.pipelines
+        await load_tracker.refresh_live_leases()
+        assert fake.pipelines == pipelines + 1  # every live lease in one round trip
+
+    _run(fake, models, start, clock=lambda: t["now"])
+    t["now"] = 1000.0 + load_tracker.LEASE_REFRESH_INTERVAL
+    _run(fake, models, refresh, clock=lambda: t["now"])
+
+    t["now"] = 1000.0 + load_tracker.LEASE_TTL + 10  # past the original deadline
+    assert _run(fake, models, get_all_loads, clock=lambda: t["now"]) == {"A": 1, "B": 0}
+    assert "short" not in fake.zsets.get(load_tracker._key("B"), {})  # released, not re-added
+
+
+def test_refresh_does_not_resurrect_a_release_it_raced():
+    fake = _FakeRedis()
+
+    async def scenario():
+        await acquire("A", "r1")
+        refreshing = asyncio.create_task(load_tracker.refresh_live_leases())
+        await asyncio.sleep(0)  # pipeline in flight
+        await release("A", "r1")
+        await refreshing
+        return await get_all_loads()
+
+    assert _run(fake, {"m": ["A"]}, scenario) == {"A": 0}
+
+
+def _batched(monkeypatch):
+    monkeypatch.setattr(load_tracker.config, "LOAD_FLUSH_INTERVAL_MS", 50)
+    monkeypatch.setattr(load_tracker, "_buffer", load_tracker.LeaseBuffer())
+
+
+def test_batched_acquire_release_within_interval_never_hits_redis(monkeypatch):
+    _batched(monkeypatch)
+    fake = _FakeRedis()
+
+    async def scenario():
+        await acquire("A", "r1")
+        await release("A", "r1")
+        await flush()
+
+    _run(fake, {"m": ["A"]}, scenario)
+    assert fake.pipelines == 0
+    assert fake.zsets == {}
+
+
+def test_batched_loads_count_unflushed_local_leases(monkeypatch):
+    _batched(monkeypatch)
+    fake = _FakeRedis()
+    fake.zsets[load_tracker._key("A")] = {"other-replica": 9999999999.0}
+
+    async def scenario():
+        await acquire("A", "r1")
+        assert await get_all_loads() == {"A": 2}  # Redis view + our unflushed acquire
+        await flush()
+        assert await get_all_loads() == {"A": 2}  # now in Redis, not double counted
+        await release("A", "r1")
+        assert await get_all_loads() == {"A": 1}  # unflushed release already subtracted
+        await flush()
+        return await get_all_loads()
+
+    assert _run(fake, {"m": ["A"]}, scenario) == {"A": 1}
+    assert fake.zsets[load_tracker._key("A")] == {"other-replica": 9999999999.0}
+
+
+def test_batched_release_during_inflight_flush_is_not_lost(monkeypatch):
+    _batched(monkeypatch)
+    fake = _FakeRedis()
+
+    async def scenario():
+        await acquire("A", "r1")
+        flushing = asyncio.create_task(flush())
+        await asyncio.sleep(0)  # flush has swapped its batch and is awaiting Redis
+        await release("A", "r1")  # lands while r1 is being written
+        await flushing
+        await flush()
+
+    _run(fake, {"m": ["A"]}, scenario)
+    assert fake.zsets[load_tracker._key("A")] == {}
+
+
+def test_batched_release_is_retried_after_a_failed_flush(monkeypatch):
+    _batched(monkeypatch)
+    fake = _FakeRedis()
+
+    async def scenario():
+        await acquire("A", "r1")
+        await flush()
+        await release("A", "r1")
+        fake.down = True
+        await flush()
+        fake.down = False
+        assert await get_all_loads() == {"A": 0}  # the pending release still counts locally
+        await flush()
+
+    _run(fake, {"m": ["A"]}, scenario)
+    assert fake.zsets[load_tracker._key("A")] == {}
+
+
+def test_legacy_hash_leases_are_migrated_live_only():
+    fake = _FakeRedis()
+    fake.hashes[load_tracker._legacy_key("A")] = {"live": "1100.0", "expired": "900.0", "garbage": "not-a-lease"}
+
+    async def scenario():
+        await migrate_legacy_leases()
+        return await get_all_loads()
+
+    assert _run(fake, {"m": ["A"]}, scenario, clock=lambda: 1000.0) == {"A": 1}
+    assert fake.hashes == {}
+    assert fake.zsets[load_tracker._key("A")] == {"live": 1100.0}
+
+
+class _CountingRedis(_FakeRedis):
+    def __init__(self):
+        super().__init__()
+        self.counted: list[list[str]] = []
+
+    def register_script(self, source):
+        script = super().register_script(source)
+
+        async def counting(keys, args):
+            self.counted.append(list(keys))
+            return await script(keys=keys, args=args)
+
+        return counting
+
+
+def test_get_loads_reads_only_the_route_servers_without_snapshot():
+    fake = _CountingRedis()
+
+    async def scenario():
+        await acquire("B", "r1")
+        return await load_tracker.get_loads(("B",))
+
+    assert _run(fake, {"m1": ["A"], "m2": ["B"]}, scenario) == {"B": 1}
+    assert fake.counted == [[load_tracker._key("B")]]
+
+
+def test_fresh_snapshot_serves_loads_from_memory(monkeypatch):
+    monkeypatch.setattr(load_tracker.config, "LOAD_SNAPSHOT_INTERVAL_MS", 100)
+    monkeypatch.setattr(load_tracker, "_snapshot", load_tracker.LoadSnapshot())
+    fake = _CountingRedis()
+
+    async def scenario():
+        await acquire("A", "r1")
+        await load_tracker._snapshot.refresh()
+        fake.counted.clear()
+        first = await load_tracker.get_loads(("A",))
+        # Gone stale (refresher stopped): fall back to a direct read of the route's servers.
+        load_tracker._snapshot.taken_at -= 1
+        second = await load_tracker.get_loads(("A",))
+        return first, second
+
+    assert _run(fake, {"m": ["A", "B"]}, scenario) == ({"A": 1, "B": 0}, {"A": 1})
+    assert fake.counted == [[load_tracker._key("A")]]
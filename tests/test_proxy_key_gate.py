@@ -38,7 +38,7 @@ def test_blocked_key_gets_403_before_any_upstream_call(monkeypatch):
     # Register the model so the request clears the 404 model-resolution check
     # that runs before the key gate, without ever reaching an upstream server.
     monkeypatch.setattr(proxy.config, "MODELS", {"m": ["http://up"]})
-    monkeypatch.setattr(proxy.aleph_service, "resolve", lambda model: model)
+    proxy.routing_table.update_aleph({}, set(), set())  # no redirections
 
     KeysManager().invalid_keys = {"blocked": {"reason": "no_credits", "message": "No credits."}}
 
@@ -63,9 +63,9 @@ def test_valid_key_passes_the_gate(monkeypatch):
     # gate to the forwarding loop. Upstream is stubbed to refuse connections, so
     # reaching the all-servers-failed 503 proves the gate didn't over-block.
     monkeypatch.setattr(proxy.config, "MODELS", {"m": ["http://up"]})
-    monkeypatch.setattr(proxy.aleph_service, "resolve", lambda model: model)
+    proxy.routing_table.update_aleph({}, set(), set())  # no redirections
 
-    async def _no_loads():
+    async def _no_loads(servers):
         return {}
 
     async def _noop(*args, **kwargs):
@@ -74,7 +74,7 @@ def test_valid_key_passes_the_gate(monkeypatch):
     async def _refuse(*args, **kwargs):
         raise httpx.ConnectError("refused")
 
-    monkeypatch.setattr(proxy, "get_all_loads", _no_loads)
+    monkeypatch.setattr(proxy, "get_loads", _no_loads)
     monkeypatch.setattr(proxy, "load_acquire", _noop)
     monkeypatch.setattr(proxy, "load_release", _noop)
     monkeypatch.setattr(proxy.client, "send", _refuse)
@@ -95,9 +95,9 @@ def test_key_in_both_sets_treated_as_valid(monkeypatch):
     # Defensive overlap case: the valid set wins over the invalid map (the two
     # are disjoint by construction), matching auth/check and the box-side check.
     monkeypatch.setattr(proxy.config, "MODELS", {"m": ["http://up"]})
-    monkeypatch.setattr(proxy.aleph_service, "resolve", lambda model: model)
+    proxy.routing_table.update_aleph({}, set(), set())  # no redirections
 
-    async def _no_loads():
+    async def _no_loads(servers):
         return {}
 
     async def _noop(*args, **kwargs):
@@ -106,7 +106,7 @@ def test_key_in_both_sets_treated_as_valid(monkeypatch):
     async def _refuse(*args, **kwargs):
         raise httpx.ConnectError("refused")
 
-    monkeypatch.setattr(proxy, "get_all_loads", _no_loads)
+    monkeypatch.setattr(proxy, "get_loads", _no_loads)
     monkeypatch.setattr(proxy, "load_acquire", _noop)
     monkeypatch.setattr(proxy, "load_release", _noop)
     monkeypatch.setattr(proxy.client, "send", _refuse)
@@ -129,7 +129,7 @@ def test_no_auth_request_still_reaches_x402_payment_flow(monkeypatch):
     from fastapi.responses import JSONResponse
 
     monkeypatch.setattr(proxy.config, "MODELS", {"m": ["http://up"]})
-    monkeypatch.setattr(proxy.aleph_service, "resolve", lambda model: model)
+    proxy.routing_table.update_aleph({}, set(), set())  # no redirections
 
     async def _max_price(model, body_json):
         return 1.0
@@ -0,0 +1,165 @@
+import asyncio
+import base64
+import json
+
+import pytest
+
+from src import rate_limit as rate_limit_module
+from src.api_keys import parse_limits
+from src.rate_limit import Limits, RateLimiter, estimate_tokens, identity_for_key, limits_from
+from src.request_context import RequestContext
+from src.x402 import X402Manager
+
+
+class _FakeScript:
+    """Applies SYNC_SCRIPT's semantics in Python: shared buckets and per-replica inflight."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.store = redis.store
+
+    async def __call__(self, keys, args):
+        if self.redis.fail:
+            raise ConnectionError("down")
+        now, replica = float(args[0]), args[1]
+        out = []
+        for i in range(len(keys) // 2):
+            a = 3 + i * 7
+            levels = []
+            for j in range(2):
+                rate, cap, used = (float(x) for x in args[a + 3 * j : a + 3 * j + 3])
+                level = cap
+                if rate > 0:
+                    prev, ts = self.store.get((keys[2 * i], j), (cap, now))
+                    level = min(cap, prev + (now - ts) * rate) - used
+                    self.store[(keys[2 * i], j)] = (level, now)
+                levels.append(str(level))
+            inflight = self.store.setdefault(keys[2 * i + 1], {})
+            inflight[replica] = int(args[a + 6])
+            out.append([levels[0], levels[1], sum(inflight.values())])
+        return out
+
+
+class _FakeRedis:
+    def __init__(self):
+        self.store: dict = {}
+        self.fail = False
+        self.registered = 0
+
+    def register_script(self, script):
+        self.registered += 1
+        return _FakeScript(self)
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    fake = _FakeRedis()
+    monkeypatch.setattr(rate_limit_module, "get_redis", lambda: fake)
+    return fake
+
+
+def test_unlimited_callers_are_not_tracked():
+    limiter = RateLimiter()
+    release = limiter.acquire("key:a", Limits(), 10_000)
+    assert callable(release)
+    assert limiter.inflight("key:a") == 0
+
+
+def test_request_bucket_allows_a_burst_then_asks_to_retry():
+    limiter = RateLimiter()
+    limits = Limits(rps=1)
+    assert callable(limiter.acquire("key:a", limits, 0))
+    assert callable(limiter.acquire("key:a", limits, 0))  # burst of BURST_SECONDS x rps
+    wait = limiter.acquire("key:a", limits, 0)
+    assert isinstance(wait, float) and 0 < wait <= 1
+    assert callable(limiter.acquire("key:b", limits, 0))  # other callers are unaffected
+
+
+def test_token_bucket_admits_an_oversized_request_only_when_full():
+    limiter = RateLimiter()
+    limits = Limits(tps=100)
+    assert callable(limiter.acquire("key:a", limits, 1_000))
+    assert isinstance(limiter.acquire("key:a", limits, 1), float)
+
+
+def test_token_estimate_counts_prompt_text_not_media():
+    image = {"type": "image_url", "image_url": {"url": "data:image/png;base64," + "A" * 400_000}}
+    body = {"messages": [{"role": "user", "content": [{"type": "text", "text": "x" * 400}, image]}], "max_tokens": 50}
+    scope = {"type": "http", "headers": [], "query_string": b""}
+    ctx = RequestContext(scope, "v1/chat/completions", json.dumps(body).encode())
+    assert estimate_tokens(ctx) == len("user\n" + "x" * 400) // 4 + 50
+
+
+def test_an_oversized_request_drains_at_most_one_full_bucket():
+    limiter = RateLimiter()
+    limits = Limits(tps=100)
+    limiter.acquire("key:a", limits, 10_000_000)
+    assert limiter._identities["key:a"].tokens.level == 0
+
+
+def test_concurrency_cap_frees_on_release():
+    limiter = RateLimiter()
+    limits = Limits(concurrency=1)
+    release = limiter.acquire("key:a", limits, 0)
+    assert callable(release)
+    assert limiter.acquire("key:a", limits, 0) == 1.0
+    release()
+    release()  # idempotent
+    assert limiter.inflight("key:a") == 0
+    assert callable(limiter.acquire("key:a", limits, 0))
+
+
+def test_replicas_share_buckets_and_inflight_through_sync(redis):
+    a, b = RateLimiter(), RateLimiter()
+    limits = Limits(rps=1, concurrency=2)
+
+    async def scenario():
+        held = [a.acquire("key:x", limits, 0), a.acquire("key:x", limits, 0), b.acquire("key:x", limits, 0)]
+        await a.sync()
+        await b.sync()  # b learns about a's two inflight requests
+        return held
+
+    held = asyncio.run(scenario())
+    assert all(callable(h) for h in held)
+    assert b.acquire("key:x", limits, 0) == 1.0  # the cap of 2 is exceeded cluster-wide
+    # The shared request bucket was drained by both replicas
+    assert b._identities["key:x"].requests.level < 0
+
+
+def test_failed_sync_keeps_consumption_for_the_next_one(redis):
+    limiter = RateLimiter()
+    limiter.acquire("key:x", Limits(rps=5), 0)
+    redis.fail = True
+    asyncio.run(limiter.sync())
+    assert limiter._identities["key:x"].requests.used == 1
+    redis.fail = False
+    asyncio.run(limiter.sync())
+    assert limiter._identities["key:x"].requests.used == 0
+    assert redis.registered == 1  # the script is registered once, not on every sync
+
+
+def test_backend_limits_override_defaults(monkeypatch):
+    monkeypatch.setattr(rate_limit_module.config, "RATE_LIMIT_RPS", 2.0)
+    monkeypatch.setattr(rate_limit_module.config, "RATE_LIMIT_TPS", 0.0)
+    monkeypatch.setattr(rate_limit_module.config, "RATE_LIMIT_CONCURRENCY", 4)
+    assert limits_from(None) == Limits(rps=2, tps=0, concurrency=4)
+    assert limits_from({"rps": 10, "concurrency": "bad"}) == Limits(rps=10, tps=0, concurrency=4)
+
+
+def test_identity_never_contains_the_raw_key():
+    identity = identity_for_key("sk-secret")
+    assert "sk-secret" not in identity
+    assert identity == identity_for_key("sk-secret")
+
+
+def test_parse_limits_tolerates_legacy_snapshots():
+    assert parse_limits(json.dumps(["a"])) == {}
+    assert parse_limits(json.dumps({"keys": ["a"], "limits": {"a": {"rps": 1}}})) == {"a": {"rps": 1}}
+
+
+def test_payer_address_from_json_or_base64_header():
+    payload = {"payload": {"authorization": {"from": "0xAbC"}}}
+    assert X402Manager.payer_address(json.dumps(payload)) == "0xAbC"
+    assert X402Manager.payer_address(base64.b64encode(json.dumps(payload).encode()).decode()) == "0xAbC"
+    assert X402Manager.payer_address("garbage") is None
+
@@ -0,0 +1,56 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import src.proxy as proxy
+from src import fast_json
+from src.request_context import RequestContext
+
+
+def _ctx(body: bytes, headers: list[tuple[bytes, bytes]] | None = None) -> RequestContext:
+    scope = {"type": "http", "headers": headers or [], "query_string": b""}
+    return RequestContext(scope, "v1/chat/completions", body)
+
+
+def test_body_untouched_unless_rewritten():
+    raw = b'{"model": "m", "messages": []}'
+    ctx = _ctx(raw)
+    assert ctx.model_name == "m"
+    assert ctx.body is raw  # no rewrite -> the original bytes are forwarded as-is
+
+
+def test_in_place_rewrite_reserializes_once():
+    ctx = _ctx(b'{"model": "Old", "messages": []}')
+    ctx.json["model"] = "new"
+    ctx.mark_dirty()
+    body = ctx.body
+    assert fast_json.loads(body) == {"model": "new", "messages": []}
+    assert ctx.body is body  # cached until the next change
+
+
+def test_replace_json_swaps_the_shared_view():
+    ctx = _ctx(b'{"model": "m"}')
+    ctx.replace_json({"model": "m", "stripped": True})
+    assert ctx.json == {"model": "m", "stripped": True}
+    assert fast_json.loads(ctx.body) == {"model": "m", "stripped": True}
+
+
+def test_non_object_or_invalid_body_has_no_model():
+    assert _ctx(b"[1, 2]").model_name is None
+    assert _ctx(b"not json").model_name is None
+    assert _ctx(b"\xff\xfe").model_name is None
+    assert _ctx(b'{"model": 3}').model_name is None
+
+
+def test_preferred_instances_cookie():
+    cookie = b'other=1; preferred_instances={"m": "http://a"}'
+    assert _ctx(b"{}", [(b"cookie", cookie)]).preferred_instances == {"m": "http://a"}
+    assert _ctx(b"{}", [(b"cookie", b"preferred_instances=[1]")]).preferred_instances == {}
+    assert _ctx(b"{}").preferred_instances == {}
+
+
+def test_missing_model_is_a_422_like_the_pydantic_body():
+    app = FastAPI()
+    app.include_router(proxy.router)
+    resp = TestClient(app).post("/v1/chat/completions", json={"messages": []})
+    assert resp.status_code == 422
+    assert resp.json()["detail"][0]["loc"] == ["body", "model"]
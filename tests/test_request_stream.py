@@ -0,0 +1,81 @@
+import asyncio
+import json
+
+import pytest
+
+from src.request_context import RequestContext
+from src.request_stream import ClientDisconnected, StreamedBody, TopLevelScanner
+
+DOC = {
+    "messages": [{"role": "user", "content": [{"image_url": {"url": "data:" + "QUJD" * 2000}}, 'a"b\\c}{][']}],
+    "stream": True,
+    "model": 'Qwené/x"y',
+    "n": 1.5e3,
+}
+
+
+def _scan(raw: bytes, size: int, fields=("model", "stream", "n")) -> TopLevelScanner:
+    scanner = TopLevelScanner(frozenset(fields))
+    for i in range(0, len(raw), size):
+        scanner.feed(raw[i : i + size])
+    return scanner
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 100_000])
+@pytest.mark.parametrize("ascii_only", [True, False])
+def test_finds_top_level_fields_across_any_chunking(size, ascii_only):
+    scanner = _scan(json.dumps(DOC, ensure_ascii=ascii_only).encode(), size)
+    assert not scanner.failed and scanner.done
+    assert scanner.values == {"model": DOC["model"], "stream": True, "n": 1500.0}
+
+
+def test_nested_fields_are_not_top_level():
+    scanner = _scan(b'{"x": {"model": "inner"}, "y": ["model"], "model": "outer"}', 5)
+    assert scanner.values == {"model": "outer"}
+
+
+@pytest.mark.parametrize("raw", [b"[1]", b'"model"', b'{"model" 1}', b'{"a": tru, "model": "m"}'])
+def test_non_objects_fail(raw):
+    scanner = _scan(raw, 4, ("model",))
+    assert scanner.failed and "model" not in scanner.values
+
+
+def _receive(*chunks: bytes, disconnect: bool = False):
+    messages = [{"type": "http.request", "body": c, "more_body": i < len(chunks) - 1} for i, c in enumerate(chunks)]
+    if disconnect:
+        messages[-1]["more_body"] = True
+        messages.append({"type": "http.disconnect"})
+
+    async def receive():
+        return messages.pop(0)
+
+    return receive
+
+
+def test_scan_reads_the_whole_object_and_replays_everything():
+    async def scenario():
+        stream = StreamedBody(_receive(b'{"model": "m", ', b'"messages": []', b"}"))
+        assert await stream.scan("model") == "m"
+        first = b"".join([c async for c in stream.replay()])
+        second = b"".join([c async for c in stream.replay()])  # failover attempt
+        return first, second
+
+    assert asyncio.run(scenario()) == (b'{"model": "m", "messages": []}',) * 2
+
+
+def test_duplicate_model_resolves_like_the_buffered_parser():
+    raw = b'{"model": "cheap", "messages": [], "model": "pricey", "n": 1}'
+    chunks = [raw[i : i + 9] for i in range(0, len(raw), 9)]
+    streamed = asyncio.run(StreamedBody(_receive(*chunks)).scan("model"))
+    buffered = RequestContext({"type": "http", "headers": [], "query_string": b""}, "v1/chat/completions", raw)
+    assert streamed == buffered.model_name == "pricey"
+
+
+def test_disconnect_mid_body_raises():
+    async def scenario():
+        stream = StreamedBody(_receive(b'{"model": "m", ', disconnect=True))
+        await stream.scan("model")
+        await stream.read_all()
+
+    with pytest.raises(ClientDisconnected):
+        asyncio.run(scenario())
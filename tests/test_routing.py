@@ -0,0 +1,42 @@
+import pytest
+
+from src import routing
+from src.routing import RoutingTable
+
+
+@pytest.fixture
+def table(monkeypatch):
+    monkeypatch.setattr(routing.config, "MODELS", {"qwen": ["A", "B", "C"], "plain": ["D"]})
+    t = RoutingTable()
+    t.update_health({"qwen": ["B"]}, {"qwen": ["C", "B"]})
+    t.update_aleph({"old-qwen": "qwen"}, {"qwen"}, set())
+    return t
+
+
+def test_tiers_are_disjoint_and_deduplicated(table):
+    route = table.get("qwen")
+    assert (route.healthy, route.capable, route.unknown) == (("B",), ("C",), ("A",))
+    assert route.preferable == {"B", "C"}
+
+
+def test_redirections_and_thinking_variants_resolve(table):
+    assert table.get("Old-Qwen").model == "qwen"
+    thinking = table.get("old-qwen-thinking")
+    assert (thinking.model, thinking.thinking_requested, thinking.is_reasoning) == ("qwen", True, True)
+    assert table.get("qwen").thinking_requested is False
+
+
+def test_unknown_or_non_reasoning_thinking_names_miss(table):
+    assert table.get("nope") is None
+    assert table.get("plain-thinking") is None  # base isn't a reasoning model -> 404
+
+
+def test_servers_sorted_by_load_within_tiers_only(table):
+    # The unknown-tier server is idle but still ranks after the busy healthy one.
+    assert table.get("qwen").servers_by_load({"A": 0, "B": 9, "C": 5}) == ["B", "C", "A"]
+
+
+def test_replaced_models_config_triggers_recompile(table, monkeypatch):
+    monkeypatch.setattr(routing.config, "MODELS", {"new": ["E"]})
+    assert table.get("qwen") is None
+    assert table.get("new").unknown == ("E",)
@@ -0,0 +1,33 @@
+from src import stall
+from src.stall import StallDetector
+
+
+def test_no_timeout_until_enough_samples(monkeypatch):
+    monkeypatch.setattr(stall.config, "STALL_TIMEOUT_MULTIPLIER", 4)
+    monkeypatch.setattr(stall.config, "STALL_TIMEOUT_MIN_SECONDS", 1)
+    detector = StallDetector()
+    for _ in range(stall.MIN_SAMPLES - 1):
+        detector.observe_first_byte("m", True, 2.0)
+    assert detector.first_byte_timeout("m", True) is None
+    detector.observe_first_byte("m", True, 2.0)
+    assert detector.first_byte_timeout("m", True) == 8.0
+
+
+def test_timeouts_are_per_model_and_kind_with_a_floor(monkeypatch):
+    monkeypatch.setattr(stall.config, "STALL_TIMEOUT_MULTIPLIER", 3)
+    monkeypatch.setattr(stall.config, "STALL_TIMEOUT_MIN_SECONDS", 10)
+    detector = StallDetector()
+    for i in range(100):
+        detector.observe_max_gap("m", True, 0.01 if i < 99 else 5.0)  # p99 ignores the one outlier
+        detector.observe_max_gap("big", False, 20.0)
+    assert detector.idle_timeout("m", True) == 10  # 3 x 0.01, raised to the floor
+    assert detector.idle_timeout("big", False) == 60
+    assert detector.idle_timeout("m", False) is None
+
+
+def test_disabled_by_default(monkeypatch):
+    monkeypatch.setattr(stall.config, "STALL_TIMEOUT_MULTIPLIER", 0)
+    detector = StallDetector()
+    for _ in range(100):
+        detector.observe_first_byte("m", True, 1.0)
+    assert detector.first_byte_timeout("m", True) is None
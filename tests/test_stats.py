@@ -0,0 +1,24 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from src import stats
+
+
+def _client():
+    api = FastAPI()
+    api.include_router(stats.router)
+    return TestClient(api)
+
+
+def test_stats_require_the_admin_token(monkeypatch):
+    monkeypatch.setattr(stats.config, "BACKEND_SECRET_TOKEN", "s3cret")
+    assert _client().get("/libertai/stats").status_code == 401
+    assert _client().get("/libertai/stats", headers={"x-admin-token": "nope"}).status_code == 401
+    resp = _client().get("/libertai/stats", headers={"x-admin-token": "s3cret"})
+    assert resp.status_code == 200
+    assert "upstream_pools" in resp.json()
+
+
+def test_stats_are_closed_without_a_configured_secret(monkeypatch):
+    monkeypatch.setattr(stats.config, "BACKEND_SECRET_TOKEN", None)
+    assert _client().get("/libertai/stats", headers={"x-admin-token": ""}).status_code == 401
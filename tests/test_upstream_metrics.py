@@ -0,0 +1,38 @@
+from src.upstream_metrics import MetricsParser, parse
+
+PAGE = """\
+# HELP vllm:num_requests_running Number of requests in model execution batches.
+# TYPE vllm:num_requests_running gauge
+vllm:num_requests_running{engine="0",model_name="a"} 3.0
+vllm:num_requests_running{engine="0",model_name="b"} 2.0
+# TYPE vllm:num_requests_waiting gauge
+vllm:num_requests_waiting{engine="0",model_name="a"} 4.0
+vllm:num_requests_waiting{engine="0",model_name="b"} 0.0
+vllm:kv_cache_usage_perc{engine="0",model_name="a"} 0.25
+vllm:kv_cache_usage_perc{engine="0",model_name="b"} 0.75
+vllm:generation_tokens_total{engine="0",model_name="a"} 1000.0 1712345678000
+vllm:generation_tokens_created{engine="0",model_name="a"} 1.7e+09
+vllm:time_to_first_token_seconds_bucket{le="0.001",model_name="a"} 0.0
+vllm:num_requests_running_weird garbage
+"""
+
+
+def test_sums_series_across_models_and_keeps_peak_kv_cache():
+    load = parse(PAGE)
+    assert (load.running, load.waiting) == (5, 4)
+    assert load.kv_cache_usage == 0.75
+    assert load.generation_tokens == 1000.0
+    assert load.tokens_per_second is None
+
+
+def test_v0_names_and_unlabelled_samples():
+    parser = MetricsParser()
+    for line in (
+        "vllm:num_requests_running 1",
+        "vllm:gpu_cache_usage_perc 0.5",
+        'vllm:avg_generation_throughput_toks_per_s{model_name="a"} 42.5',
+        "vllm:num_requests_waiting{",
+    ):
+        parser.feed(line)
+    assert (parser.load.running, parser.load.waiting) == (1, 0)
+    assert (parser.load.kv_cache_usage, parser.load.tokens_per_second) == (0.5, 42.5)
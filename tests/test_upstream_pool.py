@@ -0,0 +1,101 @@
+import asyncio
+
+import httpx
+
+from src import upstream_pool
+from src.upstream_pool import UpstreamPools, pool_size
+
+
+def test_pool_size_follows_configured_capacity(monkeypatch):
+    monkeypatch.setattr(upstream_pool.config, "UPSTREAM_POOL_CONNECTIONS", 0)
+    monkeypatch.setattr(upstream_pool.config, "UPSTREAM_MAX_CONCURRENCY", 0)
+    assert pool_size() == upstream_pool.DEFAULT_POOL_SIZE
+    monkeypatch.setattr(upstream_pool.config, "UPSTREAM_MAX_CONCURRENCY", 32)
+    assert pool_size() == 32 + upstream_pool.POOL_HEADROOM
+    monkeypatch.setattr(upstream_pool.config, "UPSTREAM_POOL_CONNECTIONS", 8)
+    assert pool_size() == 8
+
+
+def test_each_upstream_gets_its_own_pool():
+    pools = UpstreamPools(httpx.Timeout(5.0))
+    a = pools._client("https://a:443")
+    assert pools._client("https://a:443") is a
+    assert pools._client("https://b:443") is not a
+    assert upstream_pool._origin(httpx.URL("https://a/v1/x")) == upstream_pool._origin(httpx.URL("https://a:443/y"))
+    asyncio.run(pools.aclose())
+
+
+def test_requests_are_sent_through_their_upstream_pool(monkeypatch):
+    pools = UpstreamPools(httpx.Timeout(5.0))
+    seen: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen.append(request.url.host)
+        return httpx.Response(200, text="ok")
+
+    async def scenario():
+        for origin in ("http://a:80", "http://b:80"):
+            pools._clients[origin] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        for url in ("http://a/v1/chat/completions", "http://b/v1/embeddings"):
+            response = await pools.send(pools.build_request("POST", url, content=b"{}"))
+            assert response.text == "ok"
+        await pools.aclose()
+
+    asyncio.run(scenario())
+    assert seen == ["a", "b"]
+
+
+def test_prewarm_opens_connections_and_tolerates_dead_boxes(monkeypatch):
+    monkeypatch.setattr(upstream_pool.config, "UPSTREAM_PREWARM_CONNECTIONS", 2)
+    pools = UpstreamPools(httpx.Timeout(5.0))
+    warmed: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "dead":
+            raise httpx.ConnectError("refused")
+        warmed.append(str(request.url))
+        return httpx.Response(200)
+
+    async def scenario():
+        for origin in ("http://up:80", "http://dead:80"):
+            pools._clients[origin] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        await pools.prewarm(["http://up", "http://dead"])
+        await pools.aclose()
+
+    asyncio.run(scenario())
+    assert warmed == ["http://up/health"] * 2
+
+
+class _Body(httpx.AsyncByteStream):
+    async def __aiter__(self):
+        yield b"ok"
+
+
+def test_stats_count_requests_until_their_response_is_closed():
+    pools = UpstreamPools(httpx.Timeout(5.0))
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "dead":
+            raise httpx.ConnectError("refused")
+        return httpx.Response(200, stream=_Body())
+
+    async def scenario():
+        for origin in ("http://a:80", "http://dead:80"):
+            pools._clients[origin] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        streamed = await pools.send(pools.build_request("POST", "http://a/v1/x"), stream=True)
+        await pools.send(pools.build_request("POST", "http://a/v1/x"))
+        try:
+            await pools.send(pools.build_request("POST", "http://dead/v1/x"))
+        except httpx.ConnectError:
+            pass
+        during = pools.stats()
+        assert await streamed.aread() == b"ok"
+        await streamed.aclose()
+        after = pools.stats()
+        await pools.aclose()
+        return during, after
+
+    during, after = asyncio.run(scenario())
+    assert during["http://a:80"] == {"max": pool_size(), "requests": 1, "http2": during["http://a:80"]["http2"]}
+    assert during["http://dead:80"]["requests"] == 0
+    assert after["http://a:80"]["requests"] == 0
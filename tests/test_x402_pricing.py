@@ -0,0 +1,39 @@
+import asyncio
+
+from src import fast_json
+from src.x402 import X402Manager, _enc, prompt_text
+
+PRICES = {"price_per_million_input_tokens": 1.0, "price_per_million_output_tokens": 2.0}
+
+
+def _price(model: str, info: dict, body: dict) -> float | None:
+    mgr = X402Manager()
+    mgr.prices = {model: info}
+    return asyncio.run(mgr.compute_max_price(model, body))
+
+
+def test_chat_price_counts_message_text_not_its_json():
+    text = "Ünïcödé prompt " * 1000
+    image = {"type": "image_url", "image_url": {"url": "data:image/png;base64," + "A" * 100_000}}
+    body = {
+        "messages": [
+            {"role": "system", "content": "be brief"},
+            {"role": "user", "content": [{"type": "text", "text": text}, image]},
+        ],
+        "max_tokens": 1000,
+    }
+    tokens = len(_enc.encode("\n".join(["system", "be brief", "user", text])))
+    assert _price("m", PRICES, body) == tokens / 1_000_000 + 1000 * 2 / 1_000_000
+    # The image's base64 payload isn't prompt text
+    assert "AAAA" not in prompt_text(body["messages"])[0]
+
+
+def test_embedding_price_counts_texts_and_token_ids():
+    info = {"is_embedding": True, "price_per_million_input_tokens": 1_000_000.0}
+    assert _price("e", info, {"input": ["hello", "world"]}) == len(_enc.encode("hello\nworld"))
+    assert _price("e", info, {"input": [[1, 2, 3], [4]]}) == 4
+
+
+def test_loads_accepts_what_the_stdlib_accepts():
+    assert fast_json.loads(b'{"a": NaN, "b": 123456789012345678901234567890}')["b"] == 123456789012345678901234567890
+    assert fast_json.loads(b'{"a": 1}') == {"a": 1}